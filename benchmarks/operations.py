@@ -0,0 +1,377 @@
+"""
+operations - throughput benchmark of the konfchanger pack operations
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Generates a throwaway home directory of every requested shape, with a backup_locations file listing its
+configurations, and runs backup, apply, list and delete on it through the same Utils methods the commands use.
+delete only renames the pack into the trash, delete-reclaim is the time it then takes until the trash is emptied.
+Reports the latency percentiles, files/s and MB/s of every operation and the peak memory python allocated during it,
+and saves them as JSON. Passing an earlier JSON file with --compare prints how the median latencies changed.
+
+usage: python benchmarks/operations.py [--shape SHAPE ...] [--scale N] [--runs N] [--layout LAYOUT]
+                                       [--output FILE] [--compare FILE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import click
+from konfchanger import konfchanger
+from konfchanger_utils import Utils, KONFIGCHANGER_CONFIG_DIR_PATH, DEFAULT_BACKUP_LIST_FILE_NAME, \
+    DEFAULT_CONFIG_FILE_NAME
+
+# every shape is a list of (kind, count, size) parts, counts are multiplied by --scale
+#   rc: count single rc files in .config, each of them a location of its own
+#   dir: a location directory holding count files
+#   huge: a location directory holding count files of size bytes
+#   deep: a location directory nested count levels deep with a few files on every level
+#   symlinks: a location directory holding count files and a symlink to each of them
+SHAPES = {
+    'rc-files': [('rc', 2000, 256)],
+    'huge-dirs': [('huge', 8, 8 * 1024 * 1024), ('huge', 8, 8 * 1024 * 1024), ('huge', 8, 8 * 1024 * 1024)],
+    'deep': [('deep', 64, 512)],
+    'symlinks': [('symlinks', 1000, 512)],
+    'mixed': [('rc', 200, 256), ('dir', 500, 4096), ('huge', 4, 4 * 1024 * 1024), ('deep', 16, 512),
+              ('symlinks', 100, 512)],
+}
+OPERATIONS = ['backup', 'backup-unchanged', 'list', 'apply', 'apply-unchanged', 'delete']
+# operations whose work goes on after they return, with the name the time until that is finished is reported as
+FINISHED_OPERATIONS = {'delete': 'delete-reclaim'}
+DEEP_FILES_PER_LEVEL = 4
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def build_home(home, shape, scale):
+    """Fills home with the configurations of the shape
+
+    :rtype: list of the locations relative to home"""
+
+    config_dir = os.path.join(home, '.config')
+    os.makedirs(config_dir, exist_ok=True)
+    locations = list()
+    for part_number, (kind, count, size) in enumerate(SHAPES[shape]):
+        count *= scale
+        location = os.path.join('.config', kind + str(part_number))
+        if kind == 'rc':
+            for i in range(count):
+                write_file(os.path.join(config_dir, kind + str(part_number) + '_' + str(i) + 'rc'), size)
+                locations.append(location + '_' + str(i) + 'rc')
+            continue
+        locations.append(location)
+        path = os.path.join(home, location)
+        if kind == 'deep':
+            for level in range(count):
+                path = os.path.join(path, 'level' + str(level))
+                os.makedirs(path)
+                for i in range(DEEP_FILES_PER_LEVEL):
+                    write_file(os.path.join(path, 'file' + str(i)), size)
+            continue
+        os.makedirs(path)
+        for i in range(count):
+            write_file(os.path.join(path, 'file' + str(i)), size)
+            if kind == 'symlinks':
+                os.symlink('file' + str(i), os.path.join(path, 'link' + str(i)))
+    return locations
+
+
+def measure_locations(home, locations):
+    """Returns (files, bytes) of the regular files below the locations"""
+
+    files = 0
+    size = 0
+    for location in locations:
+        path = os.path.join(home, location)
+        if os.path.isfile(path) and not os.path.islink(path):
+            files += 1
+            size += os.path.getsize(path)
+            continue
+        for root, _, file_names in os.walk(path):
+            for name in file_names:
+                file_path = os.path.join(root, name)
+                if not os.path.islink(file_path):
+                    files += 1
+                    size += os.path.getsize(file_path)
+    return files, size
+
+
+def init_home(home, locations, layout, workers):
+    """Does what "init" does, writing the config with the wanted layout directly"""
+
+    config_dir = os.path.join(home, KONFIGCHANGER_CONFIG_DIR_PATH)
+    os.makedirs(config_dir)
+    with open(os.path.join(REPO_DIR, DEFAULT_CONFIG_FILE_NAME), 'r') as default_config_file:
+        config = json.load(default_config_file)
+    config['store_layout'] = layout
+    if workers is not None:
+        config['copy_workers'] = workers
+    with open(os.path.join(config_dir, DEFAULT_CONFIG_FILE_NAME), 'w') as config_file:
+        json.dump(config, config_file)
+    with open(os.path.join(config_dir, DEFAULT_BACKUP_LIST_FILE_NAME), 'w') as backup_list_file:
+        backup_list_file.write('\n'.join(locations) + '\n')
+    os.makedirs(os.path.join(home, config['store_dir']))
+
+
+def new_utils():
+    utils = Utils()
+    utils.disable_info_log()
+    return utils
+
+
+def remove_locations(home, locations):
+    for location in locations:
+        path = os.path.join(home, location)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+
+def get_percentile(sorted_values, percentile):
+    """Nearest rank percentile of the already sorted values"""
+
+    rank = max(1, -(-len(sorted_values) * percentile // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class OperationRunner:
+    """Runs the operations against one generated home, every operation working on the packs the earlier ones left"""
+
+    def __init__(self, home, locations):
+        self.home = home
+        self.locations = locations
+        self.utils = new_utils()
+        self.ctx = click.Context(konfchanger)
+        self.pack_names = list()
+
+    def backup(self, run):
+        name = 'bench' + str(run)
+        pack_path = self.utils.get_config_backup_absolute_path_by_name(name)
+        error_code, error = self.utils.create_directory(pack_path, True)
+        if error_code != 0:
+            raise RuntimeError(error)
+        if self.utils.copy_configs_to_store(pack_path):
+            raise RuntimeError('backup of ' + name + ' failed')
+        self.utils.update_pack_index(name)
+        self.pack_names.append(name)
+
+    def backup_unchanged(self, run):
+        name = self.pack_names[run % len(self.pack_names)]
+        if self.utils.copy_configs_to_store(self.utils.get_config_backup_absolute_path_by_name(name)):
+            raise RuntimeError('backup of ' + name + ' failed')
+        self.utils.update_pack_index(name)
+
+    def list(self, run):
+        self.utils.get_stored_config_name_list()
+        self.utils.echo_configs()
+
+    def prepare_apply(self, run):
+        remove_locations(self.home, self.locations)
+
+    def apply(self, run):
+        self.utils.copy_to_set_locations(self.ctx, self.pack_names[run % len(self.pack_names)])
+
+    def apply_unchanged(self, run):
+        self.apply(run)
+
+    def prepare_delete(self, run):
+        if not self.pack_names:
+            self.backup(run)
+
+    def delete(self, run):
+        name = self.pack_names.pop()
+        self.utils.delete_location(self.utils.get_config_backup_absolute_path_by_name(name))
+        self.utils.remove_from_pack_index(name)
+        self.utils.remove_unreferenced_objects()
+
+    def finish_delete(self, run):
+        # waits for the background process emptying the trash, then removes whatever it left
+        self.utils.empty_trash()
+
+    def time_operation(self, operation, runs):
+        """Runs the operation runs times, and once more while tracing allocations. If the operation has a finish
+        method, it is run right after every run of the operation and timed on its own
+
+        :rtype: (list of latencies in seconds, list of finish latencies in seconds, peak bytes allocated by python)"""
+
+        method_name = operation.replace('-', '_')
+        function = getattr(self, method_name)
+        prepare = getattr(self, 'prepare_' + method_name, None)
+        finish = getattr(self, 'finish_' + method_name, None)
+        latencies = list()
+        finish_latencies = list()
+        for run in range(runs + 1):
+            if prepare is not None:
+                prepare(run)
+            if run == runs:
+                tracemalloc.start()
+                function(run)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                if finish is not None:
+                    finish(run)
+                break
+            start = time.perf_counter()
+            function(run)
+            latencies.append(time.perf_counter() - start)
+            if finish is not None:
+                start = time.perf_counter()
+                finish(run)
+                finish_latencies.append(time.perf_counter() - start)
+        return latencies, finish_latencies, peak
+
+
+def get_summary(operation, latencies, peak, files, size):
+    latencies = sorted(latencies)
+    median = statistics.median(latencies)
+    moves_files = operation not in ('list', 'delete', 'delete-reclaim')
+    return {
+        'operation': operation,
+        'runs': len(latencies),
+        'files': files if moves_files else None,
+        'bytes': size if moves_files else None,
+        'latency_s': {
+            'min': latencies[0],
+            'p50': median,
+            'p90': get_percentile(latencies, 90),
+            'p99': get_percentile(latencies, 99),
+            'max': latencies[-1],
+            'mean': statistics.mean(latencies),
+        },
+        'files_per_s': files / median if moves_files and median > 0 else None,
+        'mb_per_s': size / median / 1e6 if moves_files and median > 0 else None,
+        'peak_python_memory_bytes': peak,
+    }
+
+
+def run_shape(shape, options):
+    """Generates a home of the shape and times every operation on it
+
+    :rtype: list of result dicts"""
+
+    home = tempfile.mkdtemp(prefix='konfchanger_bench_' + shape + '_', dir=options.dir)
+    previous_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    runner = None
+    try:
+        locations = build_home(home, shape, options.scale)
+        files, size = measure_locations(home, locations)
+        init_home(home, locations, options.layout, options.workers)
+        print('{} ({} locations, {} files, {:.1f} MB, {} layout)'.format(shape, len(locations), files, size / 1e6,
+                                                                        options.layout))
+        runner = OperationRunner(home, locations)
+        results = list()
+        for operation in OPERATIONS:
+            latencies, finish_latencies, peak = runner.time_operation(operation, options.runs)
+            timed = [(operation, latencies, peak)]
+            if operation in FINISHED_OPERATIONS:
+                timed.append((FINISHED_OPERATIONS[operation], finish_latencies, None))
+            for timed_operation, timed_latencies, timed_peak in timed:
+                result = get_summary(timed_operation, timed_latencies, timed_peak, files, size)
+                result['shape'] = shape
+                result['layout'] = options.layout
+                result['locations'] = len(locations)
+                results.append(result)
+                throughput = ''
+                if result['files_per_s'] is not None:
+                    throughput = '{:10.0f} files/s {:8.1f} MB/s'.format(result['files_per_s'], result['mb_per_s'])
+                memory = '' if timed_peak is None else '  peak {:6.1f} MB'.format(timed_peak / 1e6)
+                print('  {:<16} p50 {:8.1f} ms  p90 {:8.1f} ms  p99 {:8.1f} ms {}{}'.format(
+                    timed_operation, result['latency_s']['p50'] * 1000, result['latency_s']['p90'] * 1000,
+                    result['latency_s']['p99'] * 1000, throughput, memory))
+        return results
+    finally:
+        if previous_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = previous_home
+        if runner is not None:
+            # no background process may still be emptying the trash while the home is removed
+            runner.utils.empty_trash()
+        shutil.rmtree(home)
+
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_report_path):
+    """Prints how the median latency of every operation changed since the previous report"""
+
+    with open(previous_report_path, 'r') as previous_report_file:
+        previous_report = json.load(previous_report_file)
+    previous = {(result['shape'], result['layout'], result['operation']): result
+                for result in previous_report['results']}
+    print('compared with ' + str(previous_report['meta'].get('version')) + ':')
+    for result in results:
+        old = previous.get((result['shape'], result['layout'], result['operation']))
+        if old is None:
+            continue
+        change = result['latency_s']['p50'] / old['latency_s']['p50'] - 1
+        print('  {:<10} {:<16} p50 {:+7.1%}'.format(result['shape'], result['operation'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='konfchanger backup/apply/list/delete benchmark')
+    parser.add_argument('--shape', choices=sorted(SHAPES), action='append',
+                        help='shape of the generated home directory, can be repeated, defaults to all of them')
+    parser.add_argument('--scale', type=int, default=1, help='multiplies the number of files of every shape')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per operation')
+    parser.add_argument('--layout', choices=['directory', 'objects'], default='directory', help='store layout')
+    parser.add_argument('--workers', type=int, help='copy_workers, defaults to the one of the default config')
+    parser.add_argument('--dir', help='directory to generate the home directories in, defaults to the temp dir')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare the median latencies with')
+    options = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    results = list()
+    for shape in options.shape or sorted(SHAPES):
+        results.extend(run_shape(shape, options))
+    report = {
+        'meta': {
+            'version': get_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'options': vars(options),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        'results': results,
+    }
+    if options.output is not None:
+        with open(options.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print('results saved to ' + options.output)
+    if options.compare is not None:
+        compare(results, options.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
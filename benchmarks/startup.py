@@ -0,0 +1,137 @@
+"""
+startup - startup time regression check for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Runs "konfchanger --help" and "konfchanger list" through konfchanger_daemon.main, the entry point setup.py installs,
+against a throwaway home directory, first with no daemon running and then with one. Compares the median time they take
+beyond a bare "import click" with STARTUP_TARGETS. Exits with 1 if any target is missed, or if "--help" imports any
+module which is only needed to run a command.
+
+usage: python benchmarks/startup.py [--runs N]
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from konfchanger_daemon import NO_DAEMON_ENV, get_socket_path, send_request
+
+# seconds a command may take on top of the interpreter start and the click import, with the daemon down and up.
+# A command answered by the daemon does not import click, so it may take less than the baseline
+STARTUP_TARGETS = {
+    ('--help', 'down'): 0.030,
+    ('list', 'down'): 0.100,
+    ('--help', 'up'): 0.030,
+    ('list', 'up'): 0.010,
+}
+# seconds to wait for a started daemon to answer
+DAEMON_START_TIMEOUT = 10.0
+# modules which must not be imported just to print the help
+LAZY_MODULES = ['konfchanger_utils', 'konfchanger_store', 'konfchanger_copy', 'konfchanger_archive',
+                'konfchanger_index', 'konfchanger_trace', 'konfchanger_watch',
+                'konfchanger_trash', 'konfchanger_sync',
+                'konfchanger_layers', 'konfchanger_walk', 'konfchanger_rules', 'sqlite3',
+                'konfchanger_ini', 'konfchanger_diff', 'konfchanger_verify', 'konfchanger_journal',
+                'konfchanger_api', 'zipfile']
+RUN_CLI = 'from konfchanger_daemon import main; main()'
+
+
+def run(code, args, env, runs):
+    """Returns the median wall time of running the python code with args"""
+
+    timings = list()
+    for _ in range(runs):
+        timer = subprocess.run([sys.executable, '-c', 'import time, subprocess, sys; t = time.perf_counter(); '
+                                'subprocess.run(sys.argv[1:], stdout=subprocess.DEVNULL, check=True); '
+                                'print(time.perf_counter() - t)', sys.executable, '-c', code] + args,
+                               env=env, cwd=REPO_DIR, stdout=subprocess.PIPE, check=True)
+        timings.append(float(timer.stdout))
+    return statistics.median(timings)
+
+
+def get_modules_imported_by_help(env):
+    code = ('import sys, json\n'
+            'from konfchanger_daemon import main\n'
+            'sys.argv[1:] = ["--help"]\n'
+            'try:\n'
+            '    main()\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'print(json.dumps(sorted(sys.modules)))')
+    result = subprocess.run([sys.executable, '-c', code], env=env, cwd=REPO_DIR, stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def start_daemon(env, home):
+    """Starts the daemon of home and returns its process once it answers"""
+
+    import time
+    daemon = subprocess.Popen([sys.executable, '-c', RUN_CLI, 'daemon'], env=env, cwd=REPO_DIR,
+                              stdout=subprocess.DEVNULL)
+    socket_path = get_socket_path(home)
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while send_request({'ping': True}, socket_path) is None:
+        if daemon.poll() is not None or time.monotonic() > deadline:
+            daemon.kill()
+            raise RuntimeError('the daemon did not start')
+        time.sleep(0.05)
+    return daemon
+
+
+def stop_daemon(daemon, env):
+    subprocess.run([sys.executable, '-c', RUN_CLI, 'daemon', '--stop'], env=env, cwd=REPO_DIR,
+                   stdout=subprocess.DEVNULL, check=True)
+    daemon.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='konfchanger startup time regression check')
+    parser.add_argument('--runs', type=int, default=15, help='number of runs per command')
+    options = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='konfchanger_startup_')
+    env = dict(os.environ, HOME=home, PYTHONPATH=REPO_DIR)
+    env.pop(NO_DAEMON_ENV, None)
+    failed = False
+    daemon = None
+    try:
+        os.mkdir(os.path.join(home, '.config'))
+        subprocess.run([sys.executable, '-c', RUN_CLI, 'init'], env=env, cwd=REPO_DIR, stdout=subprocess.DEVNULL,
+                       check=True)
+        imported = set(get_modules_imported_by_help(env))
+        for module in LAZY_MODULES:
+            if module in imported:
+                print('FAIL "--help" imports ' + module)
+                failed = True
+        baseline = run('import click', [], env, options.runs)
+        print('baseline (python + import click): {:.1f} ms'.format(baseline * 1000))
+        for (command, daemon_state), target in STARTUP_TARGETS.items():
+            if daemon_state == 'up' and daemon is None:
+                daemon = start_daemon(env, home)
+            overhead = run(RUN_CLI, [command], env, options.runs) - baseline
+            status = 'ok' if overhead <= target else 'FAIL'
+            print('{:<4} {:<8} daemon {:<4} {:6.1f} ms over baseline (target {:.0f} ms)'.format(
+                status, command, daemon_state, overhead * 1000, target * 1000))
+            failed = failed or overhead > target
+    finally:
+        if daemon is not None:
+            stop_daemon(daemon, env)
+        shutil.rmtree(home)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
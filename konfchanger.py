@@ -8,29 +8,53 @@ This program is distributed in the hope that it will be useful, but WITHOUT ANY
 
 You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
+import os
+import time
 import click
-from konfchanger_utils import Utils
 
-utils = Utils()
+
+class LazyUtils:
+    """Creates Utils, and so reads konfigchanger's config, only when a command first needs it"""
+
+    def __init__(self):
+        self.__utils = None
+
+    def __getattr__(self, name):
+        if self.__utils is None:
+            from konfchanger_utils import Utils
+            self.__utils = Utils()
+        return getattr(self.__utils, name)
+
+
+utils = LazyUtils()
+
+
+def enable_verbose(ctx, flag_name, enable_flag=False):
+    if enable_flag:
+        utils.enable_verbose(ctx, flag_name, enable_flag)
 
 
 @click.group()
+@click.option('--timings', 'timings', is_flag=True, help='If provided, prints the time spent and the files copied, skipped and failed for every configuration location')
+@click.option('--trace-json', 'trace_path', type=click.Path(dir_okay=False, writable=True), help='If provided, writes the timings of every configuration location as JSON to this file')
 @click.pass_context
-def konfchanger(ctx):
+def konfchanger(ctx, timings, trace_path):
     """This is a tool to backup/restore KDE configuration and styles."""
 
-    if utils is None:
-        return 1
+    if timings or trace_path is not None:
+        utils.enable_tracing()
+        ctx.call_on_close(lambda: utils.report_trace(timings, trace_path, ctx.invoked_subcommand))
+    if ctx.invoked_subcommand in ('init', 'backup-all', 'apply-all'):
+        return 0
     utils.logger.log('Checking for Backup directory')
-    store_present = utils.is_konfigchanger_config_present() and utils.is_store_dir_present()
-    if (ctx.invoked_subcommand != 'init') and (not store_present):
+    if not utils.is_store_dir_present():
         utils.logger.info('Please run "init" command for the first time using this tool')
-        return 1
+        ctx.exit(1)
     return 0
 
 
 @konfchanger.command('init')
-@click.option('-v', '--verbose', is_flag=True, callback=utils.enable_verbose, is_eager=True)
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True)
 @click.pass_context
 def init_konfigchanger(ctx, verbose):
     """RUN THIS COMMAND FOR THE FIRST TIME BEFORE USING THIS CLI"""
@@ -63,11 +87,12 @@ def init_konfigchanger(ctx, verbose):
 
 @konfchanger.command()
 @click.option('--name', 'name', type=click.STRING, help='The name to be assigned to the backed up configuration pack')
-@click.option('-v', '--verbose', is_flag=True, callback=utils.enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
 @click.option('--overwrite-existing', 'overwrite', is_flag=True, help='If provided, will overwrite existing configuration pack if provided name matches')
+@click.option('--parent', 'parent', type=click.STRING, help='If provided, only the configurations which differ from this configuration pack are stored, applying the new pack applies it on top of its parent')
 # TODO: implement post backup hook flag
 @click.pass_context
-def backup(ctx, name, overwrite, verbose):
+def backup(ctx, name, overwrite, parent, verbose):
     """Backup current configuration"""
 
     if not utils.is_backup_list_file_present():
@@ -79,37 +104,60 @@ def backup(ctx, name, overwrite, verbose):
     fixed_name = name.strip()
     if fixed_name.startswith('.'):
         fixed_name = fixed_name[1:]
+    if fixed_name == utils.get_switched_config_name():
+        utils.logger.info(fixed_name + ' is the currently switched configuration pack, it already holds the current configurations')
+        return 0
+    if parent is not None:
+        parent_error = utils.check_parent_config(fixed_name, parent)
+        if parent_error is not None:
+            utils.logger.info(parent_error)
+            return 1
     configuration_exists = utils.is_duplicate_name_present_in_store(fixed_name)
-    absolute_path = utils.get_config_backup_absolute_path_by_name(fixed_name)
+    if configuration_exists:
+        replace_error = utils.check_replaced_configs([fixed_name])
+        if replace_error is not None:
+            utils.logger.info(replace_error)
+            return 1
     if (overwrite is False) and (configuration_exists):
         overwrite = click.confirm('Do you want to overwrite the exisiting configuration backup?', abort=True)
         utils.logger.log('Overwrite choice by user:' + str(overwrite))
         if not overwrite:
             return 0
-    error_code, error = utils.create_directory(absolute_path, overwrite)
-    if error_code == 0:
-        if utils.copy_configs_to_store(absolute_path):
-            utils.logger.error('Some error occurred while backing up your configurations.')
-            utils.logger.info('Please use the delete command to delete this configurations backup if needed')
-            return 1
-        else:
-            utils.logger.info(
-                name + ' Backup complete, You can apply this configuration by passing this name -> "' + fixed_name + '" with the --name flag for "apply" option')
-            return 0
-    elif error_code == 1:
-        utils.logger.error('Error creating backup folder at ' + absolute_path)
+    error_code, error = utils.backup_config(fixed_name, parent)
+    if error_code == 1 and error is not None:
+        utils.logger.error('Error creating backup folder at ' + utils.get_config_backup_absolute_path_by_name(fixed_name))
         utils.logger.error(error)
         return 1
+    elif error_code == 1:
+        utils.logger.error('Some error occurred while backing up your configurations.')
+        utils.logger.info('Please use the delete command to delete this configurations backup if needed')
+        return 1
+    utils.logger.info(
+        name + ' Backup complete, You can apply this configuration by passing this name -> "' + fixed_name + '" with the --name flag for "apply" option')
+    return 0
 
 
 @konfchanger.command()
-@click.option('-v', '--verbose', is_flag=True, callback=utils.enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
 @click.option('--name', 'name', type=click.STRING, help='The name to be assigned to the backed up configuration pack')
+@click.option('--archive', 'archive', type=click.Path(exists=True, dir_okay=False), help='If provided, applies this exported archive directly instead of a stored configuration pack')
+@click.option('--overlay', 'overlays', type=click.STRING, multiple=True, help='A configuration pack to apply on top of the named one, can be given more than once. Later ones win for the files they share')
 # TODO: implement post apply hook flag
 @click.pass_context
-def apply(ctx, name, verbose):
+def apply(ctx, name, archive, overlays, verbose):
     """Apply a backed-up configuration"""
 
+    if archive is not None and overlays:
+        utils.logger.info('--overlay can not be used together with --archive')
+        return 1
+    if archive is not None:
+        if utils.get_switched_config_name() is not None:
+            utils.logger.info('Materializing the switched configuration pack before applying')
+            utils.materialize_switched_config(ctx)
+        utils.create_bak_file(ctx)
+        utils.copy_archive_to_set_locations(ctx, archive)
+        utils.logger.info(archive + ' ---- Applied')
+        return 0
     stored_configs = utils.get_stored_config_name_list()
     if stored_configs is None:
         utils.logger.info('No backed up configuration packs present!!\nBackup folder is empty')
@@ -127,18 +175,67 @@ def apply(ctx, name, verbose):
                 name + ' provided name doesnt match with any existing stored configurations.\n Please select one from below:\n')
         if (name is None) or (name not in stored_configs):  # if no name is provided or wrong name is provided
             name = utils.get_config_name()
+    unknown_overlays = [overlay for overlay in overlays if overlay not in stored_configs]
+    if unknown_overlays:
+        utils.logger.info(', '.join(unknown_overlays) + ' provided overlays dont match with any existing stored configurations')
+        return 1
+    if utils.get_switched_config_name() is not None:
+        utils.logger.info('Materializing the switched configuration pack before applying')
+        utils.materialize_switched_config(ctx)
     utils.create_bak_file(ctx)
-    utils.copy_to_set_locations(ctx, name)
+    utils.copy_to_set_locations(ctx, name, overlays)
     # TODO: send kwin reconfigure signal
-    utils.logger.info(name + ' ---- Applied')
+    utils.logger.info(' + '.join((name,) + overlays) + ' ---- Applied')
     return 0
 
 
+@konfchanger.command('undo')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--steps', 'steps', type=click.IntRange(1), default=1, show_default=True, help='The number of applies to undo, the last one first')
+@click.option('--list', 'show_journals', is_flag=True, help='If provided, lists the applies which can be undone instead')
+@click.option('--force', 'force', is_flag=True, help='If provided, also puts back the files which were changed again after they were applied')
+@click.pass_context
+def undo(ctx, steps, show_journals, force, verbose):
+    """Put back the files the last apply replaced"""
+
+    journals = utils.get_apply_journals()
+    if len(journals) == 0:
+        utils.logger.info('There is no apply which can be undone')
+        return 0
+    if show_journals:
+        for i, (_, journal) in enumerate(journals, 1):
+            utils.logger.info('[' + str(i) + '] ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(journal['time'])) +
+                              ' ' + journal['description'] + ' (' + str(len(journal['entries'])) + ' paths)')
+        return 0
+    error_code = 0
+    for description, restored, problems in utils.undo_applies(steps, force):
+        for relative_path, problem in problems:
+            utils.logger.error(relative_path + ' ' + problem)
+        if problems:
+            utils.logger.info(description + ' ---- Partly undone, put back ' + str(restored) + ' paths. Run undo again '
+                              'with --force to also put back the ' + str(len(problems)) + ' paths left')
+            error_code = 1
+        else:
+            utils.logger.info(description + ' ---- Undone, put back ' + str(restored) + ' paths')
+    return error_code
+
+
 @konfchanger.command()
-@click.option('-v', '--verbose', is_flag=True, callback=utils.enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--archive', 'archive', type=click.Path(exists=True, dir_okay=False), help='If provided, lists the contents of this exported archive instead')
+@click.option('-l', '--long', 'long', is_flag=True, help='If provided, also prints size, entry count, timestamps and source host of every configuration pack')
+@click.option('--sort', 'sort', type=click.Choice(['name', 'size', 'entries', 'created', 'updated']), default='name', show_default=True, help='The order of the configuration packs for --long')
+@click.option('--host', 'host', type=click.STRING, help='If provided, only lists configuration packs backed up on this host with --long')
+@click.option('--match', 'pattern', type=click.STRING, help='If provided, only lists configuration packs whose name matches this glob pattern with --long')
 @click.pass_context
-def list(ctx, verbose):
+def list(ctx, archive, long, sort, host, pattern, verbose):
     """List all available backed up configurations"""
+    if archive is not None:
+        utils.echo_archive(archive)
+        return 0
+    if long:
+        utils.echo_configs_long(sort, host, pattern)
+        return 0
     utils.logger.log('Listing existing configurations')
     utils.get_stored_config_name_list()
     utils.echo_configs()
@@ -147,7 +244,7 @@ def list(ctx, verbose):
 
 @konfchanger.command('delete')
 @click.option('--name', 'name', type=click.STRING, help='The name to be assigned to the backed up configuration pack')
-@click.option('-v', '--verbose', is_flag=True, callback=utils.enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
 @click.option('--yes', 'yes', is_flag=True, help='If provided then confirmation to delete a configuration backup wont be asked')
 @click.pass_context
 def delete_configuration_backup(ctx, name, yes, verbose):
@@ -161,8 +258,440 @@ def delete_configuration_backup(ctx, name, yes, verbose):
             name + ' provided name doesnt match with any existing saved configurations.\n Please select 1 from below:\n')
     if (name is None) or (name not in stored_configs):  # if no name is provided or wrong name is provided
         name = utils.get_config_name()
+    if name == utils.get_switched_config_name():
+        utils.logger.info(name + ' is the currently switched configuration pack, please run "materialize" before deleting it')
+        return 1
+    children = utils.get_child_config_names(name)
+    if children:
+        utils.logger.info('These configuration packs are stored as a delta against ' + name + ', please delete them first: ' + ', '.join(children))
+        return 1
     if yes or click.confirm('Do you really want to delete ' + name + ' configuration?', abort=True):
         rem_config_path = utils.get_config_backup_absolute_path_by_name(name)
         utils.delete_location(rem_config_path)
+        utils.remove_from_pack_index(name)
+        utils.remove_unreferenced_objects()
         utils.logger.info(name + ' configuration deleted!!')
     return 0
+
+
+@konfchanger.command('switch')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'name', type=click.STRING, help='The name of the configuration pack to switch to')
+@click.pass_context
+def switch(ctx, name, verbose):
+    """Switch to a backed-up configuration by linking the configurations into it"""
+
+    stored_configs = utils.get_stored_config_name_list()
+    if stored_configs is None:
+        utils.logger.info('No backed up configuration packs present!!\nBackup folder is empty')
+        return 0
+    if (name is not None) and (name not in stored_configs):  # if wrong name is provided
+        utils.logger.info(
+            name + ' provided name doesnt match with any existing stored configurations.\n Please select one from below:\n')
+    if (name is None) or (name not in stored_configs):  # if no name is provided or wrong name is provided
+        name = utils.get_config_name()
+    utils.switch_to_config(ctx, name)
+    utils.logger.info(name + ' ---- Switched')
+    return 0
+
+
+@konfchanger.command('materialize')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.pass_context
+def materialize(ctx, verbose):
+    """Replace the links of a switched configuration with real copies"""
+
+    name = utils.get_switched_config_name()
+    if name is None:
+        utils.logger.info('No configuration pack is switched to, nothing to materialize')
+        return 0
+    utils.materialize_switched_config(ctx)
+    utils.logger.info(name + ' ---- Materialized')
+    return 0
+
+
+@konfchanger.command('watch')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'name', type=click.STRING, help='The name of the configuration pack to keep up to date')
+@click.option('--debounce', 'debounce', type=click.FLOAT, default=1.0, show_default=True, help='Seconds without further changes to wait for before backing up')
+@click.option('--poll-interval', 'poll_interval', type=click.FLOAT, default=2.0, show_default=True, help='Seconds between scans for changes when inotify can not be used')
+@click.option('--polling', 'polling', is_flag=True, help='If provided, scans for changes instead of using inotify')
+@click.pass_context
+def watch(ctx, name, debounce, poll_interval, polling, verbose):
+    """Keep a configuration pack up to date by backing up configurations as they change"""
+
+    if not utils.is_backup_list_file_present():
+        return 1
+    if utils.get_switched_config_name() is not None:
+        utils.logger.info('The configurations are switched to a configuration pack, please run "materialize" before watching them')
+        return 1
+    if name is None:
+        name = click.prompt('Please give the name of the configuration pack to keep up to date', type=click.STRING)
+    fixed_name = name.strip().lstrip('.')
+    absolute_path = utils.get_config_backup_absolute_path_by_name(fixed_name)
+    parent = None
+    if utils.is_duplicate_name_present_in_store(fixed_name):
+        replace_error = utils.check_replaced_configs([fixed_name])
+        if replace_error is not None:
+            utils.logger.info(replace_error)
+            return 1
+        parent = utils.get_parent_config_name(fixed_name)
+        if not utils.is_config_pack_updatable(absolute_path, parent):
+            utils.logger.info(fixed_name + ' can not be updated in place, please run "backup --overwrite-existing" for it first')
+            return 1
+    else:
+        error_code, error = utils.create_directory(absolute_path)
+        if error_code == 1:
+            utils.logger.error('Error creating backup folder at ' + absolute_path)
+            utils.logger.error(error)
+            return 1
+    utils.logger.info('Backing up the current configurations into ' + fixed_name)
+    if utils.copy_configs_to_store(absolute_path, parent=parent):
+        utils.logger.error('Some error occurred while backing up your configurations.')
+    utils.update_pack_index(fixed_name)
+    utils.remove_unreferenced_objects()
+    try:
+        utils.watch_configs(fixed_name, debounce, poll_interval, polling)
+    except KeyboardInterrupt:
+        utils.logger.info('Stopped watching')
+    return 0
+
+
+@konfchanger.command('daemon')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--stop', 'stop', is_flag=True, help='If provided, stops the running daemon instead of starting one')
+@click.pass_context
+def daemon(ctx, stop, verbose):
+    """Serve apply, list, backup and diff from a resident process so they start faster"""
+
+    import konfchanger_daemon
+    socket_path = konfchanger_daemon.get_socket_path(utils.get_home_path())
+    if stop:
+        if not konfchanger_daemon.stop(socket_path):
+            utils.logger.info('No daemon is running')
+            return 1
+        utils.logger.info('Daemon stopped')
+        return 0
+    if not konfchanger_daemon.serve(socket_path, utils.logger):
+        utils.logger.info('A daemon is already running on ' + socket_path)
+        return 1
+    utils.logger.info('Daemon stopped')
+    return 0
+
+
+@konfchanger.command('gc')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.pass_context
+def collect_garbage(ctx, verbose):
+    """Reclaim the space of deleted configurations right away"""
+
+    if utils.is_trash_empty():
+        utils.logger.info('Trash is empty')
+    else:
+        removed, freed, failed = utils.empty_trash()
+        utils.logger.info('Removed ' + str(removed) + ' entries (' + str(freed) + ' bytes) from the trash')
+        if failed:
+            utils.logger.error(str(failed) + ' entries in the trash could not be removed')
+    removed_objects = utils.remove_unreferenced_objects()
+    utils.logger.info('Removed ' + str(removed_objects) + ' unreferenced objects')
+    return 0
+
+
+konfchanger.add_command(collect_garbage, 'empty-trash')
+
+
+def get_packs_to_sync(names, available_names, switched_name, dest_store):
+    """Returns the packs to synchronize: the given names or, if there are none, every available pack.
+    The pack dest_store is switched to is left out, None is returned if a name is not available"""
+
+    unknown_names = [name for name in names if name not in available_names]
+    if unknown_names:
+        utils.logger.info(', '.join(unknown_names) + ' provided names dont match with any existing stored configurations')
+        return None
+    names = [name for name in names or available_names]
+    if switched_name in names:
+        utils.logger.info(switched_name + ' is the currently switched configuration pack of ' + dest_store + ', skipping it')
+        names.remove(switched_name)
+    return names
+
+
+@konfchanger.command('push')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--remote', 'remote', type=click.Path(exists=True, file_okay=False), required=True, help='The store to send configuration packs to, a local path or a mounted directory')
+@click.option('--name', 'names', type=click.STRING, multiple=True, help='The name of a configuration pack to send, can be given more than once, together with the packs it is stored as a delta against. Defaults to every configuration pack')
+@click.pass_context
+def push(ctx, remote, names, verbose):
+    """Send configuration packs to another store, transferring only what changed"""
+
+    if os.path.samefile(remote, utils.get_store_dir()):
+        utils.logger.info(remote + ' is the store itself')
+        return 1
+    stored_configs = utils.get_stored_config_name_list()
+    if stored_configs is None:
+        utils.logger.info('No backed up configuration packs present!!\nBackup folder is empty')
+        return 0
+    try:
+        names = utils.get_config_layers(names)
+    except ValueError as e:
+        utils.logger.error(e)
+        return 1
+    names = get_packs_to_sync(names, stored_configs, utils.get_switched_config_name(remote), remote)
+    if names is None:
+        return 1
+    replace_error = utils.check_replaced_configs(names, remote, utils.get_store_dir())
+    if replace_error is not None:
+        utils.logger.info(remote + ': ' + replace_error)
+        return 1
+    failed = utils.push_configs(remote, names)
+    if failed:
+        utils.logger.error('Could not send ' + ', '.join(failed) + ' to ' + remote)
+        return 1
+    utils.logger.info('Sent ' + str(len(names)) + ' configuration packs to ' + remote +
+                      ', run "reindex" with that store to list them there')
+    return 0
+
+
+@konfchanger.command('pull')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--remote', 'remote', type=click.Path(exists=True, file_okay=False), required=True, help='The store to fetch configuration packs from, a local path or a mounted directory')
+@click.option('--name', 'names', type=click.STRING, multiple=True, help='The name of a configuration pack to fetch, can be given more than once, together with the packs it is stored as a delta against. Defaults to every configuration pack')
+@click.pass_context
+def pull(ctx, remote, names, verbose):
+    """Fetch configuration packs from another store, transferring only what changed"""
+
+    if os.path.samefile(remote, utils.get_store_dir()):
+        utils.logger.info(remote + ' is the store itself')
+        return 1
+    remote_configs = utils.get_remote_config_name_list(remote)
+    if not remote_configs:
+        utils.logger.info('No configuration packs present in ' + remote)
+        return 0
+    try:
+        names = utils.get_config_layers(names, remote)
+    except ValueError as e:
+        utils.logger.error(e)
+        return 1
+    names = get_packs_to_sync(names, remote_configs, utils.get_switched_config_name(), utils.get_store_dir())
+    if names is None:
+        return 1
+    replace_error = utils.check_replaced_configs(names, source_store=remote)
+    if replace_error is not None:
+        utils.logger.info(replace_error)
+        return 1
+    failed = utils.pull_configs(remote, names)
+    if failed:
+        utils.logger.error('Could not fetch ' + ', '.join(failed) + ' from ' + remote)
+        return 1
+    utils.logger.info('Fetched ' + str(len(names)) + ' configuration packs from ' + remote)
+    return 0
+
+
+@konfchanger.command('diff')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'name', type=click.STRING, help='The name of the configuration pack to compare')
+@click.option('--against', 'against', type=click.STRING, help='The name of the configuration pack to compare with, defaults to the current configurations')
+@click.pass_context
+def diff(ctx, name, against, verbose):
+    """Show how the current configurations or another pack differ from a backed-up configuration"""
+
+    stored_configs = utils.get_stored_config_name_list()
+    if stored_configs is None:
+        utils.logger.info('No backed up configuration packs present!!\nBackup folder is empty')
+        return 0
+    if (name is not None) and (name not in stored_configs):  # if wrong name is provided
+        utils.logger.info(
+            name + ' provided name doesnt match with any existing stored configurations.\n Please select one from below:\n')
+    if (name is None) or (name not in stored_configs):  # if no name is provided or wrong name is provided
+        name = utils.get_config_name()
+    if (against is not None) and (against not in stored_configs):
+        utils.logger.info(against + ' provided name doesnt match with any existing stored configurations')
+        return 1
+    error_code, error = utils.diff_configs(name, against)
+    if error_code == 1:
+        utils.logger.error('Error while comparing ' + name)
+        utils.logger.error(error)
+    return error_code
+
+
+@konfchanger.command('verify')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'names', type=click.STRING, multiple=True, help='The name of a configuration pack to verify, can be given more than once. Defaults to every configuration pack')
+@click.option('--full', 'full', is_flag=True, help='If provided, reads every file again instead of trusting the checksums of files which did not change since they were last verified')
+@click.pass_context
+def verify(ctx, names, full, verbose):
+    """Check backed-up configurations for corrupted or missing files"""
+
+    stored_configs = utils.get_stored_config_name_list()
+    if stored_configs is None:
+        utils.logger.info('No backed up configuration packs present!!\nBackup folder is empty')
+        return 0
+    for name in names:
+        if not os.path.isdir(utils.get_config_backup_absolute_path_by_name(name)):
+            utils.logger.info(name + ' provided name doesnt match with any existing stored configurations')
+            return 1
+    result = utils.verify_configs(names, full)
+    for name, relative_path, problem in result.problems:
+        utils.logger.error(name + ': ' + (relative_path + ' ' if relative_path else '') + problem)
+    utils.logger.info('Checked ' + str(result.files_checked) + ' files, read ' + str(result.files_hashed) + ' of them (' +
+                      str(result.bytes_hashed) + ' bytes), found ' + str(len(result.problems)) + ' problems')
+    if result.files_without_checksum:
+        utils.logger.info(str(result.files_without_checksum) + ' files were backed up without a checksum, only their '
+                          'size was checked. Run backup with --overwrite-existing for their packs to record one')
+    return 1 if result.problems else 0
+
+
+@konfchanger.command('export')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'name', type=click.STRING, help='The name of the configuration pack to export')
+@click.option('--output', 'output', type=click.Path(dir_okay=False, writable=True), help='The archive file to write, defaults to <name>.kpack')
+@click.option('--compression', 'compression', type=click.Choice(['store', 'deflate', 'bzip2', 'lzma']), default='deflate', show_default=True, help='The compression used for the archive')
+@click.pass_context
+def export_configuration_backup(ctx, name, output, compression, verbose):
+    """Export a backed-up configuration into a single archive file"""
+
+    stored_configs = utils.get_stored_config_name_list()
+    if stored_configs is None:
+        utils.logger.info('No backed up configuration packs present!!\nBackup folder is empty')
+        return 0
+    if (name is not None) and (name not in stored_configs):  # if wrong name is provided
+        utils.logger.info(
+            name + ' provided name doesnt match with any existing stored configurations.\n Please select one from below:\n')
+    if (name is None) or (name not in stored_configs):  # if no name is provided or wrong name is provided
+        name = utils.get_config_name()
+    output = utils.export_config(name, output, compression)
+    if output is None:
+        return 1
+    utils.logger.info(name + ' exported to ' + output)
+    return 0
+
+
+@konfchanger.command('import')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--archive', 'archive', type=click.Path(exists=True, dir_okay=False), required=True, help='The exported archive to import')
+@click.option('--name', 'name', type=click.STRING, help='The name to be assigned to the imported configuration pack, defaults to the archive name')
+@click.option('--overwrite-existing', 'overwrite', is_flag=True, help='If provided, will overwrite existing configuration pack if provided name matches')
+@click.pass_context
+def import_configuration_backup(ctx, archive, name, overwrite, verbose):
+    """Import a configuration pack from an exported archive file"""
+
+    if name is None:
+        name = os.path.splitext(os.path.basename(archive))[0]
+    fixed_name = name.strip().lstrip('.')
+    if fixed_name == utils.get_switched_config_name():
+        utils.logger.info(fixed_name + ' is the currently switched configuration pack, please run "materialize" first')
+        return 1
+    if utils.is_duplicate_name_present_in_store(fixed_name):
+        replace_error = utils.check_replaced_configs([fixed_name])
+        if replace_error is not None:
+            utils.logger.info(replace_error)
+            return 1
+        if not overwrite:
+            click.confirm('Do you want to overwrite the exisiting configuration backup?', abort=True)
+    if utils.import_config(archive, fixed_name):
+        return 1
+    utils.update_pack_index(fixed_name)
+    utils.remove_unreferenced_objects()
+    utils.logger.info(archive + ' imported as ' + fixed_name)
+    return 0
+
+
+@konfchanger.command('reindex')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.pass_context
+def reindex(ctx, verbose):
+    """Rebuild the index of backed up configurations from the store"""
+
+    stored_configs = utils.reindex_store()
+    utils.logger.info('Indexed ' + str(len(stored_configs)) + ' configuration packs')
+    return 0
+
+
+def get_homes(root, homes):
+    """Returns the homes given and every directory directly below root, if given"""
+
+    from konfchanger_api import find_homes
+    all_homes = [os.path.abspath(home) for home in homes]
+    if root is not None:
+        all_homes += [home for home in find_homes(root) if home not in all_homes]
+    return all_homes
+
+
+def run_for_homes(run, root, homes, locations_file, results_path):
+    """Runs run, backup_homes or apply_homes of konfchanger_api, for the homes, printing a line for every home as it
+    finishes and writing every result as JSON to results_path if given"""
+
+    import json
+    all_homes = get_homes(root, homes)
+    if len(all_homes) == 0:
+        utils.logger.info('No home directories given, pass --root or --home')
+        return 1
+    locations = None
+    if locations_file is not None:
+        with open(locations_file, 'r') as lines:
+            locations = lines.readlines()
+
+    def echo_result(result):
+        if result.ok:
+            utils.logger.info(result.home + ' ---- wrote ' + str(result.files_copied) + ' files (' +
+                              str(result.bytes_copied) + ' bytes), skipped ' + str(result.files_skipped) + ' identical files')
+        else:
+            utils.logger.info(result.home + ' ---- failed')
+        for error in result.errors:
+            utils.logger.error(result.home + ': ' + error)
+
+    results = run(all_homes, locations=locations, on_result=echo_result)
+    failed = [result for result in results if not result.ok]
+    utils.logger.info(str(len(results) - len(failed)) + ' of ' + str(len(results)) + ' home directories done')
+    if results_path is not None:
+        with open(results_path, 'w') as results_file:
+            json.dump([result.to_dict() for result in results], results_file, indent=2)
+    return 1 if failed else 0
+
+
+@konfchanger.command('backup-all')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'name', type=click.STRING, required=True, help='The name to be assigned to the configuration pack backed up in every home directory, an existing one is overwritten')
+@click.option('--root', 'root', type=click.Path(exists=True, file_okay=False), help='Backs up every home directory directly below this directory, like /home')
+@click.option('--home', 'homes', type=click.Path(exists=True, file_okay=False), multiple=True, help='A home directory to back up, can be given more than once')
+@click.option('--store', 'store', type=click.STRING, help='The store to use in every home directory, relative to it or absolute. Defaults to the store of its konfigchanger config')
+@click.option('--locations', 'locations_file', type=click.Path(exists=True, dir_okay=False), help='A configuration list file to use for every home directory. Defaults to the one of its konfigchanger config')
+@click.option('--parent', 'parent', type=click.STRING, help='If provided, only the configurations which differ from this configuration pack are stored')
+@click.option('--processes', 'processes', type=click.IntRange(1), help='The number of home directories handled at a time, defaults to the number of CPUs')
+@click.option('--json', 'results_path', type=click.Path(dir_okay=False, writable=True), help='If provided, writes the result of every home directory as JSON to this file')
+@click.pass_context
+def backup_all(ctx, name, root, homes, store, locations_file, parent, processes, results_path, verbose):
+    """Backup the configurations of many home directories at once"""
+
+    from konfchanger_api import backup_homes
+
+    def run(all_homes, locations, on_result):
+        return backup_homes(all_homes, name, processes, on_result, store_dir=store, locations=locations, parent=parent)
+
+    if run_for_homes(run, root, homes, locations_file, results_path):
+        ctx.exit(1)
+    return 0
+
+
+@konfchanger.command('apply-all')
+@click.option('-v', '--verbose', is_flag=True, callback=enable_verbose, is_eager=True, help='If provied, will print verbose logs')
+@click.option('--name', 'name', type=click.STRING, required=True, help='The name of the configuration pack to apply in every home directory')
+@click.option('--overlay', 'overlays', type=click.STRING, multiple=True, help='A configuration pack to apply on top of the named one, can be given more than once')
+@click.option('--root', 'root', type=click.Path(exists=True, file_okay=False), help='Applies to every home directory directly below this directory, like /home')
+@click.option('--home', 'homes', type=click.Path(exists=True, file_okay=False), multiple=True, help='A home directory to apply to, can be given more than once')
+@click.option('--store', 'store', type=click.STRING, help='The store to use in every home directory, relative to it or absolute. Defaults to the store of its konfigchanger config')
+@click.option('--locations', 'locations_file', type=click.Path(exists=True, dir_okay=False), help='A configuration list file to use for every home directory. Defaults to the one of its konfigchanger config')
+@click.option('--processes', 'processes', type=click.IntRange(1), help='The number of home directories handled at a time, defaults to the number of CPUs')
+@click.option('--json', 'results_path', type=click.Path(dir_okay=False, writable=True), help='If provided, writes the result of every home directory as JSON to this file')
+@click.pass_context
+def apply_all(ctx, name, overlays, root, homes, store, locations_file, processes, results_path, verbose):
+    """Apply a backed-up configuration to many home directories at once"""
+
+    from konfchanger_api import apply_homes
+
+    def run(all_homes, locations, on_result):
+        return apply_homes(all_homes, name, processes, on_result, store_dir=store, locations=locations,
+                           overlays=overlays)
+
+    if run_for_homes(run, root, homes, locations_file, results_path):
+        ctx.exit(1)
+    return 0
@@ -0,0 +1,349 @@
+"""
+konfchanger_api - a non-interactive programming interface to konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Every function takes the home directory it works on explicitly, never asks anything and never prints. It returns a
+Result instead. The store and the locations default to what konfigchanger's config below that home says, and can be
+given instead, the store relative to home or absolute and the locations as the lines of a configuration list file.
+backup and apply run with the privileges of the caller, backup_homes and apply_homes handle every home as its owner
+when run as root:
+
+    from konfchanger_api import backup, apply, backup_homes, find_homes
+
+    result = backup('/home/alice', 'laptop', store_dir='.konfchanger', locations=['.config/kdeglobals', '.config/kwinrc'])
+    if not result.ok:
+        print(result.errors)
+    for result in backup_homes(find_homes('/home'), 'nightly', processes=4):
+        print(result.home, result.ok, result.files_copied)
+"""
+import os
+import click
+import functools
+from konfchanger_utils import Utils
+
+# keys of settings every function accepts, besides store_dir
+SETTING_KEYS = ('store_layout', 'compare_hash', 'copy_workers')
+
+
+class Result:
+    """What a call did for one home directory. It only holds plain data, so it can be sent back from a worker process"""
+
+    def __init__(self, home, name):
+        self.home = home
+        self.name = name
+        self.ok = False
+        # what the command line tool would have printed, and the errors it would have reported
+        self.messages = list()
+        self.errors = list()
+        # the counters of every location per operation, as in the JSON written by --trace-json
+        self.locations = list()
+        # every file which could not be copied, with its location, path, error type and message
+        self.failures = list()
+
+    # totals over every operation, the .bak copies made before applying included
+    def __get_total(self, key):
+        return sum(location[key] for location in self.locations)
+
+    @property
+    def files_copied(self):
+        return self.__get_total('files_copied')
+
+    @property
+    def bytes_copied(self):
+        return self.__get_total('bytes_copied')
+
+    @property
+    def files_skipped(self):
+        return self.__get_total('files_skipped')
+
+    @property
+    def bytes_skipped(self):
+        return self.__get_total('bytes_skipped')
+
+    def to_dict(self):
+        return {
+            'home': self.home,
+            'name': self.name,
+            'ok': self.ok,
+            'messages': self.messages,
+            'errors': self.errors,
+            'locations': self.locations,
+            'failures': self.failures,
+        }
+
+
+class _Context:
+    """Stands in for the click context the Utils methods abort through"""
+
+    def abort(self):
+        raise click.Abort()
+
+
+def _get_utils(home, result, store_dir=None, locations=None, **settings):
+    unknown = [key for key in settings if key not in SETTING_KEYS]
+    if unknown:
+        raise TypeError('Unknown settings ' + ', '.join(unknown) + ', expected any of ' + ', '.join(SETTING_KEYS))
+    settings = {key: value for key, value in settings.items() if value is not None}
+    if store_dir is not None:
+        settings['store_dir'] = store_dir
+    utils = Utils(home, settings, locations)
+    utils.logger.info = lambda message: result.messages.append(str(message))
+    utils.logger.error = lambda error: result.errors.append(str(error))
+    utils.logger.log = lambda message: None
+    utils.enable_tracing()
+    return utils
+
+
+def _check_store(utils, result, locations=None):
+    """Creates the store and the config directory of konfigchanger below the home of utils if they are missing
+
+    :rtype: bool True if the store can be used"""
+
+    if utils.get_store_dir() is None:
+        result.errors.append('There is no konfigchanger config at ' + utils.get_konfig_config_dir_path() +
+                             ', please pass store_dir')
+        return False
+    if locations is None and not utils.is_backup_list_file_present():
+        result.errors.append('There is no configuration list file at ' + utils.get_backup_list_file_path() +
+                             ', please pass locations')
+        return False
+    os.makedirs(utils.get_store_dir(), exist_ok=True)
+    os.makedirs(utils.get_konfig_config_dir_path(), exist_ok=True)
+    return True
+
+
+def _finish(utils, result):
+    result.locations = [record.to_dict() for record in utils.tracer.get_records()]
+    result.failures = list(utils.tracer.failures)
+    return result
+
+
+def backup(home, name, store_dir=None, locations=None, parent=None, overwrite=True, **settings):
+    """Backs up the configurations of home as the pack name, replacing a pack of that name unless overwrite is False or
+    other packs are stored as a delta against it. If the name of a parent pack is given, only what differs from it is
+    stored. settings optionally overrides any of SETTING_KEYS
+
+    :rtype: Result"""
+
+    result = Result(home, name)
+    utils = _get_utils(home, result, store_dir, locations, **settings)
+    try:
+        if not name or name.startswith('.') or os.sep in name:
+            result.errors.append(repr(name) + ' can not be used as the name of a configuration pack')
+            return result
+        if not _check_store(utils, result, locations):
+            return result
+        if name == utils.get_switched_config_name():
+            result.messages.append(name + ' is the currently switched configuration pack, it already holds the '
+                                          'current configurations')
+            result.ok = True
+            return result
+        if parent is not None:
+            parent_error = utils.check_parent_config(name, parent)
+            if parent_error is not None:
+                result.errors.append(parent_error)
+                return result
+        if os.path.isdir(utils.get_config_backup_absolute_path_by_name(name)):
+            if not overwrite:
+                result.errors.append(name + ' already exists and overwrite is False')
+                return result
+            replace_error = utils.check_replaced_configs([name])
+            if replace_error is not None:
+                result.errors.append(replace_error)
+                return result
+        error_code, error = utils.backup_config(name, parent)
+        if error is not None:
+            result.errors.append('Error creating backup folder at ' + utils.get_config_backup_absolute_path_by_name(name))
+            result.errors.append(str(error))
+        result.ok = error_code == 0
+    except Exception as e:
+        result.errors.append(type(e).__name__ + ': ' + str(e))
+    return _finish(utils, result)
+
+
+def apply(home, name, store_dir=None, locations=None, overlays=(), **settings):
+    """Applies the pack name, with the overlay packs given stacked on top of it in order, to the configurations of
+    home. What gets replaced is recorded, so undo can put it back. settings optionally overrides any of SETTING_KEYS
+
+    :rtype: Result"""
+
+    result = Result(home, name)
+    utils = _get_utils(home, result, store_dir, locations, **settings)
+    try:
+        if not _check_store(utils, result, locations):
+            return result
+        stored_configs = _list_store(utils.get_store_dir())
+        unknown = [pack for pack in (name,) + tuple(overlays) if pack not in stored_configs]
+        if unknown:
+            result.errors.append(', '.join(unknown) + ' doesnt match with any existing stored configurations')
+            return result
+        ctx = _Context()
+        if utils.get_switched_config_name() is not None:
+            utils.materialize_switched_config(ctx)
+        utils.create_bak_file(ctx)
+        utils.copy_to_set_locations(ctx, name, tuple(overlays))
+        result.ok = True
+    except click.Abort:
+        pass
+    except Exception as e:
+        result.errors.append(type(e).__name__ + ': ' + str(e))
+    return _finish(utils, result)
+
+
+def list_packs(home, store_dir=None):
+    """Returns the names of the packs in the store of home, sorted
+
+    :rtype: list of str"""
+
+    utils = Utils(home, None if store_dir is None else {'store_dir': store_dir})
+    utils.disable_info_log()
+    utils.disable_error_log()
+    return _list_store(utils.get_store_dir())
+
+
+def _list_store(store_dir):
+    if store_dir is None or not os.path.isdir(store_dir):
+        return list()
+    return sorted(name for name in os.listdir(store_dir)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(store_dir, name)))
+
+
+def find_homes(root):
+    """Returns every directory directly below root, like the homes of every user below /home, sorted"""
+
+    return sorted(entry.path for entry in os.scandir(root)
+                  if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'))
+
+
+def _drop_privileges(uid, gid):
+    import pwd
+    try:
+        groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+    except KeyError:
+        groups = [gid]
+    os.setgroups(groups)
+    os.setgid(gid)
+    os.setuid(uid)
+
+
+def run_as_owner(function, home):
+    """Returns function(home), run in a child process with the user and groups of the owner of home when running as
+    root, so everything created in home belongs to its owner and the owner's permissions apply.
+    The child is forked for every call, the calling process keeps its privileges
+
+    :rtype: Result"""
+
+    st = os.stat(home)
+    if os.geteuid() != 0 or st.st_uid == 0:
+        return function(home)
+    import pickle
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            try:
+                _drop_privileges(st.st_uid, st.st_gid)
+                result = function(home)
+            except BaseException as e:
+                result = Result(home, None)
+                result.errors.append(type(e).__name__ + ': ' + str(e))
+            with os.fdopen(write_fd, 'wb') as result_file:
+                result_file.write(pickle.dumps(result))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as result_file:
+        data = result_file.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise ChildProcessError('The process running as the owner of ' + home + ' ended without a result')
+    return pickle.loads(data)
+
+
+def group_by_store(homes, store_dir=None):
+    """Returns the homes grouped by the store they use, store_dir if given or the store of their konfigchanger config,
+    in the order of homes. A home without a store is in a group of its own
+
+    :rtype: list of list of str"""
+
+    groups = dict()
+    for home in homes:
+        utils = Utils(home, None if store_dir is None else {'store_dir': store_dir})
+        utils.disable_info_log()
+        utils.disable_error_log()
+        store = utils.get_store_dir()
+        groups.setdefault(home if store is None else os.path.realpath(store), list()).append(home)
+    return list(groups.values())
+
+
+def _run_group(function, homes):
+    return [run_as_owner(function, home) for home in homes]
+
+
+def _run_for_homes(function, homes, groups, processes=None, on_result=None, results=None):
+    """Runs function for the homes of every group in a pool of processes, the homes of a group one after another.
+    results optionally holds the Result of homes which are not run, by home
+
+    :rtype: list of Result in the order of homes"""
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    results = results or dict()
+    if on_result is not None:
+        for result in results.values():
+            on_result(result)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(_run_group, function, group): group for group in groups}
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is None:
+                group_results = future.result()
+            else:
+                group_results = [Result(home, None) for home in futures[future]]
+                for result in group_results:
+                    result.errors.append(type(error).__name__ + ': ' + str(error))
+            for result in group_results:
+                results[result.home] = result
+                if on_result is not None:
+                    on_result(result)
+    return [results[home] for home in homes]
+
+
+def backup_homes(homes, name, processes=None, on_result=None, **options):
+    """Runs backup for every home with the same name and options, in a pool of processes, os.cpu_count() of them by
+    default, each home copying with its own copy threads. When running as root, every home is handled as its owner,
+    see run_as_owner. Homes sharing a store are not backed up, as their packs of the same name would replace each
+    other. on_result optionally is called with every Result as soon as its home is done
+
+    :rtype: list of Result in the order of homes"""
+
+    homes = list(homes)
+    groups = group_by_store(homes, options.get('store_dir'))
+    shared = dict()
+    for group in groups:
+        if len(group) > 1:
+            for home in group:
+                result = Result(home, name)
+                result.errors.append('The store of ' + home + ' is shared with ' +
+                                     ', '.join(other for other in group if other != home) +
+                                     ', every home directory needs a store of its own to back up into')
+                shared[home] = result
+    return _run_for_homes(functools.partial(backup, name=name, **options), homes,
+                          [group for group in groups if len(group) == 1], processes, on_result, shared)
+
+
+def apply_homes(homes, name, processes=None, on_result=None, **options):
+    """Runs apply for every home with the same name and options, in a pool of processes like backup_homes.
+    Homes sharing a store are applied to one after another
+
+    :rtype: list of Result in the order of homes"""
+
+    homes = list(homes)
+    return _run_for_homes(functools.partial(apply, name=name, **options), homes,
+                          group_by_store(homes, options.get('store_dir')), processes, on_result)
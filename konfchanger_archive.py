@@ -0,0 +1,230 @@
+"""
+konfchanger_archive - single file export/import of configuration packs for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import time
+import zlib
+import tempfile
+from konfchanger_copy import remove_path
+from konfchanger_store import LAYOUT_OBJECTS, HASH_CHUNK_SIZE, PACK_MANIFEST_FILE_NAME, get_pack_entry_path, \
+    get_root_of, new_manifest, write_manifest
+
+ARCHIVE_EXTENSION = '.kpack'
+# names of the zipfile compression constants, zipfile itself is only imported when an archive is used
+COMPRESSIONS = {
+    'store': 'ZIP_STORED',
+    'deflate': 'ZIP_DEFLATED',
+    'bzip2': 'ZIP_BZIP2',
+    'lzma': 'ZIP_LZMA',
+}
+
+# A pack archive is a zip file: its central directory is the index which lets a single member be read without
+# decompressing the others. Every file of the pack is a member named by its path relative to home, and the pack
+# manifest is stored as the PACK_MANIFEST_FILE_NAME member.
+
+
+def _get_zip_date_time(mtime_ns):
+    date_time = time.localtime(mtime_ns / 1e9)[:6]
+    if date_time[0] < 1980:
+        return 1980, 1, 1, 0, 0, 0
+    return date_time
+
+
+def export_pack(pack_path, manifest, archive_path, object_store=None, compression='deflate', composition=None):
+    """Streams every file of the pack into a compressed archive at archive_path, one file at a time.
+    composition optionally is the Composition the contents of every file are read from, for a pack stored as a delta"""
+
+    import zipfile
+    compress_type = getattr(zipfile, COMPRESSIONS[compression])
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(archive_path)), suffix=ARCHIVE_EXTENSION)
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=compress_type) as archive:
+            roots = set(manifest['roots'])
+            for relative_path in sorted(manifest['entries']):
+                entry = manifest['entries'][relative_path]
+                if entry['type'] != 'file':
+                    continue
+                if composition is not None:
+                    src = composition.open(relative_path)
+                elif manifest.get('layout') == LAYOUT_OBJECTS:
+                    src = open(object_store.get_object_path(entry['hash']), 'rb')
+                else:
+                    src = open(get_pack_entry_path(pack_path, manifest, get_root_of(relative_path, roots),
+                                                   relative_path), 'rb')
+                info = zipfile.ZipInfo(relative_path, _get_zip_date_time(entry['mtime_ns']))
+                info.compress_type = compress_type
+                info.external_attr = (0o100000 | entry['mode']) << 16
+                with src, archive.open(info, 'w') as dst:
+                    for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                        dst.write(chunk)
+            archive.writestr(PACK_MANIFEST_FILE_NAME, json.dumps(manifest))
+        os.replace(tmp_path, archive_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_archive_manifest(archive):
+    """Reads the manifest of the archive, refusing paths which would point outside of home, either by themselves or
+    by lying below a symlink of the archive, which would be written through"""
+
+    manifest = json.loads(archive.read(PACK_MANIFEST_FILE_NAME))
+    entries = manifest['entries']
+    for relative_path in manifest['roots'] + list(entries):
+        if os.path.isabs(relative_path) or os.path.normpath(relative_path).split(os.sep)[0] == '..':
+            raise ValueError('Archive contains a path outside of home: ' + relative_path)
+    for relative_path in entries:
+        parent = os.path.dirname(os.path.normpath(relative_path))
+        while parent:
+            if entries.get(parent, dict()).get('type') == 'symlink':
+                raise ValueError('Archive contains a path below the symlink ' + parent + ': ' + relative_path)
+            parent = os.path.dirname(parent)
+    return manifest
+
+
+def check_inside(root_path, dest):
+    """Raises ValueError unless the parent directory of dest, with every symlink in it resolved, lies in root_path"""
+
+    root = os.path.realpath(root_path)
+    parent = os.path.realpath(os.path.dirname(dest))
+    if parent != root and not parent.startswith(root + os.sep):
+        raise ValueError(dest + ' would be written outside of ' + root_path + ', into ' + parent)
+
+
+def list_archive(archive_path):
+    """Returns (relative_path, size, compressed_size) of every file in the archive, read from its index only"""
+
+    import zipfile
+    with zipfile.ZipFile(archive_path) as archive:
+        return [(info.filename, info.file_size, info.compress_size) for info in archive.infolist()
+                if info.filename != PACK_MANIFEST_FILE_NAME]
+
+
+def import_pack(archive_path, pack_path, layout, object_store=None):
+    """Creates a pack of the given layout at pack_path from the archive, streaming one member at a time"""
+
+    import zipfile
+    with zipfile.ZipFile(archive_path) as archive:
+        archived_manifest = read_archive_manifest(archive)
+        manifest = new_manifest(layout)
+        manifest['roots'] = archived_manifest['roots']
+        manifest['host'] = archived_manifest.get('host', manifest['host'])
+        roots = set(manifest['roots'])
+        dirs = list()
+        for relative_path in sorted(archived_manifest['entries']):
+            entry = dict(archived_manifest['entries'][relative_path])
+            manifest['entries'][relative_path] = entry
+            if layout == LAYOUT_OBJECTS:
+                if entry['type'] == 'file':
+                    with archive.open(relative_path) as src:
+                        entry['hash'] = object_store.put_stream(src)
+                continue
+            root = get_root_of(relative_path, roots)
+            dest = get_pack_entry_path(pack_path, manifest, root, relative_path)
+            check_inside(pack_path, dest)
+            if relative_path == root:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if entry['type'] == 'dir':
+                os.makedirs(dest, exist_ok=True)
+                dirs.append((dest, entry))
+            elif entry['type'] == 'symlink':
+                os.symlink(entry['target'], dest)
+            else:
+                fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+                with archive.open(relative_path) as src, os.fdopen(fd, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                        dst.write(chunk)
+                os.chmod(dest, entry['mode'])
+                os.utime(dest, ns=(entry['mtime_ns'], entry['mtime_ns']))
+                entry['ino'] = os.lstat(dest).st_ino
+        for dest, entry in reversed(dirs):
+            os.chmod(dest, entry['mode'])
+            os.utime(dest, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        write_manifest(pack_path, manifest)
+
+
+def _is_same_as_member(info, dest):
+    """Checks if dest already holds the contents of the archive member, using its size and the CRC32 from the index"""
+
+    if not os.path.isfile(dest) or os.path.islink(dest) or os.path.getsize(dest) != info.file_size:
+        return False
+    crc = 0
+    with open(dest, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+
+def apply_archive(archive_path, home_path, roots, logger, engine):
+    """Writes the entries of the archive below the given roots into home_path without unpacking the archive first
+
+    :rtype: bool True if an error occurred"""
+
+    import zipfile
+    any_error = False
+    with zipfile.ZipFile(archive_path) as archive:
+        manifest = read_archive_manifest(archive)
+        wanted_roots = set(roots)
+        dirs = list()
+        for relative_path in sorted(manifest['entries']):
+            root = get_root_of(relative_path, wanted_roots)
+            if root is None:
+                continue
+            entry = manifest['entries'][relative_path]
+            dest = os.path.join(home_path, relative_path)
+            try:
+                with engine.trace_location(os.path.join(home_path, root)):
+                    check_inside(home_path, dest)
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    if entry['type'] == 'dir':
+                        if not os.path.isdir(dest) or os.path.islink(dest):
+                            engine.record_previous(dest)
+                        if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+                            remove_path(dest)
+                        os.makedirs(dest, exist_ok=True)
+                        dirs.append((dest, entry))
+                    elif entry['type'] == 'symlink':
+                        if os.path.islink(dest) and os.readlink(dest) == entry['target']:
+                            continue
+                        engine.record_previous(dest)
+                        remove_path(dest)
+                        os.symlink(entry['target'], dest)
+                    else:
+                        info = archive.getinfo(relative_path)
+                        if _is_same_as_member(info, dest):
+                            engine.stats.add_skipped(info.file_size)
+                            continue
+                        logger.log('Applying ' + relative_path + ' from ' + archive_path)
+                        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+                        try:
+                            with archive.open(info) as src, os.fdopen(fd, 'wb') as dst:
+                                for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                                    dst.write(chunk)
+                            os.chmod(tmp_path, entry['mode'])
+                            os.utime(tmp_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+                            engine.record_previous(dest)
+                            if os.path.isdir(dest) and not os.path.islink(dest):
+                                remove_path(dest)
+                            os.replace(tmp_path, dest)
+                        except BaseException:
+                            if os.path.exists(tmp_path):
+                                os.unlink(tmp_path)
+                            raise
+                        engine.stats.add_copied(info.file_size)
+            except Exception as e:
+                any_error = True
+                logger.error('Error while applying ' + relative_path + ' into ' + dest)
+                logger.error(e)
+        for dest, entry in reversed(dirs):
+            os.chmod(dest, entry['mode'])
+            os.utime(dest, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    return any_error
@@ -0,0 +1,350 @@
+"""
+konfchanger_copy - an in-process parallel copy engine for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import threading
+import contextlib
+from konfchanger_walk import scan_tree
+
+# ioctl request number of FICLONE from linux/fs.h, asks the filesystem to share the extents of a file (reflink)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# worker threads when no number is configured, the default of ThreadPoolExecutor
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# items handed to the worker pool ahead of the workers, per worker
+IN_FLIGHT_PER_WORKER = 4
+# errors after which the next kernel-side copy mechanism should be tried instead of failing
+UNSUPPORTED_COPY_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+
+def _reflink(source_fd, dest_fd):
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, source_fd)
+        return True
+    except OSError as e:
+        if e.errno in UNSUPPORTED_COPY_ERRNOS + (errno.EPERM,):
+            return False
+        raise
+
+
+def _copy_file_range(source_fd, dest_fd):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while True:
+        try:
+            count = os.copy_file_range(source_fd, dest_fd, COPY_CHUNK_SIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in UNSUPPORTED_COPY_ERRNOS:
+                return False
+            raise
+        if count == 0:
+            return True
+        copied += count
+
+
+def _sendfile(source_fd, dest_fd):
+    offset = 0
+    while True:
+        try:
+            count = os.sendfile(dest_fd, source_fd, offset, COPY_CHUNK_SIZE)
+        except OSError as e:
+            if offset == 0 and e.errno in UNSUPPORTED_COPY_ERRNOS:
+                return False
+            raise
+        if count == 0:
+            return True
+        offset += count
+
+
+def copy_file_contents(source_fd, dest_fd):
+    """Copies the whole contents of source_fd into dest_fd, letting the kernel do the work wherever it can:
+    reflink first, then copy_file_range, then sendfile and finally a plain read/write loop"""
+
+    if _reflink(source_fd, dest_fd) or _copy_file_range(source_fd, dest_fd) or _sendfile(source_fd, dest_fd):
+        return
+    while True:
+        chunk = os.read(source_fd, COPY_CHUNK_SIZE)
+        if not chunk:
+            return
+        os.write(dest_fd, chunk)
+
+
+def copy_metadata(source, dest, st=None):
+    """Copies mode, timestamps, extended attributes and, where allowed, ownership like "cp -a" does"""
+
+    st = st or os.lstat(source)
+    if st.st_uid != os.geteuid() or st.st_gid != os.getegid():
+        try:
+            os.chown(dest, st.st_uid, st.st_gid, follow_symlinks=False)
+        except PermissionError:
+            pass
+    shutil.copystat(source, dest, follow_symlinks=False)
+
+
+def files_have_same_contents(source, dest):
+    with open(source, 'rb') as a, open(dest, 'rb') as b:
+        while True:
+            chunk = a.read(COPY_CHUNK_SIZE)
+            if chunk != b.read(COPY_CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+
+def is_same_entry(source, dest, source_st=None):
+    """Checks if dest already is identical to source, trusting equal size and mtime and
+    only comparing contents when the sizes match but the mtimes differ"""
+
+    source_st = source_st or os.lstat(source)
+    try:
+        dest_st = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    if stat.S_IFMT(source_st.st_mode) != stat.S_IFMT(dest_st.st_mode):
+        return False
+    if stat.S_ISLNK(source_st.st_mode):
+        return os.readlink(source) == os.readlink(dest)
+    if not stat.S_ISREG(source_st.st_mode) or source_st.st_size != dest_st.st_size:
+        return False
+    if source_st.st_mtime_ns == dest_st.st_mtime_ns:
+        return True
+    return files_have_same_contents(source, dest)
+
+
+def copy_file(source, dest):
+    """Copies a regular file with its metadata, writing into the file at dest if there is one and replacing anything
+    else. Returns the lstat result of source, None if dest already is the same file"""
+
+    st = os.lstat(source)
+    if os.path.lexists(dest) and os.path.samestat(st, os.lstat(dest)):
+        return None
+    if os.path.islink(dest) or os.path.isdir(dest):
+        remove_path(dest)
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o7777)
+        try:
+            copy_file_contents(source_fd, dest_fd)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+    copy_metadata(source, dest, st)
+    return st
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+class CopyStats:
+    """Thread safe counters of what a CopyEngine copied and skipped, also handed to the tracer if there is one"""
+
+    def __init__(self, tracer=None):
+        self.__lock = threading.Lock()
+        self.tracer = tracer
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+
+    def add_copied(self, size):
+        with self.__lock:
+            self.files_copied += 1
+            self.bytes_copied += size
+        if self.tracer is not None:
+            self.tracer.add_copied(size)
+
+    def add_skipped(self, size):
+        with self.__lock:
+            self.files_skipped += 1
+            self.bytes_skipped += size
+        if self.tracer is not None:
+            self.tracer.add_skipped(size)
+
+
+class CopyEngine:
+    """Copies files and trees in-process using a pool of worker threads instead of forking "cp" per location"""
+
+    def __init__(self, workers=None, logger=None, tracer=None):
+        self.workers = workers
+        self.logger = logger
+        self.tracer = tracer
+        self.stats = CopyStats(tracer)
+        # the ApplyJournal recording what applying replaces, if any
+        self.journal = None
+
+    def __log(self, message):
+        if self.logger is not None:
+            self.logger.log(message)
+
+    def copy_file(self, source, dest):
+        """Copies a regular file with its metadata, replacing whatever is at dest"""
+
+        st = copy_file(source, dest)
+        if st is not None:
+            self.stats.add_copied(st.st_size)
+
+    def copy_symlink(self, source, dest):
+        if os.path.lexists(dest):
+            remove_path(dest)
+        os.symlink(os.readlink(source), dest)
+        copy_metadata(source, dest)
+
+    def record_previous(self, path, in_place=False):
+        """Saves what is at path into the journal of the engine, if it has one, before it gets replaced.
+        in_place tells that a regular file at path is going to be overwritten instead of replaced by a new file"""
+
+        if self.journal is not None:
+            self.journal.record(path, in_place)
+
+    def trace_location(self, path):
+        """Attributes what is done inside the block to the location of path if the engine has a tracer"""
+
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.trace_location(path)
+
+    def trace_iter(self, path, items):
+        """Yields from the iterator items, attributing the work done to produce every item to the location of path"""
+
+        while True:
+            with self.trace_location(path):
+                item = next(items, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def map(self, function, items, location=None, done=None):
+        """Calls function on every item using the worker pool.
+        items may be any iterable, like a generator walking a tree. It is only consumed as fast as the workers get
+        through it, so no more than IN_FLIGHT_PER_WORKER items per worker are held at a time.
+        location optionally returns the path of the location an item belongs to, for the tracer.
+        done optionally is called in the calling thread with every item function returned for
+
+        :rtype: list of (item, error) for the items for which function raised"""
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+        if self.tracer is not None and location is not None:
+            untraced_function = function
+
+            def function(item):
+                with self.tracer.trace_location(location(item)):
+                    return untraced_function(item)
+
+        workers = self.workers or DEFAULT_WORKERS
+        failed = list()
+        pending = dict()
+
+        def collect(return_when):
+            finished, _ = wait(pending, return_when=return_when)
+            for future in finished:
+                item = pending.pop(future)
+                error = future.exception()
+                if error is not None:
+                    failed.append((item, error))
+                elif done is not None:
+                    done(item)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for item in items:
+                pending[pool.submit(function, item)] = item
+                if len(pending) >= workers * IN_FLIGHT_PER_WORKER:
+                    collect(FIRST_COMPLETED)
+            if pending:
+                collect(ALL_COMPLETED)
+        return failed
+
+    def copy_entry(self, source, dest, skip_identical=False, st=None):
+        """Copies a single file or symlink, doing nothing if skip_identical is set and dest already is identical"""
+
+        st = st or os.lstat(source)
+        if skip_identical and is_same_entry(source, dest, st):
+            self.stats.add_skipped(st.st_size)
+        elif stat.S_ISLNK(st.st_mode):
+            self.record_previous(dest)
+            self.copy_symlink(source, dest)
+        elif stat.S_ISREG(st.st_mode):
+            self.record_previous(dest, in_place=True)
+            self.copy_file(source, dest)
+        else:
+            self.__log('Skipping special file ' + source)
+
+    def copy_entries(self, pairs, skip_identical=False, locations=None):
+        """Copies every (source, dest) pair like "cp -a source dest" where dest is the full destination path.
+        Directories are merged into existing destination directories. Their trees are walked as a stream feeding the
+        workers, so memory only grows with the number of directories, not with the number of files.
+        If skip_identical is set, files and symlinks already identical at their destination are not written again.
+        locations optionally maps a source to the location it is traced as, defaults to the source itself
+
+        :rtype: list of (source, error) for every pair which could not be copied completely"""
+
+        locations = locations or dict()
+        failed = dict()
+        dirs = list()
+
+        def fail(source, error):
+            failed.setdefault(source, error)
+            if self.tracer is not None:
+                self.tracer.add_failed(source, error)
+
+        def iter_jobs():
+            for source, dest in pairs:
+                self.__log('Copying ' + source + ' to ' + dest)
+                try:
+                    yield from self.trace_iter(locations.get(source, source), iter_source_jobs(source, dest))
+                except Exception as e:
+                    failed.setdefault(source, e)
+
+        def iter_source_jobs(source, dest):
+            for job_dest, job_source, st in scan_tree(dest, source, lambda error: fail(source, error)):
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.isdir(job_dest) or os.path.islink(job_dest):
+                        self.record_previous(job_dest)
+                    if os.path.lexists(job_dest) and (os.path.islink(job_dest) or not os.path.isdir(job_dest)):
+                        remove_path(job_dest)
+                    os.makedirs(job_dest, exist_ok=True)
+                    dirs.append((job_source, job_dest, st))
+                else:
+                    yield job_source, job_dest, st, source
+
+        def copy_job(job):
+            job_source, job_dest, st, _ = job
+            self.copy_entry(job_source, job_dest, skip_identical, st)
+
+        for job, error in self.map(copy_job, iter_jobs(), lambda job: locations.get(job[3], job[3])):
+            failed.setdefault(job[3], error)
+        for source, dest, st in reversed(dirs):
+            try:
+                copy_metadata(source, dest, st)
+            except Exception as e:
+                failed.setdefault(source, e)
+        return list(failed.items())
+
+    def move(self, source, dest):
+        """Moves source to dest, falling back to copy and delete when they are on different filesystems"""
+
+        try:
+            os.rename(source, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            failed = self.copy_entries([(source, dest)])
+            if failed:
+                raise failed[0][1]
+            remove_path(source)
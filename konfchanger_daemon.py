@@ -0,0 +1,204 @@
+"""
+konfchanger_daemon - a resident process serving konfchanger commands over a Unix socket, and its thin client
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+The client side only needs the standard library modules imported below, so a command answered by the daemon does not
+pay for importing click and the rest of konfchanger. A request is a single JSON object sent by the client, which then
+shuts down its side of the connection, and the daemon answers with a single JSON object before closing it.
+"""
+import os
+import sys
+import json
+import socket
+import struct
+
+# relative to home, inside konfigchanger's config dir so every home directory gets its own daemon
+DAEMON_SOCKET_PATH = os.path.join('.config', 'konfigchanger_config', 'daemon.sock')
+# commands the client hands to the daemon if one is running, everything else always runs in-process
+DAEMON_COMMANDS = ('apply', 'list', 'backup', 'diff', 'undo')
+# set this environment variable to always run commands in-process
+NO_DAEMON_ENV = 'KONFCHANGER_NO_DAEMON'
+# group options of konfchanger which take a value, needed to find the command in the arguments
+GROUP_OPTIONS_WITH_VALUE = ('--trace-json',)
+RECEIVE_SIZE = 64 * 1024
+
+
+class NeedsInput(Exception):
+    """Raised when a command served by the daemon asks for input, which only the client could give"""
+
+
+class NoInput:
+    """Stands in for stdin while the daemon runs a command"""
+
+    def read(self, *args):
+        raise NeedsInput()
+
+    readline = read
+
+    def isatty(self):
+        return False
+
+
+def get_socket_path(home_path=None):
+    return os.path.join(home_path or os.getenv('HOME'), DAEMON_SOCKET_PATH)
+
+
+def get_command(args):
+    """Returns the konfchanger command in args, None if there is none"""
+
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+        elif arg in GROUP_OPTIONS_WITH_VALUE:
+            skip_next = True
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def receive_all(connection):
+    chunks = list()
+    for chunk in iter(lambda: connection.recv(RECEIVE_SIZE), b''):
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def send_request(message, socket_path=None):
+    """Sends message to the daemon and returns its answer, None if no daemon is listening"""
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(socket_path or get_socket_path())
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        client.sendall(json.dumps(message).encode())
+        client.shutdown(socket.SHUT_WR)
+        return json.loads(receive_all(client) or b'null')
+    finally:
+        client.close()
+
+
+def run_in_daemon(args):
+    """Runs the command in the daemon and prints its output
+
+    :rtype: int the exit code of the command or None if it has to run in-process instead"""
+
+    response = send_request({'args': args, 'cwd': os.getcwd(), 'color': sys.stdout.isatty()})
+    if response is None or response.get('needs_input'):
+        return None
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['exit_code']
+
+
+def main():
+    """Entry point of the konfchanger command: hands apply, list, backup, diff and undo to the daemon if one is running,
+    runs everything else and everything the daemon can not answer in-process"""
+
+    args = sys.argv[1:]
+    if os.getenv(NO_DAEMON_ENV) is None and get_command(args) in DAEMON_COMMANDS:
+        exit_code = run_in_daemon(args)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    from konfchanger import konfchanger
+    konfchanger(prog_name='konfchanger')
+
+
+def is_same_user(connection):
+    """Checks if the peer of the connection runs as the same user as the daemon"""
+
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+
+def run_command(group, utils, message):
+    """Runs a command of the click group in this process, capturing what it prints
+
+    :rtype: dict the answer to the client"""
+
+    import io
+    import traceback
+    import contextlib
+    utils.prepare_for_command()
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exit_code = 0
+    previous_cwd = os.getcwd()
+    previous_stdin = sys.stdin
+    try:
+        os.chdir(message['cwd'])
+        sys.stdin = NoInput()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                group.main(args=message['args'], prog_name='konfchanger', color=message.get('color') or None)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except NeedsInput:
+        return {'needs_input': True}
+    except Exception:
+        stderr.write(traceback.format_exc())
+        exit_code = 1
+    finally:
+        sys.stdin = previous_stdin
+        os.chdir(previous_cwd)
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'exit_code': exit_code}
+
+
+def serve(socket_path, logger):
+    """Answers requests on socket_path one at a time until stopped
+
+    :rtype: bool False if another daemon already listens on socket_path"""
+
+    import signal
+    from konfchanger import konfchanger, utils
+    if send_request({'ping': True}, socket_path) is not None:
+        return False
+    if os.path.lexists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    previous_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(previous_umask)
+    server.listen()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info('Listening on ' + socket_path + ', press Ctrl+C to stop')
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                if not is_same_user(connection):
+                    continue
+                message = json.loads(receive_all(connection))
+                if message.get('ping'):
+                    response = {'pong': True}
+                elif message.get('stop'):
+                    connection.sendall(json.dumps({'stopped': True}).encode())
+                    break
+                else:
+                    response = run_command(konfchanger, utils, message)
+                connection.sendall(json.dumps(response).encode())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+    return True
+
+
+def stop(socket_path):
+    """Asks the daemon listening on socket_path to stop
+
+    :rtype: bool False if no daemon is listening"""
+
+    return send_request({'stop': True}, socket_path) is not None
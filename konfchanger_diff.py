@@ -0,0 +1,123 @@
+"""
+konfchanger_diff - differences between configuration packs and the live configurations for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Both sides of a diff are views with the entries of a manifest and the methods of a Composition to get at the
+contents of their files: get_path, read and get_ini.
+"""
+import os
+from konfchanger_copy import files_have_same_contents
+from konfchanger_ini import is_ini_path, read_ini, diff_ini, format_changes
+from konfchanger_store import make_entry, get_root_of, get_exclude
+from konfchanger_walk import scan_tree
+
+ADDED = 'A'
+DELETED = 'D'
+MODIFIED = 'M'
+
+
+class LiveView:
+    """The configurations below the given roots of home_path as they currently are, left out what the rules of their
+    location exclude"""
+
+    def __init__(self, home_path, roots, logger, location_rules=None):
+        self.home_path = home_path
+        self.roots = list(roots)
+        self.entries = dict()
+        for root in self.roots:
+            source_path = os.path.join(home_path, root)
+            if not os.path.lexists(source_path):
+                continue
+            exclude = get_exclude(location_rules, source_path, logger)
+            for path, _, st in scan_tree(source_path, exclude=exclude, onerror=logger.log):
+                entry = make_entry(path, st=st)
+                if entry['type'] != 'special':
+                    self.entries[os.path.relpath(path, home_path)] = entry
+
+    def get_path(self, relative_path):
+        return os.path.join(self.home_path, relative_path)
+
+    def read(self, relative_path):
+        with open(self.get_path(relative_path), 'rb') as live_file:
+            return live_file.read()
+
+    def get_ini(self, relative_path):
+        return read_ini(self.get_path(relative_path))
+
+
+def is_file_unchanged(old_entry, new_entry):
+    """Checks from their entries alone if two files certainly have the same contents"""
+
+    if old_entry['size'] != new_entry['size']:
+        return False
+    if 'hash' in old_entry and 'hash' in new_entry:
+        return old_entry['hash'] == new_entry['hash']
+    return old_entry['mtime_ns'] == new_entry['mtime_ns']
+
+
+def diff_files(old, new, relative_path):
+    """Returns None if the file at relative_path has the same contents in both views,
+    otherwise the list of lines describing what changed, key by key for INI files"""
+
+    old_entry = old.entries[relative_path]
+    new_entry = new.entries[relative_path]
+    changes = list()
+    if old_entry['mode'] != new_entry['mode']:
+        changes.append('mode: ' + oct(old_entry['mode']) + ' -> ' + oct(new_entry['mode']))
+    if is_file_unchanged(old_entry, new_entry):
+        return changes or None
+    if is_ini_path(relative_path, max(old_entry['size'], new_entry['size'])):
+        old_ini = old.get_ini(relative_path)
+        new_ini = new.get_ini(relative_path)
+        if old_ini is not None and new_ini is not None:
+            changes.extend(format_changes(diff_ini(old_ini.groups, new_ini.groups), old_ini.groups))
+            return changes or None
+    if 'hash' in old_entry and 'hash' in new_entry:
+        same = False
+    else:
+        old_path = old.get_path(relative_path)
+        new_path = new.get_path(relative_path)
+        if old_path is not None and new_path is not None:
+            same = files_have_same_contents(old_path, new_path)
+        else:
+            same = old.read(relative_path) == new.read(relative_path)
+    if same:
+        return changes or None
+    return changes + ['contents differ']
+
+
+def diff_views(old, new, roots):
+    """Compares the entries of both views below roots. Directories are only compared through what is inside them
+
+    :rtype: list of (status, relative path, list of lines describing the changes)"""
+
+    roots = set(roots)
+    differences = list()
+    relative_paths = {relative_path for relative_path in list(old.entries) + list(new.entries)
+                      if get_root_of(relative_path, roots) is not None}
+    for relative_path in sorted(relative_paths):
+        old_entry = old.entries.get(relative_path)
+        new_entry = new.entries.get(relative_path)
+        if (old_entry or new_entry)['type'] == 'dir' and (old_entry is None or new_entry is None or
+                                                          old_entry['type'] == new_entry['type']):
+            continue
+        if old_entry is None:
+            differences.append((ADDED, relative_path, list()))
+        elif new_entry is None:
+            differences.append((DELETED, relative_path, list()))
+        elif old_entry['type'] != new_entry['type']:
+            differences.append((MODIFIED, relative_path, [old_entry['type'] + ' -> ' + new_entry['type']]))
+        elif old_entry['type'] == 'symlink':
+            if old_entry['target'] != new_entry['target']:
+                differences.append((MODIFIED, relative_path, [old_entry['target'] + ' -> ' + new_entry['target']]))
+        else:
+            changes = diff_files(old, new, relative_path)
+            if changes is not None:
+                differences.append((MODIFIED, relative_path, changes))
+    return differences
@@ -0,0 +1,102 @@
+"""
+konfchanger_index - a persistent index of the configuration packs in the store for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+from konfchanger_store import LAYOUT_DIRECTORY, read_manifest
+
+INDEX_FILE_NAME = 'pack_index.sqlite'
+SORT_COLUMNS = {
+    'name': 'name',
+    'size': 'size DESC',
+    'entries': 'entry_count DESC',
+    'created': 'created_at DESC',
+    'updated': 'updated_at DESC',
+}
+
+
+def get_pack_stats(pack_path):
+    """Returns (layout, size, entry_count, source_host) of the pack, from its manifest if it has one"""
+
+    manifest = read_manifest(pack_path)
+    if manifest is not None:
+        size = sum(entry.get('size', 0) for entry in manifest['entries'].values() if entry['type'] == 'file')
+        return manifest.get('layout', LAYOUT_DIRECTORY), size, len(manifest['entries']), manifest.get('host')
+    size = 0
+    entry_count = 0
+    for root, dir_names, file_names in os.walk(pack_path):
+        entry_count += len(dir_names) + len(file_names)
+        for name in file_names:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return LAYOUT_DIRECTORY, size, entry_count, None
+
+
+class PackIndex:
+    """SQLite backed metadata of every stored pack so listing does not need to walk the store"""
+
+    def __init__(self, index_path):
+        import sqlite3
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS packs ('
+                                'name TEXT PRIMARY KEY, layout TEXT, size INTEGER, entry_count INTEGER, '
+                                'created_at REAL, updated_at REAL, source_host TEXT)')
+
+    def close(self):
+        self.connection.close()
+
+    def update_pack(self, name, pack_path, created_at=None):
+        """Records the current metadata of the pack, keeping its creation time if it is already indexed"""
+
+        layout, size, entry_count, source_host = get_pack_stats(pack_path)
+        now = time.time()
+        source_host = source_host or os.uname().nodename
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO packs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (name, layout, size, entry_count, created_at or now, now, source_host))
+            self.connection.execute('UPDATE packs SET layout = ?, size = ?, entry_count = ?, updated_at = ?, '
+                                    'source_host = ? WHERE name = ?',
+                                    (layout, size, entry_count, now, source_host, name))
+
+    def remove_pack(self, name):
+        with self.connection:
+            self.connection.execute('DELETE FROM packs WHERE name = ?', (name,))
+
+    def get_names(self):
+        return [row[0] for row in self.connection.execute('SELECT name FROM packs ORDER BY name')]
+
+    def get_packs(self, sort='name', host=None, pattern=None):
+        """Returns the metadata rows of the packs as dicts, optionally filtered by source host and a name glob"""
+
+        query = 'SELECT name, layout, size, entry_count, created_at, updated_at, source_host FROM packs'
+        conditions = list()
+        parameters = list()
+        if host is not None:
+            conditions.append('source_host = ?')
+            parameters.append(host)
+        if pattern is not None:
+            conditions.append('name GLOB ?')
+            parameters.append(pattern)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY ' + SORT_COLUMNS[sort]
+        columns = ('name', 'layout', 'size', 'entry_count', 'created_at', 'updated_at', 'source_host')
+        return [dict(zip(columns, row)) for row in self.connection.execute(query, parameters)]
+
+    def rebuild(self, store_dir, pack_names):
+        """Drops everything indexed and indexes the given packs of the store again"""
+
+        with self.connection:
+            self.connection.execute('DELETE FROM packs')
+        for name in pack_names:
+            pack_path = os.path.join(store_dir, name)
+            self.update_pack(name, pack_path, created_at=os.stat(pack_path).st_mtime)
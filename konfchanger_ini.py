@@ -0,0 +1,212 @@
+"""
+konfchanger_ini - key level diff and patch of KDE style INI configuration files for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+A file is only treated as INI if its name matches INI_FILE_PATTERNS and every line of it is blank, a comment, a
+[Group] header or a key=value pair with no key twice in a group. Keys before the first header are in the group ''.
+
+The changes from one file to another map every group which differs to None if the group was removed, or to the keys
+of the group which differ, each to its new value or to None if the key was removed.
+"""
+import os
+import fnmatch
+import threading
+import collections
+
+# names of the files compared and stored key by key, rc files of KDE but not dotfiles like .bashrc
+INI_FILE_PATTERNS = ('[!.]*rc', 'kdeglobals', '*.ini')
+# larger files are always handled as a whole
+INI_MAX_SIZE = 1024 * 1024
+PARSE_CACHE_SIZE = 512
+COMMENT_PREFIXES = ('#', ';')
+
+
+class IniFile:
+    """The lines of an INI file and its groups, each a dict of its keys to their values, in file order"""
+
+    def __init__(self, text):
+        self.lines = text.splitlines(keepends=True)
+        self.groups = {'': dict()}
+        group = ''
+        for line_number, line in enumerate(self.lines, 1):
+            stripped = line.strip()
+            if not stripped or stripped.startswith(COMMENT_PREFIXES):
+                continue
+            if is_header(stripped):
+                group = stripped[1:-1]
+                self.groups.setdefault(group, dict())
+                continue
+            key, separator, value = stripped.partition('=')
+            key = key.strip()
+            if not separator or not key:
+                raise ValueError('Line ' + str(line_number) + ' is neither a group header nor a key=value pair')
+            if key in self.groups[group]:
+                raise ValueError('Key ' + key + ' appears twice in group ' + group)
+            self.groups[group][key] = value.strip()
+        if not self.groups['']:
+            del self.groups['']
+
+    def get_text(self):
+        return ''.join(self.lines)
+
+
+def is_header(stripped_line):
+    return stripped_line.startswith('[') and stripped_line.endswith(']')
+
+
+def is_ini_path(path, size=None):
+    """Checks if the file at path should be handled key by key, going by its name and, if given, its size"""
+
+    if size is not None and size > INI_MAX_SIZE:
+        return False
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in INI_FILE_PATTERNS)
+
+
+def parse_ini(data):
+    """Returns the IniFile of the bytes data, None if they are not an INI file"""
+
+    try:
+        return IniFile(data.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+_parse_cache = collections.OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+
+def read_ini(path):
+    """Returns the IniFile of the file at path, None if it is not an INI file.
+    Parsed files are cached by path and stat, so a file which did not change is not read again"""
+
+    st = os.stat(path)
+    stat_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _parse_cache_lock:
+        cached = _parse_cache.get(path)
+        if cached is not None and cached[0] == stat_key:
+            _parse_cache.move_to_end(path)
+            return cached[1]
+    if st.st_size > INI_MAX_SIZE:
+        ini_file = None
+    else:
+        with open(path, 'rb') as ini:
+            ini_file = parse_ini(ini.read())
+    with _parse_cache_lock:
+        _parse_cache[path] = (stat_key, ini_file)
+        _parse_cache.move_to_end(path)
+        while len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    return ini_file
+
+
+def diff_ini(old_groups, new_groups):
+    """Returns the changes turning the groups old_groups into new_groups, empty if they are the same"""
+
+    changes = dict()
+    for group in old_groups:
+        if group not in new_groups:
+            changes[group] = None
+    for group, keys in new_groups.items():
+        old_keys = old_groups.get(group)
+        if old_keys is None:
+            changes[group] = dict(keys)
+            continue
+        group_changes = {key: value for key, value in keys.items() if old_keys.get(key) != value}
+        group_changes.update({key: None for key in old_keys if key not in keys})
+        if group_changes:
+            changes[group] = group_changes
+    return changes
+
+
+def apply_changes(groups, changes):
+    """Returns a copy of groups with the changes applied"""
+
+    groups = {group: dict(keys) for group, keys in groups.items()}
+    for group, group_changes in changes.items():
+        if group_changes is None:
+            groups.pop(group, None)
+            continue
+        keys = groups.setdefault(group, dict())
+        for key, value in group_changes.items():
+            if value is None:
+                keys.pop(key, None)
+            else:
+                keys[key] = value
+    return groups
+
+
+def _insert_before_blank_lines(lines, new_lines):
+    index = len(lines)
+    while index > 0 and not lines[index - 1].strip():
+        index -= 1
+    if index > 0 and not lines[index - 1].endswith('\n'):
+        lines[index - 1] += '\n'
+    lines[index:index] = new_lines
+
+
+def patch_ini(text, changes):
+    """Returns text with the changes applied, only touching the lines of the keys and groups which changed.
+    Comments and the order of everything else are kept, new keys go at the end of their group and new groups at the
+    end of the file"""
+
+    removed_groups = {group for group, group_changes in changes.items() if group_changes is None}
+    pending = {group: dict(group_changes) for group, group_changes in changes.items() if group_changes is not None}
+    lines = list()
+
+    def add_pending_keys(group):
+        keys = pending.pop(group, dict())
+        _insert_before_blank_lines(lines, [key + '=' + value + '\n' for key, value in keys.items() if value is not None])
+
+    group = ''
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if is_header(stripped):
+            add_pending_keys(group)
+            group = stripped[1:-1]
+            if group not in removed_groups:
+                lines.append(line)
+            continue
+        if group in removed_groups:
+            continue
+        key, separator, _ = stripped.partition('=')
+        key = key.strip()
+        group_changes = changes.get(group)
+        if separator and not stripped.startswith(COMMENT_PREFIXES) and group_changes and key in group_changes:
+            value = pending.get(group, dict()).pop(key, None)
+            if value is not None:
+                lines.append(key + '=' + value + ('\n' if line.endswith('\n') else ''))
+            continue
+        lines.append(line)
+    add_pending_keys(group)
+    for group, keys in pending.items():
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        if lines and lines[-1].strip():
+            lines.append('\n')
+        lines.append('[' + group + ']\n')
+        lines.extend(key + '=' + value + '\n' for key, value in keys.items() if value is not None)
+    return ''.join(lines)
+
+
+def format_changes(changes, old_groups):
+    """Returns a line describing every changed key, with its old value taken from old_groups"""
+
+    lines = list()
+    for group, group_changes in changes.items():
+        label = '[' + group + '] ' if group else ''
+        if group_changes is None:
+            lines.append(label + 'removed')
+            continue
+        old_keys = old_groups.get(group, dict())
+        for key, value in group_changes.items():
+            old_value = old_keys.get(key)
+            lines.append(label + key + ': ' + ('(unset)' if old_value is None else old_value) + ' -> ' +
+                         ('(unset)' if value is None else value))
+    return lines
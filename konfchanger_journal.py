@@ -0,0 +1,218 @@
+"""
+konfchanger_journal - journals of what applying configuration packs replaced, to undo them, for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Every apply which changes anything gets a directory in the journal directory, named after the time it started so they
+sort oldest first. Its journal.json maps the path of every destination the apply wrote, relative to home, to what
+was there before: "absent" if nothing was, otherwise the type of the entry and where the entry itself was saved
+below previous/. Files which are replaced by a new file are saved as a hard link, so saving them costs no copy.
+Each entry also keeps the type, size and modification time the destination had after the apply, so undo can leave
+alone what was changed again since.
+"""
+import os
+import json
+import stat
+import time
+import errno
+import shutil
+import threading
+from konfchanger_copy import copy_file
+
+JOURNAL_DIR_NAME = 'journal'
+JOURNAL_FILE_NAME = 'journal.json'
+PREVIOUS_DIR_NAME = 'previous'
+# applies which can be undone, the journals of older ones are removed
+JOURNALS_KEPT = 10
+ABSENT = 'absent'
+
+
+def get_state(st):
+    """Returns what is compared to tell if a path was changed since it was recorded, from its lstat result or None"""
+
+    if st is None:
+        return None
+    if stat.S_ISDIR(st.st_mode):
+        return [stat.S_IFMT(st.st_mode)]
+    return [stat.S_IFMT(st.st_mode), st.st_size, st.st_mtime_ns]
+
+
+def get_entry_type(st):
+    if stat.S_ISDIR(st.st_mode):
+        return 'dir'
+    if stat.S_ISLNK(st.st_mode):
+        return 'symlink'
+    return 'file'
+
+
+def save_previous(path, saved_path, st, in_place=False):
+    """Saves the entry at path, with the lstat result st, as saved_path before it is replaced.
+    A directory is moved away, as it is about to be removed anyway. Anything else is hard linked unless in_place tells
+    that a regular file at path is going to be overwritten, and copied where it can not be linked"""
+
+    if stat.S_ISDIR(st.st_mode):
+        try:
+            os.rename(path, saved_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copytree(path, saved_path, symlinks=True)
+        return
+    if not (in_place and stat.S_ISREG(st.st_mode)):
+        try:
+            os.link(path, saved_path, follow_symlinks=False)
+            return
+        except OSError:
+            pass
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(path), saved_path)
+    else:
+        copy_file(path, saved_path)
+
+
+class ApplyJournal:
+    """Records the destinations an apply writes below home_path and saves what was at them before.
+    record is called by the worker threads right before a destination is replaced"""
+
+    def __init__(self, journal_dir, home_path, description):
+        self.journal_dir = journal_dir
+        self.path = os.path.join(journal_dir, str(time.time_ns()))
+        self.home_path = home_path
+        self.description = description
+        self.entries = dict()
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.join(self.path, PREVIOUS_DIR_NAME))
+
+    def record(self, path, in_place=False):
+        """Saves what is at path unless it was already recorded"""
+
+        relative_path = os.path.relpath(path, self.home_path)
+        with self.__lock:
+            if relative_path in self.entries:
+                return
+            entry = {'type': ABSENT}
+            self.entries[relative_path] = entry
+            saved = os.path.join(PREVIOUS_DIR_NAME, str(len(self.entries)))
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        try:
+            save_previous(path, os.path.join(self.path, saved), st, in_place)
+        except BaseException:
+            with self.__lock:
+                del self.entries[relative_path]
+            raise
+        entry['type'] = get_entry_type(st)
+        entry['saved'] = saved
+
+    def commit(self):
+        """Writes the journal with the state every recorded destination was left in, or removes it if nothing was
+        recorded, and removes the journals of all but the last JOURNALS_KEPT applies
+
+        :rtype: bool True if the journal was written"""
+
+        if not self.entries:
+            shutil.rmtree(self.path)
+            return False
+        for relative_path, entry in self.entries.items():
+            try:
+                entry['after'] = get_state(os.lstat(os.path.join(self.home_path, relative_path)))
+            except FileNotFoundError:
+                entry['after'] = None
+        write_journal(self.path, {'description': self.description, 'time': time.time(), 'entries': self.entries})
+        for journal_path, _ in list_journals(self.journal_dir, complete=False)[JOURNALS_KEPT:]:
+            shutil.rmtree(journal_path, ignore_errors=True)
+        return True
+
+
+def write_journal(journal_path, journal):
+    file_path = os.path.join(journal_path, JOURNAL_FILE_NAME)
+    tmp_path = file_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as journal_file:
+            json.dump(journal, journal_file)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def read_journal(journal_path):
+    """Returns the journal at journal_path, None if it was never completely written"""
+
+    try:
+        with open(os.path.join(journal_path, JOURNAL_FILE_NAME), 'r') as journal_file:
+            return json.load(journal_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def list_journals(journal_dir, complete=True):
+    """Returns (path, journal) of every journal in journal_dir, newest first.
+    Unless complete is set, journals which were never completely written are included with None"""
+
+    if not os.path.isdir(journal_dir):
+        return list()
+    journals = list()
+    for name in sorted(os.listdir(journal_dir), key=lambda name: int(name) if name.isdigit() else -1, reverse=True):
+        journal_path = os.path.join(journal_dir, name)
+        if not name.isdigit() or not os.path.isdir(journal_path):
+            continue
+        journal = read_journal(journal_path)
+        if journal is not None or not complete:
+            journals.append((journal_path, journal))
+    return journals
+
+
+def undo_journal(journal_path, home_path, logger, force=False):
+    """Puts back what the apply of the journal at journal_path replaced, children before their parents.
+    Destinations changed again since the apply are left alone unless force is set. The journal is removed if
+    everything was put back, otherwise it is rewritten with only what was left, so undo can be tried again
+
+    :rtype: (number of paths put back, list of (relative path, why it was left alone))"""
+
+    journal = read_journal(journal_path)
+    entries = journal['entries']
+    restored = 0
+    left = dict()
+    problems = list()
+    for relative_path in sorted(entries, reverse=True):
+        entry = entries[relative_path]
+        path = os.path.join(home_path, relative_path)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            st = None
+        if not force and get_state(st) != entry['after']:
+            left[relative_path] = entry
+            problems.append((relative_path, 'was changed after it was applied'))
+            continue
+        try:
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                os.rmdir(path)
+            elif st is not None:
+                os.unlink(path)
+            if entry['type'] != ABSENT:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.move(os.path.join(journal_path, entry['saved']), path)
+            logger.log('Put back ' + path)
+            restored += 1
+        except OSError as e:
+            left[relative_path] = entry
+            if e.errno == errno.ENOTEMPTY:
+                problems.append((relative_path, 'is a directory with files added after it was applied'))
+            else:
+                problems.append((relative_path, 'could not be put back: ' + str(e)))
+    if left:
+        journal['entries'] = left
+        write_journal(journal_path, journal)
+    else:
+        shutil.rmtree(journal_path)
+    return restored, problems
@@ -0,0 +1,356 @@
+"""
+konfchanger_layers - composition of configuration packs stacked on top of each other for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+A pack backed up against a parent pack only stores the files and symlinks which differ from its parent, every
+directory, and the paths which exist in its parent but not anymore in the configurations. Its manifest names the
+parent as "parent" and lists those paths as "deleted". Such a pack, like any stack of packs given as overlays, is used
+through a Composition of it and all of its parents.
+INI files which differ from the parent only keep the keys which changed, as the "patch" of their manifest entry
+instead of any contents, see konfchanger_ini. Applying them only rewrites those keys in the live files.
+"""
+import io
+import os
+import stat
+import tempfile
+from konfchanger_copy import files_have_same_contents, remove_path
+from konfchanger_ini import IniFile, is_ini_path, read_ini, diff_ini, apply_changes, patch_ini
+from konfchanger_store import LAYOUT_DIRECTORY, LAYOUT_OBJECTS, MANIFEST_VERSION, get_pack_entry_path, get_root_of, \
+    hash_file, read_manifest
+
+
+def get_parent_chain(store_dir, name):
+    """Returns the names of the pack and all of its parents, the topmost parent first"""
+
+    chain = [name]
+    manifest = read_manifest(os.path.join(store_dir, name))
+    while manifest is not None and manifest.get('parent') is not None:
+        parent = manifest['parent']
+        if parent in chain:
+            raise ValueError('The parents of ' + name + ' form a cycle through ' + parent)
+        if not os.path.isdir(os.path.join(store_dir, parent)):
+            raise ValueError(chain[-1] + ' is stored as a delta against ' + parent + ', which does not exist')
+        chain.append(parent)
+        manifest = read_manifest(os.path.join(store_dir, parent))
+    return list(reversed(chain))
+
+
+def expand_layers(store_dir, names):
+    """Returns the packs to stack for the given names, bottom one first: every name preceded by those of its parents
+    which are not already in the stack"""
+
+    layers = list()
+    for name in names:
+        for layer in get_parent_chain(store_dir, name):
+            if layer not in layers:
+                layers.append(layer)
+    return layers
+
+
+def get_children(store_dir, name, names):
+    """Returns which of the named packs are stored as a delta against the pack name"""
+
+    children = list()
+    for child in names:
+        manifest = read_manifest(os.path.join(store_dir, child))
+        if manifest is not None and manifest.get('parent') == name:
+            children.append(child)
+    return children
+
+
+class Composition:
+    """The merged view of the named packs stacked in order, the first one at the bottom. Every path is taken from the
+    topmost pack which has it, and the paths a pack records as deleted hide what the packs below it have there"""
+
+    def __init__(self, store_dir, names, object_store):
+        self.store_dir = store_dir
+        self.names = list(names)
+        self.name = self.names[-1]
+        self.object_store = object_store
+        self.host = None
+        self.roots = list()
+        self.entries = dict()
+        # relative path of every file entry to the file holding its contents, or for INI files stored as key
+        # changes to the file of the nearest layer having it whole, None if there is none
+        self.sources = dict()
+        # relative path of every INI file stored as key changes to those changes, bottom layer first
+        self.patches = dict()
+        for name in self.names:
+            self.__add_layer(name)
+
+    def __remove_below(self, relative_path):
+        """Removes relative_path and everything below it from the view"""
+
+        prefix = relative_path + os.sep
+        for path in [path for path in self.entries if path == relative_path or path.startswith(prefix)]:
+            del self.entries[path]
+            self.sources.pop(path, None)
+            self.patches.pop(path, None)
+
+    def __add_layer(self, name):
+        pack_path = os.path.join(self.store_dir, name)
+        manifest = read_manifest(pack_path)
+        if manifest is None:
+            raise ValueError(name + ' was backed up without a manifest, please run backup with --overwrite-existing '
+                                    'for it before stacking it')
+        for relative_path in manifest.get('deleted', list()):
+            self.__remove_below(relative_path)
+        roots = set(manifest['roots'])
+        for root in manifest['roots']:
+            if root not in self.roots:
+                self.roots.append(root)
+        for relative_path in sorted(manifest['entries']):
+            entry = manifest['entries'][relative_path]
+            previous_entry = self.entries.get(relative_path)
+            if previous_entry is not None and previous_entry['type'] == 'dir' and entry['type'] != 'dir':
+                self.__remove_below(relative_path)
+            self.entries[relative_path] = entry
+            if entry['type'] != 'file':
+                self.sources.pop(relative_path, None)
+                self.patches.pop(relative_path, None)
+                continue
+            if 'patch' in entry:
+                if previous_entry is None or previous_entry['type'] != 'file':
+                    self.sources[relative_path] = None
+                self.patches.setdefault(relative_path, list()).append(entry['patch'])
+                continue
+            self.patches.pop(relative_path, None)
+            if manifest.get('layout') == LAYOUT_OBJECTS:
+                self.sources[relative_path] = self.object_store.get_object_path(entry['hash'])
+            else:
+                self.sources[relative_path] = get_pack_entry_path(pack_path, manifest, get_root_of(relative_path, roots),
+                                                                  relative_path)
+        self.host = manifest.get('host', self.host)
+
+    def get_manifest(self):
+        """Returns a manifest of the whole view, as a pack without parent would have it"""
+
+        entries = dict(self.entries)
+        for relative_path in self.patches:
+            entries[relative_path] = {key: value for key, value in entries[relative_path].items() if key != 'patch'}
+            entries[relative_path]['size'] = len(self.read(relative_path))
+        return {'version': MANIFEST_VERSION, 'layout': LAYOUT_DIRECTORY, 'host': self.host, 'roots': list(self.roots),
+                'entries': entries}
+
+    def get_path(self, relative_path):
+        """Returns the file holding the contents of the file entry at relative_path, None if they are only stored as
+        key changes"""
+
+        return None if relative_path in self.patches else self.sources[relative_path]
+
+    def read(self, relative_path):
+        """Returns the contents of the file entry at relative_path as bytes"""
+
+        source = self.sources[relative_path]
+        if source is None:
+            data = b''
+        else:
+            with open(source, 'rb') as source_file:
+                data = source_file.read()
+        patches = self.patches.get(relative_path)
+        if not patches:
+            return data
+        text = data.decode('utf-8')
+        for changes in patches:
+            text = patch_ini(text, changes)
+        return text.encode('utf-8')
+
+    def open(self, relative_path):
+        """Returns a binary file object reading the contents of the file entry at relative_path"""
+
+        if relative_path in self.patches:
+            return io.BytesIO(self.read(relative_path))
+        return open(self.sources[relative_path], 'rb')
+
+    def get_ini(self, relative_path):
+        """Returns the IniFile of the file entry at relative_path, None if it is not an INI file"""
+
+        if relative_path not in self.patches:
+            return read_ini(self.sources[relative_path])
+        source = self.sources[relative_path]
+        base = IniFile('') if source is None else read_ini(source)
+        if base is None:
+            return None
+        groups = base.groups
+        for changes in self.patches[relative_path]:
+            groups = apply_changes(groups, changes)
+        ini_file = IniFile('')
+        ini_file.groups = groups
+        return ini_file
+
+    def get_patch(self, relative_path, entry, path):
+        """Returns the key changes from what the view has at relative_path to the file entry read from path,
+        None if they are not both INI files"""
+
+        view_entry = self.entries.get(relative_path)
+        if view_entry is None or view_entry['type'] != 'file' or entry['type'] != 'file' or \
+                not is_ini_path(relative_path, entry['size']):
+            return None
+        view_ini = self.get_ini(relative_path)
+        ini_file = read_ini(path)
+        if view_ini is None or ini_file is None:
+            return None
+        return diff_ini(view_ini.groups, ini_file.groups)
+
+    def is_inherited(self, relative_path, entry, path):
+        """Checks if the file or symlink entry, read from path, is the same as what the view has at relative_path.
+        Files with the same size and mode but a different modification time have their contents compared"""
+
+        view_entry = self.entries.get(relative_path)
+        if view_entry is None or view_entry['type'] != entry['type']:
+            return False
+        if entry['type'] == 'symlink':
+            return view_entry['target'] == entry['target']
+        if entry['type'] != 'file' or view_entry['mode'] != entry['mode'] or view_entry['size'] != entry['size']:
+            return False
+        if view_entry['mtime_ns'] == entry['mtime_ns']:
+            return True
+        if relative_path in self.patches:
+            return False
+        view_hash = view_entry.get('hash') or hash_file(self.sources[relative_path])
+        return (entry.get('hash') or hash_file(path)) == view_hash
+
+    def get_deleted(self, relative_paths, roots):
+        """Returns the topmost paths of the view below the given roots which are not among relative_paths"""
+
+        roots = set(roots)
+        deleted = set()
+        for relative_path in sorted(self.entries):
+            if relative_path in relative_paths or get_root_of(relative_path, roots) is None:
+                continue
+            if get_root_of(relative_path, deleted) is None:
+                deleted.add(relative_path)
+        return sorted(deleted)
+
+
+def _is_restored(entry, source, dest):
+    """Checks if dest already holds the contents of the file entry, comparing contents only if size matches but mtime doesn't"""
+
+    try:
+        st = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(st.st_mode) or st.st_size != entry['size']:
+        return False
+    return st.st_mtime_ns == entry['mtime_ns'] or files_have_same_contents(source, dest)
+
+
+def _restore_file(entry, source, dest, engine):
+    if _is_restored(entry, source, dest):
+        engine.stats.add_skipped(entry['size'])
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+    os.close(fd)
+    try:
+        engine.copy_file(source, tmp_path)
+        os.chmod(tmp_path, entry['mode'])
+        os.utime(tmp_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        engine.record_previous(dest)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            remove_path(dest)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _restore_patched_file(composition, relative_path, entry, dest, engine):
+    """Rewrites only the keys of the live INI file at dest which differ from the view, writing the whole file if dest
+    is not an INI file. The file gets the current time as modification time, as it may differ from the backed up one"""
+
+    ini_file = None
+    if os.path.isfile(dest) and not os.path.islink(dest):
+        ini_file = read_ini(dest)
+    view_ini = composition.get_ini(relative_path)
+    if ini_file is not None and view_ini is not None:
+        changes = diff_ini(ini_file.groups, view_ini.groups)
+        if not changes:
+            engine.stats.add_skipped(os.path.getsize(dest))
+            return
+        data = patch_ini(ini_file.get_text(), changes).encode('utf-8')
+    else:
+        data = composition.read(relative_path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_path, entry['mode'])
+        engine.record_previous(dest)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            remove_path(dest)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    engine.stats.add_copied(len(data))
+
+
+def apply_composition(composition, home_path, roots, logger, engine):
+    """Writes the entries of the composition below the given roots into home_path, every destination exactly once
+
+    :rtype: bool True if an error occurred"""
+
+    wanted_roots = set(roots)
+    for root in composition.roots:
+        if root not in wanted_roots:
+            logger.log('could not find associated path to apply ' + root)
+            logger.log('So skipping applying this config!!')
+    any_error = False
+    dirs = list()
+
+    def iter_jobs():
+        nonlocal any_error
+        for relative_path in sorted(composition.entries):
+            root = get_root_of(relative_path, wanted_roots)
+            if root is None:
+                continue
+            entry = composition.entries[relative_path]
+            dest = os.path.join(home_path, relative_path)
+            location = os.path.join(home_path, root)
+            logger.log('Applying ' + relative_path + ' to ' + dest)
+            try:
+                with engine.trace_location(location):
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    if entry['type'] == 'dir':
+                        if not os.path.isdir(dest) or os.path.islink(dest):
+                            engine.record_previous(dest)
+                        if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+                            remove_path(dest)
+                        os.makedirs(dest, exist_ok=True)
+                        dirs.append((dest, entry))
+                        continue
+                    if entry['type'] == 'symlink':
+                        if os.path.islink(dest) and os.readlink(dest) == entry['target']:
+                            continue
+                        engine.record_previous(dest)
+                        remove_path(dest)
+                        os.symlink(entry['target'], dest)
+                        continue
+            except Exception as e:
+                any_error = True
+                logger.error('Error while restoring ' + relative_path + ' into ' + dest)
+                logger.error(e)
+                continue
+            yield relative_path, entry, dest, location
+
+    def restore(job):
+        relative_path, entry, dest, _ = job
+        if relative_path in composition.patches:
+            _restore_patched_file(composition, relative_path, entry, dest, engine)
+        else:
+            _restore_file(entry, composition.sources[relative_path], dest, engine)
+
+    for (_, _, dest, _), e in engine.map(restore, iter_jobs(), lambda job: job[3]):
+        any_error = True
+        logger.error('Error while restoring ' + dest)
+        logger.error(e)
+    for dest, entry in reversed(dirs):
+        os.chmod(dest, entry['mode'])
+        os.utime(dest, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    return any_error
@@ -0,0 +1,201 @@
+"""
+konfchanger_rules - include/exclude rules and size limits of the configuration locations for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Every line of the locations file which starts with whitespace belongs to the location above it. It is either a
+pattern like a line of a .gitignore file, matched against paths relative to the location, or a size limit:
+
+    .config/google-chrome
+        Cache/
+        *.lock
+        !Default/Cache/keep-me
+        max-file-size 10M
+        max-size 500M
+
+The last pattern matching a path decides whether it is excluded, "!" re-includes what an earlier pattern excluded.
+An excluded directory is not walked at all, so nothing below it can be re-included, as with git.
+"""
+import re
+import stat
+
+MAX_FILE_SIZE_OPTION = 'max-file-size'
+MAX_SIZE_OPTION = 'max-size'
+SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?', re.IGNORECASE)
+
+
+def parse_size(text):
+    """Returns the number of bytes of a size like 512, 10K, 1.5M or 2GiB, units being powers of 1024"""
+
+    match = SIZE_PATTERN.fullmatch(text.strip())
+    if match is None:
+        raise ValueError('Invalid size ' + text)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def translate_glob(segment):
+    """Returns the regular expression for a glob matching a single path component"""
+
+    regex = ''
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '\\' and i < len(segment):
+            regex += re.escape(segment[i])
+            i += 1
+        elif char == '[':
+            end = segment.find(']', i + 1 if segment[i:i + 1] in ('!', '^') else i)
+            if end == -1:
+                regex += re.escape(char)
+                continue
+            body = segment[i:end]
+            i = end + 1
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            regex += '[' + body.replace('\\', '\\\\').replace('/', '') + ']'
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+class Pattern:
+    """A single gitignore style pattern"""
+
+    def __init__(self, line):
+        pattern = line.strip()
+        self.negated = pattern.startswith('!')
+        if self.negated or pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # a pattern with a slash other than at its end is relative to the location, any other matches at any depth
+        anchored = '/' in pattern
+        segments = pattern.lstrip('/').split('/')
+        regex = '' if anchored else '(?:.*/)?'
+        for i, segment in enumerate(segments):
+            last = i == len(segments) - 1
+            if segment == '**':
+                regex += '.*' if last else '(?:.*/)?'
+            else:
+                regex += translate_glob(segment) + ('' if last else '/')
+        self.regex = regex
+        self.matcher = re.compile(regex, re.DOTALL)
+
+    def matches(self, relative_path, is_dir):
+        return (is_dir or not self.dir_only) and self.matcher.fullmatch(relative_path) is not None
+
+
+class LocationRules:
+    """The patterns and size limits of a single location.
+    The patterns are compiled into one expression per kind of entry, so a path no pattern matches, which is most of
+    them, is decided by a single match. Only paths some pattern matches are checked pattern by pattern"""
+
+    def __init__(self):
+        self.patterns = list()
+        self.max_file_size = None
+        self.max_size = None
+        self.__any_matcher = None
+        self.__any_file_matcher = None
+        self.__has_negated = False
+
+    def add_line(self, line):
+        """Adds a pattern or size limit line of the locations file, without its leading whitespace"""
+
+        option, _, value = line.partition(' ')
+        if option == MAX_FILE_SIZE_OPTION:
+            self.max_file_size = parse_size(value)
+        elif option == MAX_SIZE_OPTION:
+            self.max_size = parse_size(value)
+        else:
+            self.patterns.append(Pattern(line))
+            self.__compile()
+
+    def __compile(self):
+        def combine(patterns):
+            if not patterns:
+                return None
+            return re.compile('|'.join('(?:' + pattern.regex + ')' for pattern in patterns), re.DOTALL)
+
+        self.__any_matcher = combine(self.patterns)
+        self.__any_file_matcher = combine([pattern for pattern in self.patterns if not pattern.dir_only])
+        self.__has_negated = any(pattern.negated for pattern in self.patterns)
+
+    def is_excluded(self, relative_path, is_dir):
+        """Checks if the patterns exclude relative_path, a path below the location with / separated components"""
+
+        matcher = self.__any_matcher if is_dir else self.__any_file_matcher
+        if matcher is None or matcher.fullmatch(relative_path) is None:
+            return False
+        if not self.__has_negated:
+            return True
+        for pattern in reversed(self.patterns):
+            if pattern.matches(relative_path, is_dir):
+                return not pattern.negated
+        return False
+
+    def get_exclude(self, on_skip=None):
+        """Returns a function for the exclude argument of scan_tree, leaving out what the patterns exclude and the files
+        above the size limits. Files are counted against max-size in the order they are walked, and each call gives a
+        fresh count. on_skip optionally is called with the relative path and the reason of every file left out for
+        its size"""
+
+        total = 0
+
+        def exclude(relative_path, st):
+            nonlocal total
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if self.is_excluded(relative_path, is_dir):
+                return True
+            if not stat.S_ISREG(st.st_mode):
+                return False
+            if self.max_file_size is not None and st.st_size > self.max_file_size:
+                if on_skip is not None:
+                    on_skip(relative_path, 'it is larger than ' + MAX_FILE_SIZE_OPTION)
+                return True
+            if self.max_size is not None and total + st.st_size > self.max_size:
+                if on_skip is not None:
+                    on_skip(relative_path, 'the location would grow larger than ' + MAX_SIZE_OPTION)
+                return True
+            total += st.st_size
+            return False
+
+        return exclude
+
+
+def parse_locations(lines, onerror=None):
+    """Returns (location, LocationRules or None) for every location in the lines of a locations file, the location
+    as written relative to home. Comments and blank lines are skipped.
+    A line which can not be parsed raises ValueError, or is skipped after passing the error to onerror if given"""
+
+    locations = list()
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip('\n')
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if line[0].isspace():
+            try:
+                if not locations:
+                    raise ValueError('it has a rule but no location above it')
+                rules = locations[-1][1] or LocationRules()
+                rules.add_line(stripped)
+                locations[-1] = (locations[-1][0], rules)
+            except (ValueError, re.error) as e:
+                error = ValueError('Line ' + str(line_number) + ' of the locations file: ' + str(e))
+                if onerror is None:
+                    raise error
+                onerror(error)
+        elif len(line) >= 2:
+            locations.append((line, None))
+    return locations
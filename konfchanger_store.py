@@ -0,0 +1,734 @@
+"""
+konfchanger_store - content addressed storage of configuration packs for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import stat
+import json
+import shutil
+import time
+import hashlib
+import tempfile
+from konfchanger_copy import CopyEngine, remove_path
+from konfchanger_walk import scan_tree
+
+OBJECTS_DIR_NAME = '.objects'
+PACK_MANIFEST_FILE_NAME = '.konfchanger_manifest'
+# written into a pack while it is backed up, lists the entries already stored so an interrupted backup can be resumed
+PACK_CHECKPOINT_FILE_NAME = '.konfchanger_checkpoint'
+# seconds between two checkpoints of a running backup
+CHECKPOINT_INTERVAL = 5.0
+# version 1 directory layout packs stored every root under its basename, version 2 ones under its path relative to home
+MANIFEST_VERSION = 2
+LAYOUT_DIRECTORY = 'directory'
+LAYOUT_OBJECTS = 'objects'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """Returns the sha256 hex digest of the file at path"""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_manifest_path(pack_path):
+    return os.path.join(pack_path, PACK_MANIFEST_FILE_NAME)
+
+
+def read_manifest(pack_path):
+    """Returns the manifest of the pack at pack_path or None if the pack does not have one"""
+
+    manifest_path = get_manifest_path(pack_path)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(pack_path, manifest, file_name=PACK_MANIFEST_FILE_NAME):
+    """Atomically writes manifest into the pack at pack_path"""
+
+    fd, tmp_path = tempfile.mkstemp(dir=pack_path, prefix=file_name)
+    try:
+        with os.fdopen(fd, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_path, os.path.join(pack_path, file_name))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_checkpoint(pack_path):
+    """Returns the checkpoint an interrupted backup left in the pack at pack_path or None if there is none"""
+
+    checkpoint_path = os.path.join(pack_path, PACK_CHECKPOINT_FILE_NAME)
+    if not os.path.isfile(checkpoint_path):
+        return None
+    try:
+        with open(checkpoint_path, 'r') as checkpoint_file:
+            return json.load(checkpoint_file)
+    except ValueError:
+        return None
+
+
+def resume_from_checkpoint(pack_path, previous_manifest, layout, parent_name=None):
+    """Returns previous_manifest extended by the entries the checkpoint of an interrupted backup of the same layout
+    and parent recorded as already stored in the pack, so they are not stored again"""
+
+    checkpoint = read_checkpoint(pack_path)
+    if checkpoint is None or checkpoint.get('layout') != layout or checkpoint.get('parent') != parent_name:
+        return previous_manifest
+    if previous_manifest is None:
+        return checkpoint
+    merged = dict(previous_manifest)
+    merged['roots'] = previous_manifest['roots'] + [root for root in checkpoint['roots']
+                                                    if root not in previous_manifest['roots']]
+    merged['entries'] = dict(previous_manifest['entries'])
+    merged['entries'].update(checkpoint['entries'])
+    return merged
+
+
+class Checkpoint:
+    """Writes the entries of a manifest being built whose contents are already stored into the checkpoint file of the
+    pack, at most every CHECKPOINT_INTERVAL seconds. Entries are pending from when they are handed to the copy workers
+    until they are done, and pending entries are left out"""
+
+    def __init__(self, pack_path, manifest, interval=CHECKPOINT_INTERVAL):
+        self.pack_path = pack_path
+        self.manifest = manifest
+        self.interval = interval
+        self.pending = set()
+        self.written_at = time.monotonic()
+
+    def add_pending(self, relative_path):
+        self.pending.add(relative_path)
+
+    def set_done(self, relative_path):
+        self.pending.discard(relative_path)
+        if time.monotonic() - self.written_at >= self.interval:
+            self.write()
+
+    def write(self):
+        checkpoint = dict(self.manifest)
+        checkpoint['entries'] = {relative_path: entry for relative_path, entry in self.manifest['entries'].items()
+                                 if relative_path not in self.pending}
+        write_manifest(self.pack_path, checkpoint, PACK_CHECKPOINT_FILE_NAME)
+        self.written_at = time.monotonic()
+
+    def remove(self):
+        checkpoint_path = os.path.join(self.pack_path, PACK_CHECKPOINT_FILE_NAME)
+        if os.path.lexists(checkpoint_path):
+            os.unlink(checkpoint_path)
+
+
+def new_manifest(layout):
+    return {'version': MANIFEST_VERSION, 'layout': layout, 'host': os.uname().nodename, 'roots': [], 'entries': {}}
+
+
+def make_entry(path, with_hash=False, st=None):
+    """Returns the manifest entry describing path as it currently is on disk, st is its lstat result if already known"""
+
+    st = st or os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return {'type': 'symlink', 'target': os.readlink(path)}
+    if stat.S_ISDIR(st.st_mode):
+        return {'type': 'dir', 'mode': st.st_mode & 0o7777, 'mtime_ns': st.st_mtime_ns}
+    if not stat.S_ISREG(st.st_mode):
+        return {'type': 'special'}
+    entry = {'type': 'file', 'mode': st.st_mode & 0o7777, 'mtime_ns': st.st_mtime_ns,
+             'size': st.st_size, 'ino': st.st_ino}
+    if with_hash:
+        entry['hash'] = hash_file(path)
+    return entry
+
+
+def is_entry_unchanged(old_entry, new_entry):
+    """Checks if the recorded entry still describes the same content, comparing hashes only when both have one"""
+
+    if old_entry is None:
+        return False
+    for key in ('type', 'target', 'mode', 'mtime_ns', 'size', 'ino'):
+        if old_entry.get(key) != new_entry.get(key):
+            return False
+    if 'hash' in new_entry and old_entry.get('hash') != new_entry['hash']:
+        return False
+    return True
+
+
+def get_root_of(relative_path, roots):
+    """Returns the root which relative_path is or lies below, None if there is none.
+    Only the parents of relative_path are looked up, so roots should be a set"""
+
+    path = relative_path
+    while path:
+        if path in roots:
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def get_stored_root(manifest, root):
+    """Returns where, relative to the pack directory, a directory layout pack keeps the root"""
+
+    if manifest is None or manifest.get('version', 1) < 2:
+        return os.path.basename(root)
+    return root
+
+
+def get_pack_entry_path(pack_path, manifest, root, relative_path):
+    """Returns where a directory layout pack stores the entry at relative_path which was backed up from root"""
+
+    stored_root = os.path.join(pack_path, get_stored_root(manifest, root))
+    if relative_path == root:
+        return stored_root
+    return os.path.join(stored_root, os.path.relpath(relative_path, root))
+
+
+def get_entries_by_root(manifest):
+    """Returns the entries of the manifest grouped by the root they were backed up from
+
+    :rtype: dict of root to dict of relative path to entry"""
+
+    roots = set(manifest['roots'])
+    entries_by_root = {root: dict() for root in roots}
+    for relative_path, entry in manifest['entries'].items():
+        root = get_root_of(relative_path, roots)
+        if root is not None:
+            entries_by_root[root][relative_path] = entry
+    return entries_by_root
+
+
+def record_parent(manifest, parent, relative_paths, roots, previous_manifest=None):
+    """Records the composition parent as what the manifest is a delta against: its name as "parent" and its paths
+    below roots which are not among relative_paths as "deleted". The deleted paths previous_manifest has below the
+    other roots of the manifest are kept"""
+
+    deleted = parent.get_deleted(relative_paths, roots)
+    if previous_manifest is not None:
+        roots = set(roots)
+        other_roots = set(manifest['roots']) - roots
+        deleted += [relative_path for relative_path in previous_manifest.get('deleted', list())
+                    if get_root_of(relative_path, other_roots) is not None]
+    manifest['parent'] = parent.name
+    manifest['deleted'] = sorted(deleted)
+
+
+def get_exclude(location_rules, source_path, logger):
+    """Returns the exclude function for scan_tree of the rules of source_path, None if it has none"""
+
+    rules = (location_rules or dict()).get(source_path)
+    if rules is None:
+        return None
+    return rules.get_exclude(lambda relative_path, reason: logger.log(
+        'Skipping ' + os.path.join(source_path, relative_path) + ' as ' + reason))
+
+
+def get_unscanned_path(error, home_path, source_path, read_path=None):
+    """Returns the path relative to home_path which error, raised while scanning source_path from read_path, kept from
+    being looked at: the path the error names or, if it names none below read_path, source_path itself"""
+
+    read_path = read_path or source_path
+    relative_path = os.path.relpath(os.fsdecode(error.filename), read_path) if error.filename is not None else os.pardir
+    if relative_path == os.curdir or relative_path.startswith(os.pardir):
+        return os.path.relpath(source_path, home_path)
+    return os.path.relpath(os.path.join(source_path, relative_path), home_path)
+
+
+def take_over_unscanned(manifest, previous_manifest, unscanned, scanned_paths):
+    """Takes over the entries of previous_manifest for the paths of unscanned, which could not be looked at, and below
+    them unless the scan saw them, so what is still there in the source is neither forgotten nor removed from the pack"""
+
+    if not previous_manifest or not unscanned:
+        return
+    for root in previous_manifest['roots']:
+        if root in unscanned and root not in manifest['roots']:
+            manifest['roots'].append(root)
+    for relative_path, entry in previous_manifest['entries'].items():
+        if relative_path in unscanned or (relative_path not in scanned_paths and
+                                          get_root_of(relative_path, unscanned) is not None):
+            manifest['entries'][relative_path] = entry
+            scanned_paths.add(relative_path)
+
+
+def is_stored_copy(path, entry):
+    """Checks if path still is the copy a directory layout pack made of the file or symlink entry, copies keep the size
+    and modification time of what they were copied from"""
+
+    try:
+        current = make_entry(path)
+    except FileNotFoundError:
+        return False
+    return all(entry.get(key) == current.get(key) for key in ('type', 'target', 'size', 'mtime_ns'))
+
+
+def get_pack_layout(pack_path):
+    manifest = read_manifest(pack_path)
+    if manifest is None:
+        return LAYOUT_DIRECTORY
+    return manifest.get('layout', LAYOUT_DIRECTORY)
+
+
+class PackBackup:
+    """One backup of source paths into a pack, shared by both store layouts. It scans the source paths, hands the
+    entries whose contents have to be stored to the copy workers of the engine, checkpoints what is already stored and
+    keeps what the previous manifest has for whatever could not be looked at or stored. The store decides what has to
+    be stored and how with its hooks:
+    make_backup_entry(read_path, st) returns the manifest entry of a scanned path,
+    get_backup_job(backup, root, relative_path, read_path, st, entry, source_path) returns the job storing an entry
+    as a (read path, pack path or None, st, relative path, source path) tuple, None if it needs none,
+    run_backup_job(backup, job) stores it on a copy worker,
+    keep_failed_entry(backup, relative_path, dest, old_entry) checks if the previous entry of a failed job is still
+    stored and finish_backup(backup) runs once everything is stored, before the manifest is written"""
+
+    def __init__(self, store, layout, source_paths, home_path, pack_path, previous_manifest=None, read_paths=None,
+                 unchanged_roots=None, parent=None, location_rules=None):
+        self.store = store
+        self.logger = store.logger
+        self.engine = store.engine
+        self.action = 'storing' if layout == LAYOUT_OBJECTS else 'copying'
+        self.source_paths = source_paths
+        self.home_path = home_path
+        self.pack_path = pack_path
+        self.manifest = new_manifest(layout)
+        self.parent = parent
+        if parent is not None:
+            self.manifest['parent'] = parent.name
+        self.previous_manifest = resume_from_checkpoint(pack_path, previous_manifest, layout,
+                                                        self.manifest.get('parent'))
+        self.previous_entries = self.previous_manifest['entries'] if self.previous_manifest else dict()
+        self.unchanged_roots = unchanged_roots or set()
+        self.previous_entries_by_root = dict()
+        if self.previous_manifest and self.unchanged_roots:
+            self.previous_entries_by_root = get_entries_by_root(self.previous_manifest)
+        self.read_paths = read_paths or dict()
+        self.location_rules = location_rules
+        self.scanned_roots = list()
+        self.scanned_paths = set()
+        # paths which could not be looked at, what the previous manifest has at or below them is kept
+        self.unscanned = set()
+        self.scanning = None
+        self.error_occurred = False
+        # (source path, pack path, relative path) of the directories created in a directory layout pack
+        self.dirs = list()
+        self.queued = 0
+        self.checkpoint = Checkpoint(pack_path, self.manifest)
+
+    def __report_scan_error(self, error):
+        if isinstance(error, FileNotFoundError):
+            self.logger.log('Skipping ' + str(error.filename) + ' as it disappeared while ' + self.action + ' it')
+            return
+        self.logger.error('Error occurred while ' + self.action + ' to location ' + self.pack_path)
+        self.logger.error(error)
+        self.unscanned.add(get_unscanned_path(error, self.home_path, self.scanning, self.read_paths.get(self.scanning)))
+        self.error_occurred = True
+
+    def __iter_location_jobs(self, source_path, root):
+        if not os.path.lexists(source_path):
+            raise FileNotFoundError(source_path + ' does not exist')
+        self.scanning = source_path
+        self.manifest['roots'].append(root)
+        self.scanned_roots.append(root)
+        exclude = get_exclude(self.location_rules, source_path, self.logger)
+        for path, read_path, st in scan_tree(source_path, self.read_paths.get(source_path), self.__report_scan_error,
+                                             exclude):
+            relative_path = os.path.relpath(path, self.home_path)
+            entry = self.store.make_backup_entry(read_path, st)
+            if entry['type'] == 'special':
+                continue
+            self.scanned_paths.add(relative_path)
+            if self.parent is not None and self.parent.is_inherited(relative_path, entry, read_path):
+                continue
+            self.manifest['entries'][relative_path] = entry
+            job = self.store.get_backup_job(self, root, relative_path, read_path, st, entry, source_path)
+            if job is not None:
+                self.checkpoint.add_pending(relative_path)
+                self.queued += 1
+                yield job
+
+    def __iter_jobs(self):
+        for source_path in self.source_paths:
+            root = os.path.relpath(source_path, self.home_path)
+            if root in self.unchanged_roots and root in self.previous_entries_by_root:
+                self.manifest['roots'].append(root)
+                self.manifest['entries'].update(self.previous_entries_by_root[root])
+                continue
+            try:
+                yield from self.engine.trace_iter(source_path, self.__iter_location_jobs(source_path, root))
+            except Exception as e:
+                self.logger.error('Error occurred while ' + self.action + ' ' + source_path + ' to location ' +
+                                  self.pack_path)
+                self.logger.error('Following error occurred:')
+                self.logger.error(e)
+                if not isinstance(e, FileNotFoundError):
+                    self.unscanned.add(root)
+                self.error_occurred = True
+
+    def run(self):
+        """Stores the source paths into the pack and writes its manifest
+
+        :rtype: bool True if an error occurred"""
+
+        try:
+            failed = self.engine.map(lambda job: self.store.run_backup_job(self, job), self.__iter_jobs(),
+                                     lambda job: job[4], lambda job: self.checkpoint.set_done(job[3]))
+        except KeyboardInterrupt:
+            self.checkpoint.write()
+            raise
+        for (read_path, dest, _, relative_path, _), e in failed:
+            self.logger.error('Error occurred while ' + self.action + ' ' + read_path + ' to location ' +
+                              self.pack_path)
+            self.logger.error(e)
+            old_entry = self.previous_entries.get(relative_path)
+            if old_entry is not None and self.store.keep_failed_entry(self, relative_path, dest, old_entry):
+                self.manifest['entries'][relative_path] = old_entry
+            else:
+                self.manifest['entries'].pop(relative_path, None)
+            self.error_occurred = True
+        take_over_unscanned(self.manifest, self.previous_manifest, self.unscanned, self.scanned_paths)
+        self.store.finish_backup(self)
+        if self.parent is not None:
+            record_parent(self.manifest, self.parent, self.scanned_paths, self.scanned_roots, self.previous_manifest)
+        write_manifest(self.pack_path, self.manifest)
+        self.checkpoint.remove()
+        return self.error_occurred
+
+
+class ObjectStore:
+    """Stores file contents once by their hash under store_dir/.objects, packs only keep a manifest pointing at them"""
+
+    def __init__(self, store_dir, logger, engine=None):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, OBJECTS_DIR_NAME)
+        self.logger = logger
+        self.engine = engine or CopyEngine(logger=logger)
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def put_file(self, path):
+        """Adds the contents of the file at path to the store if not already present and returns its digest.
+        The file is hashed first, so contents already stored are not copied again, but a new object is named after
+        the hash of the bytes actually copied into it, as the file may change in between"""
+
+        digest = hash_file(path)
+        if os.path.exists(self.get_object_path(digest)):
+            self.logger.log('Object already stored for ' + path)
+            return digest
+        with open(path, 'rb') as src:
+            digest = self.put_stream(src)
+        self.engine.stats.add_copied(os.path.getsize(self.get_object_path(digest)))
+        return digest
+
+    def backup(self, source_paths, home_path, pack_path, previous_manifest=None, read_paths=None,
+               unchanged_roots=None, parent=None, location_rules=None):
+        """Stores every source path into the object store and writes the pack manifest.
+        Files whose stat still matches previous_manifest reuse their recorded object instead of being hashed again.
+        read_paths optionally maps a source path to the location its contents should be read from.
+        The entries of unchanged_roots, roots known not to have changed since previous_manifest,
+        are taken over from it without looking at them again.
+        If parent, a Composition of the parent pack, is given only the files and symlinks which differ from it are stored,
+        INI files only by the keys which differ.
+        location_rules optionally maps a source path to the LocationRules deciding what below it is left out
+
+        :rtype: bool True if an error occurred"""
+
+        return PackBackup(self, LAYOUT_OBJECTS, source_paths, home_path, pack_path, previous_manifest, read_paths,
+                          unchanged_roots, parent, location_rules).run()
+
+    def make_backup_entry(self, read_path, st):
+        return make_entry(read_path, st=st)
+
+    def get_backup_job(self, backup, root, relative_path, read_path, st, entry, source_path):
+        """Returns the job storing the contents of the file entry as an object, None if they need not be stored"""
+
+        if entry['type'] != 'file':
+            return None
+        patch = backup.parent.get_patch(relative_path, entry, read_path) if backup.parent is not None else None
+        if patch is not None:
+            entry['patch'] = patch
+            return None
+        old_entry = backup.previous_entries.get(relative_path)
+        if is_entry_unchanged(old_entry, entry) and 'hash' in old_entry and \
+                os.path.exists(self.get_object_path(old_entry['hash'])):
+            entry['hash'] = old_entry['hash']
+            return None
+        return read_path, None, st, relative_path, source_path
+
+    def run_backup_job(self, backup, job):
+        read_path, _, _, relative_path, _ = job
+        entry = backup.manifest['entries'][relative_path]
+        entry['hash'] = self.put_file(read_path)
+        # the file may have changed since it was scanned, the object is what gets applied
+        entry['size'] = os.path.getsize(self.get_object_path(entry['hash']))
+
+    def keep_failed_entry(self, backup, relative_path, dest, old_entry):
+        """Checks if old_entry, what the previous manifest has for a file which could not be stored, is still stored"""
+
+        if 'patch' in old_entry or ('hash' in old_entry and os.path.exists(self.get_object_path(old_entry['hash']))):
+            self.logger.log('Keeping what was stored for ' + relative_path + ' before')
+            return True
+        return False
+
+    def finish_backup(self, backup):
+        # objects no manifest points at anymore are only removed by gc
+        pass
+
+    def put_stream(self, stream):
+        """Adds the contents read from the binary stream to the store if not already present and returns its digest"""
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as dst:
+                for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            object_path = self.get_object_path(digest.hexdigest())
+            if os.path.exists(object_path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest.hexdigest()
+
+    def __is_restored(self, entry, dest):
+        """Checks if dest already holds the contents of the file entry, comparing its hash only if size matches but mtime doesn't"""
+
+        try:
+            st = os.lstat(dest)
+        except FileNotFoundError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or st.st_size != entry['size']:
+            return False
+        return st.st_mtime_ns == entry['mtime_ns'] or hash_file(dest) == entry['hash']
+
+    def __restore_file(self, entry, dest):
+        if self.__is_restored(entry, dest):
+            self.engine.stats.add_skipped(entry['size'])
+            return
+        dest_dir = os.path.dirname(dest)
+        fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.' + os.path.basename(dest))
+        os.close(fd)
+        try:
+            self.engine.copy_file(self.get_object_path(entry['hash']), tmp_path)
+            os.chmod(tmp_path, entry['mode'])
+            os.utime(tmp_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                raise IsADirectoryError(dest + ' is a directory')
+            self.engine.record_previous(dest)
+            os.replace(tmp_path, dest)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def apply(self, pack_path, home_path, roots):
+        """Writes the entries of the pack below the given roots back into home_path
+
+        :rtype: bool True if an error occurred"""
+
+        manifest = read_manifest(pack_path)
+        entries = manifest['entries']
+        wanted_roots = set(roots)
+        for root in manifest['roots']:
+            if root not in wanted_roots:
+                self.logger.log('could not find associated path to apply ' + root)
+                self.logger.log('So skipping applying this config!!')
+        any_error = False
+        dirs = list()
+
+        def iter_jobs():
+            nonlocal any_error
+            for relative_path in sorted(entries):
+                root = get_root_of(relative_path, wanted_roots)
+                if root is None:
+                    continue
+                entry = entries[relative_path]
+                dest = os.path.join(home_path, relative_path)
+                location = os.path.join(home_path, root)
+                self.logger.log('Applying ' + relative_path + ' to ' + dest)
+                try:
+                    with self.engine.trace_location(location):
+                        os.makedirs(os.path.dirname(dest), exist_ok=True)
+                        if entry['type'] == 'dir':
+                            if not os.path.isdir(dest) or os.path.islink(dest):
+                                self.engine.record_previous(dest)
+                            if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+                                remove_path(dest)
+                            os.makedirs(dest, exist_ok=True)
+                            dirs.append((dest, entry))
+                            continue
+                        if entry['type'] == 'symlink':
+                            if os.path.islink(dest) and os.readlink(dest) == entry['target']:
+                                continue
+                            self.engine.record_previous(dest)
+                            if os.path.lexists(dest):
+                                remove_path(dest)
+                            os.symlink(entry['target'], dest)
+                            continue
+                except Exception as e:
+                    any_error = True
+                    self.logger.error('Error while restoring ' + relative_path + ' into ' + dest)
+                    self.logger.error(e)
+                    continue
+                yield entry, dest, location
+
+        for (entry, dest, _), e in self.engine.map(lambda job: self.__restore_file(job[0], job[1]), iter_jobs(),
+                                                   lambda job: job[2]):
+            any_error = True
+            self.logger.error('Error while restoring ' + dest)
+            self.logger.error(e)
+        for dest, entry in reversed(dirs):
+            os.chmod(dest, entry['mode'])
+            os.utime(dest, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return any_error
+
+    def get_referenced_digests(self):
+        """Returns the set of digests referenced by any pack manifest in the store"""
+
+        digests = set()
+        for name in os.listdir(self.store_dir):
+            pack_path = os.path.join(self.store_dir, name)
+            if name.startswith('.') or not os.path.isdir(pack_path):
+                continue
+            manifest = read_manifest(pack_path)
+            if manifest is None or manifest.get('layout') != LAYOUT_OBJECTS:
+                continue
+            for entry in manifest['entries'].values():
+                if 'hash' in entry:
+                    digests.add(entry['hash'])
+        return digests
+
+    def remove_unreferenced_objects(self):
+        """Deletes objects no pack manifest points at anymore and returns how many were removed"""
+
+        if not os.path.isdir(self.objects_dir):
+            return 0
+        referenced = self.get_referenced_digests()
+        removed = 0
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for rest in os.listdir(prefix_dir):
+                if prefix + rest not in referenced:
+                    os.unlink(os.path.join(prefix_dir, rest))
+                    removed += 1
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+        self.logger.log('Removed ' + str(removed) + ' unreferenced objects from store')
+        return removed
+
+
+class DirectoryStore:
+    """Stores packs as plain copies of the configurations, keeping a manifest to only re-copy what changed"""
+
+    def __init__(self, logger, compare_hash=False, engine=None):
+        self.logger = logger
+        self.compare_hash = compare_hash
+        self.engine = engine or CopyEngine(logger=logger)
+
+    def backup(self, source_paths, home_path, pack_path, previous_manifest=None, read_paths=None,
+               unchanged_roots=None, parent=None, location_rules=None):
+        """Copies the source paths into pack_path, skipping entries unchanged since previous_manifest
+        and removing the ones which disappeared.
+        read_paths optionally maps a source path to the location its contents should be read from.
+        The entries of unchanged_roots, roots known not to have changed since previous_manifest,
+        are taken over from it without looking at them again.
+        If parent, a Composition of the parent pack, is given only the files and symlinks which differ from it are stored,
+        INI files only by the keys which differ.
+        location_rules optionally maps a source path to the LocationRules deciding what below it is left out
+
+        :rtype: bool True if an error occurred"""
+
+        return PackBackup(self, LAYOUT_DIRECTORY, source_paths, home_path, pack_path, previous_manifest, read_paths,
+                          unchanged_roots, parent, location_rules).run()
+
+    def make_backup_entry(self, read_path, st):
+        return make_entry(read_path, self.compare_hash, st)
+
+    def get_backup_job(self, backup, root, relative_path, read_path, st, entry, source_path):
+        """Creates the directory of a dir entry in the pack and returns the job copying any other entry into it,
+        None if its copy in the pack is still up to date"""
+
+        dest = get_pack_entry_path(backup.pack_path, backup.manifest, root, relative_path)
+        if relative_path == root:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if entry['type'] == 'dir':
+            if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+                remove_path(dest)
+            os.makedirs(dest, exist_ok=True)
+            backup.dirs.append((read_path, dest, relative_path))
+            return None
+        patch = None
+        if backup.parent is not None and entry['type'] == 'file':
+            patch = backup.parent.get_patch(relative_path, entry, read_path)
+        old_entry = backup.previous_entries.get(relative_path)
+        if patch is not None:
+            entry['patch'] = patch
+            if os.path.lexists(dest):
+                remove_path(dest)
+        elif is_entry_unchanged(old_entry, entry) and os.path.lexists(dest):
+            if 'hash' in old_entry:
+                entry['hash'] = old_entry['hash']
+        else:
+            return read_path, dest, st, relative_path, source_path
+        return None
+
+    def run_backup_job(self, backup, job):
+        read_path, dest, st, relative_path, _ = job
+        entry = backup.manifest['entries'][relative_path]
+        if entry['type'] == 'file' and 'hash' not in entry:
+            # recorded for verify, read before copying so a file changing meanwhile does not pass unnoticed
+            entry['hash'] = hash_file(read_path)
+        self.engine.copy_entry(read_path, dest, st=st)
+
+    def keep_failed_entry(self, backup, relative_path, dest, old_entry):
+        """Checks if old_entry, what the previous manifest has for an entry which could not be copied to dest, is
+        still stored, removing what the failed copy left behind where the entry is not stored as a copy"""
+
+        if 'patch' in old_entry:
+            # nothing was stored for it, only what the copy left behind has to go
+            self.logger.log('Keeping what was stored for ' + relative_path + ' before')
+            if os.path.lexists(dest):
+                remove_path(dest)
+            return True
+        if old_entry['type'] != 'dir' and is_stored_copy(dest, old_entry):
+            self.logger.log('Keeping the previous copy of ' + relative_path)
+            return True
+        return False
+
+    def finish_backup(self, backup):
+        """Removes the entries which disappeared since the previous manifest from the pack and gives its directories
+        the metadata of their sources"""
+
+        removed = 0
+        previous_manifest = backup.previous_manifest
+        previous_roots = set(previous_manifest['roots']) if previous_manifest else set()
+        for relative_path in sorted(backup.previous_entries, reverse=True):
+            if relative_path in backup.manifest['entries']:
+                continue
+            root = get_root_of(relative_path, previous_roots)
+            dest = get_pack_entry_path(backup.pack_path, previous_manifest, root, relative_path)
+            if os.path.lexists(dest):
+                self.logger.log('Removing ' + dest + ' as it does not exist anymore')
+                remove_path(dest)
+                removed += 1
+        for path, dest, relative_path in reversed(backup.dirs):
+            if relative_path not in backup.unscanned:
+                shutil.copystat(path, dest, follow_symlinks=False)
+        self.logger.log('Copied ' + str(backup.queued) + ' and removed ' + str(removed) + ' entries')
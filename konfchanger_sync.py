@@ -0,0 +1,407 @@
+"""
+konfchanger_sync - delta transfer of configuration packs between two stores for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+Changed files are transferred the way rsync does it. The receiving side splits its current version of a file, the basis,
+into blocks and sends a signature of them: a weak rolling checksum and a strong hash per block. The sending side looks
+up every block of the new version by its strong hash where the last match ended, and only where that fails slides a
+window over it, rolling the weak checksum one byte at a time to find blocks moved by inserted or removed bytes. It
+answers with a delta: references to basis blocks it found again and the literal bytes in between. The receiver
+rebuilds the file from its basis and the delta and checks the result against the hash of the whole file. The other
+store is a path in the local filesystem, so both sides run in this process, but only the signature and the delta would
+have to cross the network. Where nothing crosses one, when both stores are on the same filesystem, and for files too
+big to be worth it, files are copied whole instead.
+
+A pack is received into a staging directory next to it, which starts out as hard links to its previous version, and is
+only renamed into place once everything arrived. An interrupted transfer leaves the previous version untouched, and
+the staging directory is picked up again by the next one.
+"""
+import os
+import stat
+import mmap
+import shutil
+import hashlib
+import tempfile
+import itertools
+import threading
+from konfchanger_copy import copy_file, copy_metadata, remove_path
+from konfchanger_store import LAYOUT_OBJECTS, PACK_MANIFEST_FILE_NAME, ObjectStore, read_manifest
+from konfchanger_trash import move_to_trash
+
+# files smaller than this are sent whole, their signature would not be much smaller than they are
+DELTA_MIN_SIZE = 8 * 1024
+# files bigger than this are sent whole, reading them whole on both sides costs more than sending them does
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+# bytes of a file the weak checksum is rolled over at most, the blocks of the rest are only compared where they are
+DELTA_ROLL_LIMIT = 64 * 1024
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 128 * 1024
+STRONG_CHECKSUM_SIZE = 16
+# bytes a signature takes per block: the weak checksum and the strong one
+SIGNATURE_BLOCK_SIZE = 4 + STRONG_CHECKSUM_SIZE
+# bytes a delta takes per reference to a block of the basis: offset and length
+DELTA_COPY_SIZE = 12
+READ_SIZE = 1024 * 1024
+# a pack is received into store_dir/.<name>.sync before it replaces the previous version
+STAGING_SUFFIX = '.sync'
+
+
+class SyncStats:
+    """Thread safe counters of what a synchronization sent"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.files_sent = 0
+        self.files_patched = 0
+        self.bytes_sent = 0
+        self.bytes_matched = 0
+        self.entries_removed = 0
+
+    def add_sent(self, size):
+        with self.__lock:
+            self.files_sent += 1
+            self.bytes_sent += size
+
+    def add_patched(self, sent, matched):
+        with self.__lock:
+            self.files_patched += 1
+            self.bytes_sent += sent
+            self.bytes_matched += matched
+
+    def add_removed(self):
+        with self.__lock:
+            self.entries_removed += 1
+
+
+def list_packs(store_dir):
+    return sorted(name for name in os.listdir(store_dir)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(store_dir, name)))
+
+
+def get_block_size(size):
+    """Returns the block size for a basis of size bytes: about its square root like rsync, so the signature and the
+    work of finding blocks again both grow slowly with the file"""
+
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, int(size ** 0.5) // 8 * 8))
+
+
+def weak_checksum(block):
+    """Returns the two 16 bit halves of the rolling checksum of block: the sum of its bytes, and the sum of every
+    byte weighted by its distance from the end of the block"""
+
+    return sum(block) & 0xffff, sum(itertools.accumulate(block)) & 0xffff
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=STRONG_CHECKSUM_SIZE).digest()
+
+
+def make_signature(basis_path, block_size):
+    """Returns the signature of the file at basis_path: the block size, a dict of the weak checksum of every full block
+    to a dict of its strong checksum to its offset, and (offset, length, strong checksum) of the last block if it is
+    shorter than the others, None otherwise"""
+
+    blocks = dict()
+    tail = None
+    offset = 0
+    with open(basis_path, 'rb') as basis:
+        for block in iter(lambda: basis.read(block_size), b''):
+            if len(block) < block_size:
+                tail = (offset, len(block), strong_checksum(block))
+            else:
+                a, b = weak_checksum(block)
+                blocks.setdefault((b << 16) | a, dict()).setdefault(strong_checksum(block), offset)
+            offset += len(block)
+    return block_size, blocks, tail
+
+
+def get_signature_size(signature):
+    _, blocks, tail = signature
+    count = sum(len(strong_checksums) for strong_checksums in blocks.values()) + (tail is not None)
+    return count * SIGNATURE_BLOCK_SIZE
+
+
+def compute_delta(source_path, signature, roll_limit=DELTA_ROLL_LIMIT):
+    """Compares the file at source_path with the basis the signature was made of. Where a block of the source is not
+    found by its strong checksum, the weak one is rolled byte by byte over the next block size bytes to find one, for
+    at most roll_limit bytes of the source in total. Past that, blocks which do not match where they are are sent
+
+    :rtype: (sha256 hex digest of the source, list of (offset, length) tuples copying a range of the basis and
+             bytes objects to insert, in the order they rebuild the source)"""
+
+    block_size, blocks, tail = signature
+    offsets = {strong: offset for strong_checksums in blocks.values() for strong, offset in strong_checksums.items()}
+    delta = list()
+
+    def add_copy(offset, length):
+        if delta and isinstance(delta[-1], tuple) and sum(delta[-1]) == offset:
+            delta[-1] = (delta[-1][0], delta[-1][1] + length)
+        else:
+            delta.append((offset, length))
+
+    with open(source_path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        if size == 0:
+            return hashlib.sha256().hexdigest(), delta
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            digest = hashlib.sha256(data).hexdigest()
+            position = 0
+            literal_start = 0
+            rolled = 0
+            while position + block_size <= size:
+                offset = offsets.get(strong_checksum(data[position:position + block_size]))
+                if offset is None:
+                    end = min(position + block_size, size - block_size + 1)
+                    if rolled >= roll_limit:
+                        position = end
+                        continue
+                    start = position
+                    a, b = weak_checksum(data[position:position + block_size])
+                    position += 1
+                    while position < end:
+                        removed = data[position - 1]
+                        a = (a - removed + data[position + block_size - 1]) & 0xffff
+                        b = (b - block_size * removed + a) & 0xffff
+                        strong_checksums = blocks.get((b << 16) | a)
+                        if strong_checksums is not None:
+                            offset = strong_checksums.get(strong_checksum(data[position:position + block_size]))
+                            if offset is not None:
+                                break
+                        position += 1
+                    rolled += position - start
+                    if offset is None:
+                        continue
+                if literal_start < position:
+                    delta.append(data[literal_start:position])
+                add_copy(offset, block_size)
+                position += block_size
+                literal_start = position
+            rest = data[position:size]
+            if tail is not None and len(rest) == tail[1] and strong_checksum(rest) == tail[2]:
+                if literal_start < position:
+                    delta.append(data[literal_start:position])
+                add_copy(tail[0], tail[1])
+            elif literal_start < size:
+                delta.append(data[literal_start:size])
+    return digest, delta
+
+
+def apply_delta(basis_path, delta, dest_path):
+    """Writes the file rebuilt from the basis and the delta to dest_path
+
+    :rtype: str sha256 hex digest of what was written"""
+
+    digest = hashlib.sha256()
+    with open(basis_path, 'rb') as basis, open(dest_path, 'wb') as dest:
+        for instruction in delta:
+            if isinstance(instruction, tuple):
+                offset, length = instruction
+                basis.seek(offset)
+                while length > 0:
+                    chunk = basis.read(min(length, READ_SIZE))
+                    if not chunk:
+                        raise EOFError(basis_path + ' is shorter than its signature')
+                    digest.update(chunk)
+                    dest.write(chunk)
+                    length -= len(chunk)
+            else:
+                digest.update(instruction)
+                dest.write(instruction)
+    return digest.hexdigest()
+
+
+def transfer_file(source, dest, engine, stats, logger, basis=None):
+    """Makes dest a copy of the regular file source, with its metadata. If an older version of the file, the basis,
+    exists at the receiving side, which defaults to dest itself, only the differences are sent, unless the file is
+    copied whole anyway as both sides are on the same filesystem or it is bigger than DELTA_MAX_SIZE"""
+
+    st = os.lstat(source)
+    basis = basis or dest
+    try:
+        basis_st = os.lstat(basis)
+    except FileNotFoundError:
+        basis_st = None
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+    os.close(fd)
+    try:
+        if basis_st is not None and stat.S_ISREG(basis_st.st_mode) and basis_st.st_dev != st.st_dev and \
+                DELTA_MIN_SIZE <= min(st.st_size, basis_st.st_size) and st.st_size <= DELTA_MAX_SIZE:
+            signature = make_signature(basis, get_block_size(basis_st.st_size))
+            digest, delta = compute_delta(source, signature)
+            if apply_delta(basis, delta, tmp_path) == digest:
+                copy_metadata(source, tmp_path, st)
+                os.replace(tmp_path, dest)
+                literal = sum(len(instruction) for instruction in delta if not isinstance(instruction, tuple))
+                copied = sum(1 for instruction in delta if isinstance(instruction, tuple))
+                stats.add_patched(get_signature_size(signature) + literal + copied * DELTA_COPY_SIZE,
+                                  st.st_size - literal)
+                engine.stats.add_copied(st.st_size)
+                logger.log('Sent ' + str(literal) + ' of ' + str(st.st_size) + ' bytes of ' + source)
+                return
+            logger.log('Rebuilt ' + dest + ' does not match ' + source + ', sending it whole')
+        engine.copy_file(source, tmp_path)
+        os.replace(tmp_path, dest)
+        stats.add_sent(st.st_size)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def is_transfer_needed(source, dest):
+    """Checks if dest differs from the regular file source by type, size or modification time, like rsync's quick check"""
+
+    try:
+        dest_st = os.lstat(dest)
+    except FileNotFoundError:
+        return True
+    source_st = os.lstat(source)
+    return not stat.S_ISREG(dest_st.st_mode) or source_st.st_size != dest_st.st_size or \
+        source_st.st_mtime_ns != dest_st.st_mtime_ns
+
+
+def link_tree(source_dir, dest_dir, engine):
+    """Recreates the directories of source_dir in dest_dir and hard links its files and symlinks into them, copying
+    them where the filesystem does not support hard links"""
+
+    for root, dir_names, file_names in os.walk(source_dir):
+        dest_root = os.path.join(dest_dir, os.path.relpath(root, source_dir))
+        os.makedirs(dest_root, exist_ok=True)
+        for name in dir_names + file_names:
+            source = os.path.join(root, name)
+            dest = os.path.join(dest_root, name)
+            st = os.lstat(source)
+            if stat.S_ISDIR(st.st_mode) or not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                continue
+            try:
+                os.link(source, dest, follow_symlinks=False)
+            except OSError:
+                if stat.S_ISLNK(st.st_mode):
+                    engine.copy_symlink(source, dest)
+                else:
+                    copy_file(source, dest)
+
+
+def mirror_tree(source_dir, dest_dir, engine, stats, logger, last_name=None):
+    """Makes dest_dir identical to source_dir, transferring only the files which changed and removing what is not in
+    source_dir. The file last_name directly inside source_dir is only transferred if everything else was
+
+    :rtype: list of (source path, error) of the files which could not be transferred"""
+
+    if os.path.lexists(dest_dir) and (os.path.islink(dest_dir) or not os.path.isdir(dest_dir)):
+        remove_path(dest_dir)
+    os.makedirs(dest_dir, exist_ok=True)
+    dirs = list()
+    to_transfer = list()
+    last = None
+    for root, dir_names, file_names in os.walk(source_dir):
+        dest_root = os.path.join(dest_dir, os.path.relpath(root, source_dir))
+        names = set(dir_names + file_names)
+        for name in os.listdir(dest_root):
+            if name not in names:
+                logger.log('Removing ' + os.path.join(dest_root, name) + ' as it does not exist anymore')
+                remove_path(os.path.join(dest_root, name))
+                stats.add_removed()
+        dirs.append((root, dest_root))
+        for name in sorted(names):
+            source = os.path.join(root, name)
+            dest = os.path.join(dest_root, name)
+            st = os.lstat(source)
+            if stat.S_ISLNK(st.st_mode):
+                if not (os.path.islink(dest) and os.readlink(dest) == os.readlink(source)):
+                    engine.copy_symlink(source, dest)
+            elif stat.S_ISDIR(st.st_mode):
+                if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+                    remove_path(dest)
+                os.makedirs(dest, exist_ok=True)
+            elif not stat.S_ISREG(st.st_mode):
+                continue
+            elif not is_transfer_needed(source, dest):
+                engine.stats.add_skipped(st.st_size)
+            elif os.path.isdir(dest) and not os.path.islink(dest):
+                remove_path(dest)
+                to_transfer.append((source, dest))
+            elif root == source_dir and name == last_name:
+                last = (source, dest)
+            else:
+                to_transfer.append((source, dest))
+    failed = engine.map(lambda job: transfer_file(job[0], job[1], engine, stats, logger), to_transfer,
+                        lambda job: source_dir)
+    if last is not None and not failed:
+        transfer_file(last[0], last[1], engine, stats, logger)
+    for root, dest_root in reversed(dirs):
+        shutil.copystat(root, dest_root, follow_symlinks=False)
+    return [(source, error) for (source, _), error in failed]
+
+
+def sync_objects(source_store, dest_store, manifest, dest_manifest, pack_path, engine, stats, logger):
+    """Transfers the objects of an objects layout pack missing from dest_store. The object a file had in the
+    previous version of the pack in dest_store is used as the basis of its new one
+
+    :rtype: list of (source object path, error) of the objects which could not be transferred"""
+
+    source_objects = ObjectStore(source_store, logger, engine)
+    dest_objects = ObjectStore(dest_store, logger, engine)
+    previous_digests = dict()
+    if dest_manifest is not None and dest_manifest.get('layout') == LAYOUT_OBJECTS:
+        previous_digests = {relative_path: entry['hash'] for relative_path, entry in dest_manifest['entries'].items()
+                            if 'hash' in entry}
+    to_transfer = dict()
+    for relative_path, entry in manifest['entries'].items():
+        # INI files stored as key changes have no object, their changes are in the manifest
+        if 'hash' not in entry or entry['hash'] in to_transfer:
+            continue
+        dest = dest_objects.get_object_path(entry['hash'])
+        if os.path.exists(dest):
+            engine.stats.add_skipped(entry['size'])
+            continue
+        basis = None
+        if relative_path in previous_digests:
+            basis = dest_objects.get_object_path(previous_digests[relative_path])
+        to_transfer[entry['hash']] = (source_objects.get_object_path(entry['hash']), dest, basis)
+
+    def transfer_object(job):
+        source, dest, basis = job
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        transfer_file(source, dest, engine, stats, logger, basis)
+
+    failed = engine.map(transfer_object, to_transfer.values(), lambda job: pack_path)
+    return [(source, error) for (source, _, _), error in failed]
+
+
+def sync_pack(source_store, dest_store, name, engine, stats, logger):
+    """Makes the pack name in dest_store identical to the one in source_store. The objects of an objects layout pack
+    are transferred first, then the pack itself is mirrored into a staging directory and renamed into place only if
+    everything was transferred, so an interrupted transfer leaves the previous version of the pack as it was.
+    The previous version is moved into the trash of dest_store
+
+    :rtype: bool True if an error occurred"""
+
+    source_pack = os.path.join(source_store, name)
+    dest_pack = os.path.join(dest_store, name)
+    staging_pack = os.path.join(dest_store, '.' + name + STAGING_SUFFIX)
+    manifest = read_manifest(source_pack)
+    failed = list()
+    with engine.trace_location(source_pack):
+        if manifest is not None and manifest.get('layout') == LAYOUT_OBJECTS:
+            failed = sync_objects(source_store, dest_store, manifest, read_manifest(dest_pack), source_pack, engine,
+                                  stats, logger)
+        if not failed:
+            if not os.path.lexists(staging_pack) and os.path.isdir(dest_pack) and not os.path.islink(dest_pack):
+                link_tree(dest_pack, staging_pack, engine)
+            failed = mirror_tree(source_pack, staging_pack, engine, stats, logger, PACK_MANIFEST_FILE_NAME)
+        if not failed:
+            if os.path.lexists(dest_pack):
+                trashed_path = move_to_trash(dest_store, dest_pack)
+                logger.log('Moved the previous version of ' + dest_pack + ' to ' + trashed_path)
+            os.rename(staging_pack, dest_pack)
+    for source, error in failed:
+        logger.error('Error occurred while sending ' + source + ' to ' + dest_store)
+        logger.error(error)
+    return bool(failed)
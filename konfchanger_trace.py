@@ -0,0 +1,171 @@
+"""
+konfchanger_trace - per location timings and I/O counters of konfchanger's operations
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+NO_LOCATION = '-'
+
+
+class LocationRecord:
+    """Counters of one location within one operation"""
+
+    def __init__(self, operation, location):
+        self.operation = operation
+        self.location = location
+        self.seconds = 0.0
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        self.failed = 0
+        self.errors = dict()
+
+    def to_dict(self):
+        return {
+            'operation': self.operation,
+            'location': self.location,
+            'seconds': self.seconds,
+            'files_copied': self.files_copied,
+            'bytes_copied': self.bytes_copied,
+            'files_skipped': self.files_skipped,
+            'bytes_skipped': self.bytes_skipped,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+
+class Tracer:
+    """Records, per operation and per location, the time spent and the files copied, skipped and failed.
+
+    The location a file belongs to is tracked per thread, so copies done by the worker threads of a CopyEngine are
+    attributed to the location they were started for. The time of a location is the sum of the time spent on it by
+    every thread, so it shows which locations dominate an operation even when they are copied in parallel."""
+
+    def __init__(self, home_path):
+        self.home_path = home_path
+        self.started_at = time.time()
+        self.operation = None
+        self.operations = list()
+        self.failures = list()
+        self.__records = dict()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def get_location_name(self, path):
+        """Returns path relative to home if it lies in home, path otherwise"""
+
+        if os.path.isabs(path):
+            relative_path = os.path.relpath(path, self.home_path)
+            if not relative_path.startswith('..'):
+                return relative_path
+        return path
+
+    def __get_record(self, location):
+        key = (self.operation, location)
+        record = self.__records.get(key)
+        if record is None:
+            record = self.__records[key] = LocationRecord(self.operation, location)
+        return record
+
+    def __get_current_location(self):
+        return getattr(self.__local, 'location', NO_LOCATION)
+
+    @contextlib.contextmanager
+    def trace_operation(self, operation):
+        """Attributes everything recorded inside the block to operation and records its wall time"""
+
+        previous_operation = self.operation
+        self.operation = operation
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.operations.append({'operation': operation, 'seconds': time.perf_counter() - start})
+            self.operation = previous_operation
+
+    @contextlib.contextmanager
+    def trace_location(self, path):
+        """Attributes everything the current thread records inside the block to the location of path,
+        adding the time spent to it and recording an exception escaping the block as a failure"""
+
+        location = self.get_location_name(path)
+        previous_location = self.__get_current_location()
+        self.__local.location = location
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.add_failed(path, e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.__local.location = previous_location
+            with self.__lock:
+                self.__get_record(location).seconds += elapsed
+
+    def add_copied(self, size):
+        with self.__lock:
+            record = self.__get_record(self.__get_current_location())
+            record.files_copied += 1
+            record.bytes_copied += size
+
+    def add_skipped(self, size):
+        with self.__lock:
+            record = self.__get_record(self.__get_current_location())
+            record.files_skipped += 1
+            record.bytes_skipped += size
+
+    def add_failed(self, path, error):
+        category = type(error).__name__
+        with self.__lock:
+            record = self.__get_record(self.__get_current_location())
+            record.failed += 1
+            record.errors[category] = record.errors.get(category, 0) + 1
+            self.failures.append({'operation': self.operation, 'location': record.location, 'path': path,
+                                  'error': category, 'message': str(error)})
+
+    def get_records(self):
+        """Returns the location records, in the order of their operations and the slowest location first"""
+
+        order = {operation['operation']: i for i, operation in reversed(list(enumerate(self.operations)))}
+        with self.__lock:
+            records = list(self.__records.values())
+        return sorted(records, key=lambda record: (order.get(record.operation, len(order)), -record.seconds))
+
+    def echo_summary(self, echo):
+        """Prints a table of the location records and the wall time of every operation"""
+
+        echo('{:<18} {:<40} {:>10} {:>8} {:>12} {:>8} {:>12} {:>7}'.format(
+            'OPERATION', 'LOCATION', 'TIME (ms)', 'COPIED', 'BYTES', 'SKIPPED', 'BYTES', 'FAILED'))
+        for record in self.get_records():
+            echo('{:<18} {:<40} {:>10.1f} {:>8} {:>12} {:>8} {:>12} {:>7}'.format(
+                str(record.operation), record.location, record.seconds * 1000, record.files_copied,
+                record.bytes_copied, record.files_skipped, record.bytes_skipped, record.failed))
+        for operation in self.operations:
+            echo('{} took {:.1f} ms'.format(operation['operation'], operation['seconds'] * 1000))
+
+    def write_json(self, trace_path, command=None):
+        """Writes the operations, location records and failures as JSON to trace_path"""
+
+        trace = {
+            'command': command,
+            'home': self.home_path,
+            'started_at': self.started_at,
+            'seconds': time.time() - self.started_at,
+            'operations': self.operations,
+            'locations': [record.to_dict() for record in self.get_records()],
+            'failures': self.failures,
+        }
+        with open(trace_path, 'w') as trace_file:
+            json.dump(trace, trace_file, indent=2)
@@ -0,0 +1,147 @@
+"""
+konfchanger_trash - instant deletion of configuration packs by moving them into a trash emptied in the background
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+A deleted pack is renamed into store_dir/.trash, which is instant as it stays on the same filesystem. Whatever is in
+the trash is removed by whoever holds the lock on the trash next: the detached process started after a deletion or the
+gc command. The lock is released by the kernel when its holder dies, so a reclaimer which crashed or was killed
+leaves the rest of the trash to the next one.
+"""
+import os
+import time
+import fcntl
+import platform
+
+TRASH_DIR_NAME = '.trash'
+TRASH_LOCK_FILE_NAME = '.lock'
+# the background reclaimer pauses after removing this many entries, so it does not hog the disk
+THROTTLE_BATCH_SIZE = 256
+THROTTLE_PAUSE = 0.02
+# ioprio_set syscall numbers by machine, used to put the background reclaimer into the idle I/O class
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def get_trash_dir(store_dir):
+    return os.path.join(store_dir, TRASH_DIR_NAME)
+
+
+def move_to_trash(store_dir, path):
+    """Renames path into the trash of the store and returns its new path"""
+
+    trash_dir = get_trash_dir(store_dir)
+    os.makedirs(trash_dir, exist_ok=True)
+    trashed_path = os.path.join(trash_dir, os.path.basename(path) + '.' + str(time.time_ns()))
+    os.rename(path, trashed_path)
+    return trashed_path
+
+
+def is_trash_empty(store_dir):
+    trash_dir = get_trash_dir(store_dir)
+    return not os.path.isdir(trash_dir) or os.listdir(trash_dir) in ([], [TRASH_LOCK_FILE_NAME])
+
+
+def lower_priority():
+    """Makes the current process the last one to get CPU and disk time, where the platform allows it"""
+
+    os.nice(19)
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall_number is None:
+        return
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+
+
+def remove_tree(path, throttle=False):
+    """Removes path and everything below it, carrying on past entries which can not be removed
+
+    :rtype: (entries removed, bytes freed, entries which could not be removed)"""
+
+    removed = 0
+    freed = 0
+    failed = 0
+
+    def remove(function, entry_path):
+        nonlocal removed, freed, failed
+        try:
+            size = os.lstat(entry_path).st_size
+            function(entry_path)
+        except OSError:
+            failed += 1
+            return
+        removed += 1
+        freed += size
+        if throttle and removed % THROTTLE_BATCH_SIZE == 0:
+            time.sleep(THROTTLE_PAUSE)
+
+    if os.path.islink(path) or not os.path.isdir(path):
+        remove(os.unlink, path)
+        return removed, freed, failed
+    for root, dir_names, file_names in os.walk(path, topdown=False):
+        for name in file_names:
+            remove(os.unlink, os.path.join(root, name))
+        for name in dir_names:
+            entry_path = os.path.join(root, name)
+            remove(os.unlink if os.path.islink(entry_path) else os.rmdir, entry_path)
+    remove(os.rmdir, path)
+    return removed, freed, failed
+
+
+def empty_trash(store_dir, throttle=False, wait=True):
+    """Removes everything in the trash of the store while holding the trash lock.
+    If wait is not set and another process holds the lock, returns None right away
+
+    :rtype: (entries removed, bytes freed, entries which could not be removed)"""
+
+    trash_dir = get_trash_dir(store_dir)
+    if not os.path.isdir(trash_dir):
+        return 0, 0, 0
+    lock_fd = os.open(os.path.join(trash_dir, TRASH_LOCK_FILE_NAME), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return None
+        totals = [0, 0, 0]
+        # list the trash again until nothing new shows up, things may be trashed while it is emptied
+        seen = {TRASH_LOCK_FILE_NAME}
+        while True:
+            names = [name for name in os.listdir(trash_dir) if name not in seen]
+            if not names:
+                return tuple(totals)
+            for name in names:
+                seen.add(name)
+                for i, count in enumerate(remove_tree(os.path.join(trash_dir, name), throttle)):
+                    totals[i] += count
+    finally:
+        os.close(lock_fd)
+
+
+def empty_trash_in_background(store_dir):
+    """Starts a detached, low priority process emptying the trash of the store and returns right away.
+    Nothing happens if another process is already emptying it"""
+
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        lower_priority()
+        empty_trash(store_dir, throttle=True, wait=False)
+    finally:
+        os._exit(0)
@@ -9,34 +9,77 @@ This program is distributed in the hope that it will be useful, but WITHOUT ANY
 You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 import os
+import time
 import click
 import shutil
 import json
-from subprocess import call
+import contextlib
+import functools
+from konfchanger_copy import CopyEngine
+from konfchanger_trace import Tracer
+from konfchanger_watch import get_watcher, wait_for_changes
+from konfchanger_trash import move_to_trash, empty_trash, empty_trash_in_background, is_trash_empty
+from konfchanger_sync import SyncStats, list_packs, sync_pack
+from konfchanger_diff import LiveView, diff_views
+from konfchanger_layers import Composition, apply_composition, expand_layers, get_children
+from konfchanger_archive import export_pack, import_pack, apply_archive, list_archive, ARCHIVE_EXTENSION
+from konfchanger_index import PackIndex, INDEX_FILE_NAME
+from konfchanger_rules import parse_locations
+from konfchanger_verify import HashCache, verify_packs, HASH_CACHE_FILE_NAME
+from konfchanger_journal import ApplyJournal, list_journals, undo_journal, JOURNAL_DIR_NAME
+from konfchanger_store import ObjectStore, DirectoryStore, LAYOUT_DIRECTORY, LAYOUT_OBJECTS, MANIFEST_VERSION, \
+    get_pack_layout, get_pack_entry_path, get_stored_root, read_manifest, read_checkpoint
 
 BAK_FILE_EXTENSION = '.bak'
 KONFIGCHANGER_CONFIG_DIR_PATH: str = '.config/konfigchanger_config'
 DEFAULT_BACKUP_LIST_FILE_NAME = 'backup_locations'
 DEFAULT_CONFIG_FILE_NAME = 'konfchanger_default_config'
+CURRENT_PACK_LINK_NAME = '.current'
+# the values read from konfigchanger's config file
+LOADED_CONFIG_KEYS = ('store_dir', 'config_list_path', 'store_layout', 'compare_hash', 'copy_workers')
+# watch backs up at the latest after this many debounce intervals, even if the changes keep coming
+WATCH_MAX_DELAY_FACTOR = 10
+
+
+def traced_operation(operation):
+    """Records the time and the copies of the decorated Utils method as operation when tracing is enabled"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.tracer is None:
+                return method(self, *args, **kwargs)
+            with self.tracer.trace_operation(operation):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class Utils:
 
-    def __init__(self):
+    def __init__(self, home_path=None, settings=None, locations=None):
+        """home_path defaults to $HOME. settings optionally overrides values of konfigchanger's config file, any of
+        LOADED_CONFIG_KEYS with store_dir and config_list_path relative to home or absolute, and locations optionally
+        gives the lines of the configuration list file instead of reading it"""
+
         self.__info_map = MyDict()
         self.logger = MyDict()
         self.__set_info_logger()
         self.__set_error_logger()
+        self.__settings = settings or dict()
+        self.__location_lines = None if locations is None else list(locations)
 
-        self.__set_home_dir()
+        self.__set_home_dir(home_path)
         self.__set_current_directory()
 
         self.__set_kconfigchanger_config_dir()
         self.__set_verbose_logger(False)
-        if not self.is_konfigchanger_config_present():
-            return
-        self.__load_konfigchanger_config_file()
-        pass
+        # konfigchanger's config file is only read when a value from it is first asked for
+        self.__config_loaded = False
+        self.__config_mtime_ns = None
+        # (stat key of the configuration list file, source paths read from it)
+        self.__source_paths_cache = None
+        self.tracer = None
 
     def __identity(*args, **args1):
         pass
@@ -44,8 +87,8 @@ class Utils:
     def __set_info_logger(self, flag=True):
         self.logger.info = click.echo if flag else self.__identity
 
-    def __set_home_dir(self):
-        self.__info_map.home_dir = os.getenv('HOME')
+    def __set_home_dir(self, home_path=None):
+        self.__info_map.home_dir = home_path or os.getenv('HOME')
 
     def __set_current_directory(self):
         self.__info_map.current_dir = os.getcwd()
@@ -55,12 +98,28 @@ class Utils:
 
     def __load_konfigchanger_config_file(self):
         konfigchanger_config = self.get_value('konfigchanger_config')
+        self.__config_mtime_ns = os.stat(konfigchanger_config).st_mtime_ns
         with open(konfigchanger_config, 'r') as cfg:
             json_data = json.load(cfg)
             self.__info_map.store_dir = os.path.join(self.get_home_path(), json_data['store_dir'])
             self.logger.log('Found Bacup folder location')
             self.__info_map['config_list_path'] = os.path.join(self.get_home_path(), json_data['config_list_path'])
             self.logger.log('Found configuration list file')
+            self.__info_map.store_layout = json_data.get('store_layout', LAYOUT_DIRECTORY)
+            self.__info_map.compare_hash = json_data.get('compare_hash', False)
+            self.__info_map.copy_workers = json_data.get('copy_workers')
+
+    def __apply_settings(self):
+        """Sets the values given instead of the ones of konfigchanger's config file, and the defaults of the ones
+        neither gives"""
+
+        for key, value in self.__settings.items():
+            if key in ('store_dir', 'config_list_path'):
+                value = os.path.join(self.get_home_path(), value)
+            self.__info_map[key] = value
+        self.__info_map.setdefault('store_layout', LAYOUT_DIRECTORY)
+        self.__info_map.setdefault('compare_hash', False)
+        self.__info_map.setdefault('copy_workers', None)
 
     def __set_stored_config_list(self, stored_configs):
         self.__info_map.store_config_list = stored_configs
@@ -83,12 +142,50 @@ class Utils:
     def enable_verbose(self, ctx, flag_name, enable_flag=False):
         self.__set_verbose_logger(enable_flag)
 
+    def enable_tracing(self):
+        self.tracer = Tracer(self.get_home_path())
+
+    def __trace_location(self, path):
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.trace_location(path)
+
+    def report_trace(self, timings, trace_path, command=None):
+        """Prints the timings table and/or writes the JSON trace of everything traced since tracing was enabled"""
+
+        if self.tracer is None:
+            return
+        if timings:
+            self.tracer.echo_summary(self.logger.info)
+        if trace_path is not None:
+            self.tracer.write_json(trace_path, command)
+            self.logger.log('Wrote trace to ' + trace_path)
+
     def disable_error_log(self):
         self.__set_error_logger(False)
 
     def disable_info_log(self):
         self.__set_info_logger(False)
 
+    def prepare_for_command(self):
+        """Resets what a previous command changed and reloads konfigchanger's config if it was modified since,
+        so a Utils can be kept in memory across commands"""
+
+        self.__set_info_logger()
+        self.__set_error_logger()
+        self.__set_verbose_logger(False)
+        self.tracer = None
+        if not self.__config_loaded:
+            return
+        try:
+            mtime_ns = os.stat(self.get_konfigchanger_config_file_path()).st_mtime_ns
+        except (OSError, TypeError):
+            mtime_ns = None
+        if mtime_ns != self.__config_mtime_ns:
+            for key in LOADED_CONFIG_KEYS:
+                self.__info_map.pop(key, None)
+            self.__config_loaded = False
+
     def get_home_path(self):
         return self.get_value('home_dir')
 
@@ -99,7 +196,12 @@ class Utils:
         return self.get_value('konfigchanger_config')
 
     def get_backup_list_file_path(self):
-        return self.get_value('config_list_path')
+        """Returns the configuration list file of konfigchanger's config, the one init creates if there is none"""
+
+        path = self.get_value('config_list_path')
+        if path is None:
+            return os.path.join(self.get_konfig_config_dir_path(), DEFAULT_BACKUP_LIST_FILE_NAME)
+        return path
 
     def get_konfig_config_dir_path(self):
         return self.get_value('konfigchanger_config_dir')
@@ -129,7 +231,9 @@ class Utils:
     def is_backup_list_file_present(self):
         """Check if the file containing list to other configuration file to be backed up is present or not"""
 
-        path = self.get_value('config_list_path')
+        if self.__location_lines is not None:
+            return True
+        path = self.get_backup_list_file_path()
         if not os.path.isfile(path):
             self.logger.info('Configuration List providing file not present at ' + path)
             self.logger.info('Please run "init" command again!!')
@@ -137,6 +241,8 @@ class Utils:
             self.logger.info(
                 '<relative_to_home_path_to_config_file_1>\n<relative_to_home_path_to_config_file_2>\n:\n<relative_to_home_path_to_config_file_n>')
             self.logger.info('any location which starts with a "#" will be ignored')
+            self.logger.info('indented lines below a location hold .gitignore style patterns of what to leave out of it, '
+                             'and "max-file-size <size>" or "max-size <size>" limits')
             return False
         else:
             self.logger.log('Configuration list providing file found')
@@ -146,7 +252,7 @@ class Utils:
         """Checks if store directory is present or not"""
 
         store_dir = self.get_value('store_dir')
-        if not os.path.isdir(store_dir):
+        if (store_dir is None) or (not os.path.isdir(store_dir)):
             self.logger.info('Backup directory is not pesent!!')
             return False
         else:
@@ -162,17 +268,58 @@ class Utils:
             return False
 
     def get_value(self, key):
-        """Get value from info_map in the object"""
+        """Get value from info_map in the object, loading konfigchanger's config file the first time a value is missing"""
 
         if key in self.__info_map.keys():
             return self.__info_map[key]
+        if not self.__config_loaded:
+            self.__config_loaded = True
+            if self.is_konfigchanger_config_present():
+                self.__load_konfigchanger_config_file()
+            self.__apply_settings()
+            return self.get_value(key)
         return None
 
+    def __list_store_dir(self):
+        store_dir = self.get_value('store_dir')
+        return sorted(config for config in os.listdir(store_dir)
+                      if not config.startswith('.') and os.path.isdir(os.path.join(store_dir, config)))
+
+    def __get_pack_index(self):
+        return PackIndex(os.path.join(self.get_konfig_config_dir_path(), INDEX_FILE_NAME))
+
+    def reindex_store(self):
+        """Rebuilds the pack index by scanning the store directory"""
+
+        pack_index = self.__get_pack_index()
+        stored_configs = self.__list_store_dir()
+        pack_index.rebuild(self.get_store_dir(), stored_configs)
+        pack_index.close()
+        self.logger.log('Indexed ' + str(len(stored_configs)) + ' configuration packs')
+        return stored_configs
+
+    def update_pack_index(self, name):
+        """Records the current metadata of the named pack in the pack index"""
+
+        pack_index = self.__get_pack_index()
+        pack_index.update_pack(name, self.get_config_backup_absolute_path_by_name(name))
+        pack_index.close()
+
+    def remove_from_pack_index(self, name):
+        pack_index = self.__get_pack_index()
+        pack_index.remove_pack(name)
+        pack_index.close()
+
     def get_stored_config_name_list(self):
-        """Gets the list of stored configurations from store folder"""
+        """Gets the list of stored configurations from the pack index, building the index from the store folder if missing"""
 
-        store_dir = self.get_value('store_dir')
-        stored_configs = [config for config in os.listdir(store_dir)]
+        if os.path.isfile(os.path.join(self.get_konfig_config_dir_path(), INDEX_FILE_NAME)):
+            pack_index = self.__get_pack_index()
+            stored_configs = pack_index.get_names()
+            pack_index.close()
+        else:
+            self.logger.log('Pack index not found, indexing the store')
+            stored_configs = self.reindex_store()
         if len(stored_configs) == 0:
             self.logger.info('Store directory does not contain any previously backed up configurations')
             return None
@@ -186,6 +333,67 @@ class Utils:
     def get_store_dir(self):
         return self.get_value('store_dir')
 
+    def get_store_layout(self):
+        return self.get_value('store_layout')
+
+    def __get_copy_engine(self):
+        return CopyEngine(self.get_value('copy_workers'), self.logger, self.tracer)
+
+    def __get_object_store(self, engine=None):
+        return ObjectStore(self.get_store_dir(), self.logger, engine or self.__get_copy_engine())
+
+    def __get_directory_store(self):
+        return DirectoryStore(self.logger, self.get_value('compare_hash'), self.__get_copy_engine())
+
+    def is_config_pack_updatable(self, location, parent=None):
+        """Checks if the pack at location has a manifest, or the checkpoint of an interrupted backup, of the current
+        version and store layout, and is stored as a delta against parent if given, so it can be updated in place"""
+
+        manifest = read_manifest(location) or read_checkpoint(location)
+        return (manifest is not None) and (manifest.get('version', 1) == MANIFEST_VERSION) and \
+            (manifest.get('layout', LAYOUT_DIRECTORY) == self.get_store_layout()) and \
+            (manifest.get('parent') == parent)
+
+    def get_parent_config_name(self, stored_config_name):
+        """Returns the name of the pack the named pack is stored as a delta against, None if it is complete"""
+
+        manifest = read_manifest(self.get_config_backup_absolute_path_by_name(stored_config_name))
+        return None if manifest is None else manifest.get('parent')
+
+    def get_child_config_names(self, stored_config_name):
+        """Returns the names of the packs stored as a delta against the named pack"""
+
+        return get_children(self.get_store_dir(), stored_config_name, self.__list_store_dir())
+
+    def check_replaced_configs(self, stored_config_names, store_dir=None, source_store=None):
+        """Returns why the named packs can not be replaced in store_dir, the configured store by default: packs which
+        are not replaced along with them are stored as a delta against them and would silently change too. Packs with
+        the same manifest in source_store, if given, are left as they are. None if they can be replaced"""
+
+        store_dir = store_dir or self.get_store_dir()
+        if not os.path.isdir(store_dir):
+            return None
+        names = list_packs(store_dir)
+        for name in stored_config_names:
+            if source_store is not None:
+                manifest = read_manifest(os.path.join(store_dir, name))
+                if manifest is not None and manifest == read_manifest(os.path.join(source_store, name)):
+                    continue
+            children = [child for child in get_children(store_dir, name, names) if child not in stored_config_names]
+            if children:
+                return 'These configuration packs are stored as a delta against ' + name + ' and would change with ' \
+                    'it, please delete them first: ' + ', '.join(children)
+        return None
+
+    def get_config_layers(self, stored_config_names, store_dir=None):
+        """Returns the named packs preceded by the packs they are stored as a delta against, bottom one first.
+        store_dir defaults to the configured store"""
+
+        return expand_layers(store_dir or self.get_store_dir(), stored_config_names)
+
+    def __get_composition(self, stored_config_names):
+        return Composition(self.get_store_dir(), self.get_config_layers(stored_config_names), self.__get_object_store())
+
     def get_config_name(self):
         """Gives user the list of stored configs provided in parameter and lets them choose one from the list"""
 
@@ -212,37 +420,156 @@ class Utils:
         for i in range(1, no_configs + 1):
             self.logger.info('[' + str(i) + '] ' + stored_configs[i - 1])
 
-    def __get_backup_source_paths(self):
-        """Get the list of configuration source paths from where we have to backup/copy configurations"""
+    def echo_configs_long(self, sort='name', host=None, pattern=None):
+        """Prints the stored configs with their metadata from the pack index"""
 
+        if not os.path.isfile(os.path.join(self.get_konfig_config_dir_path(), INDEX_FILE_NAME)):
+            self.reindex_store()
+        pack_index = self.__get_pack_index()
+        packs = pack_index.get_packs(sort, host, pattern)
+        pack_index.close()
+        if len(packs) == 0:
+            self.logger.info('No backed up configuration packs present!!')
+            return
+        self.logger.info('{:<24} {:<10} {:>12} {:>8}  {:<16}  {:<16}  {}'.format(
+            'NAME', 'LAYOUT', 'SIZE', 'ENTRIES', 'CREATED', 'UPDATED', 'HOST'))
+        for pack in packs:
+            self.logger.info('{:<24} {:<10} {:>12} {:>8}  {:<16}  {:<16}  {}'.format(
+                pack['name'], pack['layout'], pack['size'], pack['entry_count'],
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(pack['created_at'])),
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(pack['updated_at'])), pack['source_host']))
+
+    def __parse_backup_source_paths(self, lines):
         home_path = self.get_home_path()
-        source_paths_file_location = self.get_value('config_list_path')
         source_paths = list()
+        location_rules = dict()
+        for source_path, rules in parse_locations(lines, self.logger.error):
+            source_path = os.path.join(home_path, source_path)
+            source_paths.append(source_path)
+            self.logger.log(source_path)
+            if rules is not None:
+                location_rules[source_path] = rules
+        return source_paths, location_rules
+
+    def __load_backup_source_paths(self):
+        """Reads the file listing the configuration locations and the rules of each of them, unless it did not change
+        since it was last read, or parses the lines given instead of it
+
+        :rtype: (list of source paths, dict of source path to LocationRules)"""
+
+        if self.__location_lines is not None:
+            if self.__source_paths_cache is None:
+                self.__source_paths_cache = (None,) + self.__parse_backup_source_paths(self.__location_lines)
+            return self.__source_paths_cache[1], self.__source_paths_cache[2]
+        source_paths_file_location = self.get_value('config_list_path')
+        st = os.stat(source_paths_file_location)
+        stat_key = (source_paths_file_location, st.st_ino, st.st_size, st.st_mtime_ns)
+        if self.__source_paths_cache is not None and self.__source_paths_cache[0] == stat_key:
+            return self.__source_paths_cache[1], self.__source_paths_cache[2]
         with open(source_paths_file_location, 'r') as source_paths_file:
-            for source_path in source_paths_file:
-                source_path = source_path.strip('\n')
-                if (len(source_path) >= 2) & (not source_path.startswith('#')):
-                    source_path = os.path.join(home_path, source_path)
-                    source_paths.append(source_path)
-                    self.logger.log(source_path)
-        return source_paths
+            source_paths, location_rules = self.__parse_backup_source_paths(source_paths_file)
+        self.__source_paths_cache = (stat_key, source_paths, location_rules)
+        return source_paths, location_rules
+
+    def __get_backup_source_paths(self):
+        """Get the list of configuration source paths from where we have to backup/copy configurations.
+        The list is only read again once the file listing them changed"""
+
+        return list(self.__load_backup_source_paths()[0])
 
-    def copy_configs_to_store(self, dest):
-        """Copy the current configurations mentioned into a store-configuration folder"""
+    def __get_location_rules(self):
+        """Returns the LocationRules of every configuration source path which has any, by source path"""
+
+        return self.__load_backup_source_paths()[1]
+
+    @traced_operation('backup')
+    def copy_configs_to_store(self, dest, changed_locations=None, parent=None):
+        """Copy the current configurations mentioned into a store-configuration folder.
+        If dest already holds a pack of the same layout only the changed configurations are copied.
+        If changed_locations is given, every other location is taken as unchanged and not looked at.
+        If the name of a parent pack is given, only what differs from it is stored"""
 
         source_path_list = self.__get_backup_source_paths()
-        error_occurred = False
-        for source_path in source_path_list:
-            try:
-                error = call(['cp', '-a', source_path, dest])
-                if error == 1:
-                    raise Exception
-            except Exception as e:
-                self.logger.error('Error occurred while copying '+source_path + ' to location '+dest)
-                self.logger.error('Following error occurred:')
-                self.logger.error(e)
-                error_occurred = True
-        return error_occurred
+        home_path = self.get_home_path()
+        previous_manifest = read_manifest(dest) if self.is_config_pack_updatable(dest, parent) else None
+        composition = self.__get_composition([parent]) if parent is not None else None
+        read_paths = {source_path: os.path.realpath(source_path) for source_path in source_path_list
+                      if self.is_switched_location(source_path)}
+        unchanged_roots = None
+        if changed_locations is not None:
+            unchanged_roots = {os.path.relpath(source_path, home_path) for source_path in source_path_list
+                               if source_path not in changed_locations}
+        if self.get_store_layout() == LAYOUT_OBJECTS:
+            self.logger.log('Storing configurations in object store')
+            return self.__get_object_store().backup(source_path_list, home_path, dest, previous_manifest,
+                                                    read_paths, unchanged_roots, composition,
+                                                    self.__get_location_rules())
+        return self.__get_directory_store().backup(source_path_list, home_path, dest, previous_manifest,
+                                                   read_paths, unchanged_roots, composition,
+                                                   self.__get_location_rules())
+
+    def check_parent_config(self, stored_config_name, parent):
+        """Returns why the named pack can not be stored as a delta against the pack parent, None if it can"""
+
+        if not os.path.isdir(self.get_config_backup_absolute_path_by_name(parent)):
+            return parent + ' provided parent doesnt match with any existing stored configurations'
+        try:
+            parent_layers = self.get_config_layers([parent])
+        except ValueError as e:
+            return str(e)
+        if stored_config_name in parent_layers:
+            return stored_config_name + ' can not be stored as a delta against ' + parent + ', it is ' + parent + \
+                ' or one of its parents'
+        return None
+
+    def backup_config(self, stored_config_name, parent=None):
+        """Backs up the current configurations as the named pack, updating an existing pack of that name in place if it
+        can be and replacing it otherwise. If the name of a parent pack is given, only what differs from it is stored
+
+        :rtype: int 1 if an error occurred, 0 otherwise and
+                object the error if the pack could not be created, None if the error occurred while backing up"""
+
+        absolute_path = self.get_config_backup_absolute_path_by_name(stored_config_name)
+        configuration_exists = os.path.isdir(absolute_path)
+        if configuration_exists and self.is_config_pack_updatable(absolute_path, parent):
+            self.logger.log('Updating existing configuration backup in place')
+        else:
+            error_code, error = self.create_directory(absolute_path, True)
+            if error_code == 1:
+                return 1, error
+        backup_error = self.copy_configs_to_store(absolute_path, parent=parent)
+        self.update_pack_index(stored_config_name)
+        if backup_error:
+            return 1, None
+        if configuration_exists:
+            self.remove_unreferenced_objects()
+        return 0, None
+
+    def watch_configs(self, stored_config_name, debounce, poll_interval, polling=False):
+        """Keeps the named pack up to date: waits for changes below the configuration locations and, once no more
+        changes came in for debounce seconds, backs up only the locations which changed. Runs until interrupted"""
+
+        pack_path = self.get_config_backup_absolute_path_by_name(stored_config_name)
+        parent = self.get_parent_config_name(stored_config_name)
+        locations = self.__get_backup_source_paths()
+        watcher = get_watcher(locations, self.logger, poll_interval, polling, self.__get_location_rules())
+        self.logger.info('Watching ' + str(len(locations)) + ' configuration locations for changes, press Ctrl+C to stop')
+        try:
+            while True:
+                changed = wait_for_changes(watcher, debounce, debounce * WATCH_MAX_DELAY_FACTOR)
+                for location in sorted(changed):
+                    self.logger.log(location + ' changed')
+                backup_error = self.copy_configs_to_store(pack_path, changed, parent)
+                self.update_pack_index(stored_config_name)
+                self.remove_unreferenced_objects()
+                if backup_error:
+                    self.logger.error('Some error occurred while backing up the changed configurations into ' +
+                                      stored_config_name)
+                else:
+                    self.logger.info(time.strftime('%H:%M:%S') + ' Backed up ' + str(len(changed)) +
+                                     ' changed configurations into ' + stored_config_name)
+        finally:
+            watcher.close()
 
     def __bak_file_exists(self, source_paths):
         """Checks if the backup exists for the source paths provided"""
@@ -256,8 +583,10 @@ class Utils:
                 no_bk_list.append(source_path)
         return no_bk_list
 
+    @traced_operation('create_bak_file')
     def create_bak_file(self, ctx):
-        """Creates backup for the current source configurations for which no backup exists"""
+        """Creates backup for the current source configurations for which no backup exists.
+        The configurations are copied, not moved, so applying a pack can skip the files which are already identical"""
 
         source_paths = self.__get_backup_source_paths()
         no_bk_list = self.__bak_file_exists(source_paths)
@@ -265,13 +594,14 @@ class Utils:
             return
 
         any_error = False
+        to_copy = list()
         for source_path in no_bk_list:
-            source_path_bk = source_path + BAK_FILE_EXTENSION
             self.logger.log('creating backup for ' + source_path)
-            exit_code = call(['mv', '-v', source_path, source_path_bk])
-            if exit_code != 0:
-                self.logger.info('Could not backup ' + source_path + ' to ' + source_path_bk)
-                any_error = True
+            to_copy.append((source_path, source_path + BAK_FILE_EXTENSION))
+        for source_path, error in self.__get_copy_engine().copy_entries(to_copy):
+            self.logger.info('Could not backup ' + source_path + ' to ' + source_path + BAK_FILE_EXTENSION)
+            self.logger.error(error)
+            any_error = True
         if any_error:
             self.logger.info('There was error creating backup for 1 or more configurations\nSo aborting....')
             ctx.abort()
@@ -284,10 +614,13 @@ class Utils:
         config_dir = self.get_konfig_config_dir_path()
         default_backup_file_path = os.path.join(self.get_current_directory_path(), DEFAULT_BACKUP_LIST_FILE_NAME)
         default_config_file_path = os.path.join(self.get_current_directory_path(), DEFAULT_CONFIG_FILE_NAME)
+        engine = self.__get_copy_engine()
         try:
-            call(['cp', '-a', default_backup_file_path, config_dir])
+            for _, error in engine.copy_entries([(default_backup_file_path, os.path.join(config_dir, DEFAULT_BACKUP_LIST_FILE_NAME))]):
+                raise error
             self.logger.log('Successfully copied default list of configuration file at '+ config_dir)
-            call(['cp', '-a', default_config_file_path, config_dir])
+            for _, error in engine.copy_entries([(default_config_file_path, os.path.join(config_dir, DEFAULT_CONFIG_FILE_NAME))]):
+                raise error
             self.logger.log('Sucessfully copied default configuration file at '+config_dir)
             self.logger.info('Successfully created default configuration!!')
             self.__info_map.konfigchanger_config = os.path.join(config_dir, DEFAULT_CONFIG_FILE_NAME)
@@ -299,47 +632,433 @@ class Utils:
         return error_code, None
 
 
-    def copy_to_set_locations(self, ctx, stored_config_name):
-        """Copy the stored configuration to the specific locations"""
+    def __get_journal_dir(self):
+        return os.path.join(self.get_konfig_config_dir_path(), JOURNAL_DIR_NAME)
 
+    @contextlib.contextmanager
+    def __journaled(self, engine, description):
+        """Records what is replaced through engine inside the block in a new apply journal, written when the block is
+        left even if applying failed, so undo can put back what was replaced"""
+
+        engine.journal = ApplyJournal(self.__get_journal_dir(), self.get_home_path(), description)
+        try:
+            yield
+        finally:
+            if engine.journal.commit():
+                self.logger.log('Recorded the ' + str(len(engine.journal.entries)) + ' paths replaced in ' +
+                                engine.journal.path)
+            engine.journal = None
+
+    @traced_operation('apply')
+    def copy_to_set_locations(self, ctx, stored_config_name, overlays=()):
+        """Copy the stored configuration to the specific locations, skipping the files already identical.
+        The packs stored as a delta, with their parents, and the overlay packs given are stacked in order and their
+        merged view is written in one pass, the topmost pack having a path winning.
+        What gets replaced is recorded in an apply journal for undo"""
+
+        engine = self.__get_copy_engine()
+        with self.__journaled(engine, ' + '.join((stored_config_name,) + tuple(overlays))):
+            self.__apply_pack(ctx, engine, stored_config_name, overlays)
+
+    def __apply_pack(self, ctx, engine, stored_config_name, overlays):
         default_locations = self.__get_backup_source_paths()
         store_dir = self.get_value('store_dir')
         source_path = os.path.join(store_dir, stored_config_name)
+        try:
+            layers = self.get_config_layers([stored_config_name] + list(overlays))
+            composition = self.__get_composition(layers) if len(layers) > 1 else None
+        except ValueError as e:
+            self.logger.error(e)
+            ctx.abort()
+        if composition is not None:
+            self.logger.log('Applying ' + ' < '.join(layers))
+            home_path = self.get_home_path()
+            roots = [os.path.relpath(location, home_path) for location in default_locations]
+            any_error = apply_composition(composition, home_path, roots, self.logger, engine)
+            self.__echo_copy_stats(engine.stats)
+            if any_error:
+                self.logger.error('Encountered error while applying 1 or more configurations....\nSo aborting')
+                ctx.abort()
+            return
+        if get_pack_layout(source_path) == LAYOUT_OBJECTS:
+            home_path = self.get_home_path()
+            roots = [os.path.relpath(location, home_path) for location in default_locations]
+            any_error = self.__get_object_store(engine).apply(source_path, home_path, roots)
+            self.__echo_copy_stats(engine.stats)
+            if any_error:
+                self.logger.error('Encountered error while applying 1 or more configurations....\nSo aborting')
+                ctx.abort()
+            return
         any_error = False
-        src = [stored_config for stored_config in os.listdir(source_path)]
-        for config in src:
-            associated_path = self.__get_associated_path(config, default_locations)
-            if associated_path is None:
+        manifest = read_manifest(source_path)
+        if manifest is None:
+            to_copy = self.__get_legacy_pack_locations(source_path, default_locations)
+        else:
+            home_path = self.get_home_path()
+            locations = {os.path.relpath(location, home_path): location for location in default_locations}
+            to_copy = list()
+            for root in manifest['roots']:
+                location = locations.get(root)
+                if location is None:
+                    self.logger.log(root + ' is not in the list of configurations, so skipping applying it!!')
+                    continue
+                source_location = get_pack_entry_path(source_path, manifest, root, root)
+                self.logger.log('Applying ' + source_location + ' to ' + location)
+                to_copy.append((source_location, location))
+        for source_location, error in engine.copy_entries(to_copy, skip_identical=True, locations=dict(to_copy)):
+            any_error = True
+            self.logger.error('Error while copying ' + source_location + ' into ' + dict(to_copy)[source_location])
+            self.logger.error(error)
+        self.__echo_copy_stats(engine.stats)
+        if any_error:
+            self.logger.error('Encountered error while applying 1 or more configurations....\nSo aborting')
+            ctx.abort()
+
+    def diff_configs(self, stored_config_name, against_config_name=None):
+        """Prints how the live configurations, or the pack against_config_name if given, differ from the named pack,
+        INI files key by key
+
+        :rtype: int, object"""
+
+        try:
+            old = self.__get_composition([stored_config_name])
+            if against_config_name is None:
+                roots = old.roots
+                new = LiveView(self.get_home_path(), roots, self.logger, self.__get_location_rules())
+            else:
+                new = self.__get_composition([against_config_name])
+                roots = old.roots + [root for root in new.roots if root not in old.roots]
+            differences = diff_views(old, new, roots)
+        except (ValueError, OSError) as error:
+            return 1, error
+        if len(differences) == 0:
+            self.logger.info('No differences')
+        for status, relative_path, changes in differences:
+            self.logger.info(status + ' ' + relative_path)
+            for change in changes:
+                self.logger.info('    ' + change)
+        return 0, None
+
+    def export_config(self, stored_config_name, archive_path, compression):
+        """Writes the named pack into a single compressed archive, <name>.kpack if archive_path is None
+
+        :rtype: str the path of the archive or None if an error occurred"""
+
+        pack_path = self.get_config_backup_absolute_path_by_name(stored_config_name)
+        manifest = read_manifest(pack_path)
+        if manifest is None:
+            self.logger.error(stored_config_name + ' was backed up without a manifest, please run backup with '
+                                                   '--overwrite-existing for it before exporting')
+            return None
+        if archive_path is None:
+            archive_path = stored_config_name + ARCHIVE_EXTENSION
+        try:
+            composition = None
+            if manifest.get('parent') is not None:
+                self.logger.log(stored_config_name + ' is stored as a delta, exporting it merged with its parents')
+                composition = self.__get_composition([stored_config_name])
+                manifest = composition.get_manifest()
+            export_pack(pack_path, manifest, archive_path, self.__get_object_store(), compression, composition)
+            self.logger.log('Exported ' + str(len(manifest['entries'])) + ' entries into ' + archive_path)
+            return archive_path
+        except Exception as e:
+            self.logger.error('Error while exporting ' + stored_config_name + ' to ' + archive_path)
+            self.logger.error(e)
+            return None
+
+    def import_config(self, archive_path, stored_config_name):
+        """Creates a pack with the given name in the store's layout from an exported archive
+
+        :rtype: bool True if an error occurred"""
+
+        pack_path = self.get_config_backup_absolute_path_by_name(stored_config_name)
+        error_code, error = self.create_directory(pack_path, True)
+        if error_code == 1:
+            self.logger.error('Error creating backup folder at ' + pack_path)
+            self.logger.error(error)
+            return True
+        try:
+            import_pack(archive_path, pack_path, self.get_store_layout(), self.__get_object_store())
+            return False
+        except Exception as e:
+            self.logger.error('Error while importing ' + archive_path + ' as ' + stored_config_name)
+            self.logger.error(e)
+            return True
+
+    def echo_archive(self, archive_path):
+        """Prints the files of an exported archive using only its index"""
+
+        self.logger.info('These are the configurations in ' + archive_path + ':')
+        for relative_path, size, compressed_size in list_archive(archive_path):
+            self.logger.info(relative_path + ' (' + str(size) + ' bytes, ' + str(compressed_size) + ' compressed)')
+
+    def get_remote_config_name_list(self, remote_store):
+        return list_packs(remote_store)
+
+    def __sync_configs(self, source_store, dest_store, names):
+        """Makes the named packs of dest_store identical to the ones in source_store, sending only what changed
+
+        :rtype: list of the names which could not be synchronized"""
+
+        engine = self.__get_copy_engine()
+        stats = SyncStats()
+        failed = list()
+        for name in names:
+            self.logger.log('Synchronizing ' + name + ' from ' + source_store + ' to ' + dest_store)
+            try:
+                if sync_pack(source_store, dest_store, name, engine, stats, self.logger):
+                    failed.append(name)
+            except Exception as e:
+                self.logger.error('Error while synchronizing ' + name + ' to ' + dest_store)
+                self.logger.error(e)
+                failed.append(name)
+        if not is_trash_empty(dest_store):
+            empty_trash_in_background(dest_store)
+        self.logger.info('Sent ' + str(stats.files_sent) + ' whole files and ' + str(stats.files_patched) +
+                         ' changed files as deltas (' + str(stats.bytes_sent) + ' bytes, ' + str(stats.bytes_matched) +
+                         ' bytes reused from the receiving store), skipped ' + str(engine.stats.files_skipped) +
+                         ' unchanged files and removed ' + str(stats.entries_removed) + ' entries')
+        return failed
+
+    @traced_operation('push')
+    def push_configs(self, remote_store, names):
+        """Sends the named packs to remote_store
+
+        :rtype: list of the names which could not be sent"""
+
+        return self.__sync_configs(self.get_store_dir(), remote_store, names)
+
+    @traced_operation('pull')
+    def pull_configs(self, remote_store, names):
+        """Fetches the named packs from remote_store into the store
+
+        :rtype: list of the names which could not be fetched"""
+
+        failed = self.__sync_configs(remote_store, self.get_store_dir(), names)
+        for name in names:
+            if name not in failed:
+                self.update_pack_index(name)
+        self.remove_unreferenced_objects()
+        return failed
+
+    @traced_operation('apply')
+    def copy_archive_to_set_locations(self, ctx, archive_path):
+        """Applies an exported archive directly, without unpacking it into the store first.
+        What gets replaced is recorded in an apply journal for undo"""
+
+        home_path = self.get_home_path()
+        roots = [os.path.relpath(location, home_path) for location in self.__get_backup_source_paths()]
+        engine = self.__get_copy_engine()
+        with self.__journaled(engine, os.path.basename(archive_path)):
+            try:
+                any_error = apply_archive(archive_path, home_path, roots, self.logger, engine)
+            except ValueError as e:
+                self.logger.error(e)
+                ctx.abort()
+        self.__echo_copy_stats(engine.stats)
+        if any_error:
+            self.logger.error('Encountered error while applying 1 or more configurations....\nSo aborting')
+            ctx.abort()
+
+    def __echo_copy_stats(self, stats):
+        self.logger.info('Wrote ' + str(stats.files_copied) + ' files (' + str(stats.bytes_copied) + ' bytes), skipped ' +
+                         str(stats.files_skipped) + ' identical files (' + str(stats.bytes_skipped) + ' bytes)')
+
+    def __get_legacy_pack_locations(self, pack_path, locations):
+        """Pairs the entries of a pack backed up without a manifest with the locations of the same name
+
+        :rtype: list of (stored entry, location)"""
+
+        locations_by_name = dict()
+        for location in locations:
+            locations_by_name.setdefault(os.path.basename(location), location)
+        pairs = list()
+        for config in os.listdir(pack_path):
+            location = locations_by_name.get(config)
+            if location is None:
                 self.logger.log('could not find associated path to apply ' + config)
                 self.logger.log('So skipping applying this config!!')
                 continue
-            source_location = os.path.join(source_path, config)
-            self.logger.log('Applying ' + source_location + ' to ' + associated_path)
-            error_code = call(['cp', '-a', source_location, associated_path])
-            if error_code != 0:
+            source_location = os.path.join(pack_path, config)
+            self.logger.log('Applying ' + source_location + ' to ' + location)
+            pairs.append((source_location, location))
+        return pairs
+
+    def get_current_pack_link_path(self):
+        return os.path.join(self.get_store_dir(), CURRENT_PACK_LINK_NAME)
+
+    def get_switched_config_name(self, store_dir=None):
+        """Returns the name of the pack the configurations are currently switched to, None if not in switch mode.
+        store_dir defaults to the configured store"""
+
+        if store_dir is None:
+            current_link = self.get_current_pack_link_path()
+        else:
+            current_link = os.path.join(store_dir, CURRENT_PACK_LINK_NAME)
+        if not os.path.islink(current_link):
+            return None
+        return os.readlink(current_link)
+
+    def is_switched_location(self, location):
+        """Checks if location is a symlink into the currently switched pack"""
+
+        if not os.path.islink(location):
+            return False
+        return os.readlink(location).startswith(self.get_current_pack_link_path() + os.sep)
+
+    def __replace_with_symlink(self, location, target):
+        tmp_link = location + '.konfchanger_link'
+        if os.path.lexists(tmp_link):
+            os.unlink(tmp_link)
+        os.symlink(target, tmp_link)
+        if os.path.isdir(location) and not os.path.islink(location):
+            shutil.rmtree(location)
+        os.replace(tmp_link, location)
+
+    def switch_to_config(self, ctx, stored_config_name):
+        """Activates a pack by making every configuration location a symlink into store_dir/.current
+        and atomically pointing .current at the pack"""
+
+        pack_path = self.get_config_backup_absolute_path_by_name(stored_config_name)
+        if get_pack_layout(pack_path) != LAYOUT_DIRECTORY:
+            self.logger.error(stored_config_name + ' is not stored as a directory, only directory packs can be switched to')
+            ctx.abort()
+        if self.get_parent_config_name(stored_config_name) is not None:
+            self.logger.error(stored_config_name + ' is stored as a delta against ' +
+                              self.get_parent_config_name(stored_config_name) + ', only complete packs can be switched to')
+            ctx.abort()
+        locations = [location for location in self.__get_backup_source_paths()
+                     if not self.is_switched_location(location)]
+        no_bk_list = self.__bak_file_exists(locations)
+        for location, error in self.__get_copy_engine().copy_entries(
+                [(location, location + BAK_FILE_EXTENSION) for location in no_bk_list if os.path.lexists(location)]):
+            self.logger.error('Could not backup ' + location + ' to ' + location + BAK_FILE_EXTENSION)
+            self.logger.error(error)
+            ctx.abort()
+        self.__replace_with_symlink(self.get_current_pack_link_path(), stored_config_name)
+        self.logger.log('Pointed ' + self.get_current_pack_link_path() + ' to ' + stored_config_name)
+        any_error = False
+        manifest = read_manifest(pack_path)
+        home_path = self.get_home_path()
+        for location in self.__get_backup_source_paths():
+            stored_root = get_stored_root(manifest, os.path.relpath(location, home_path))
+            if not os.path.lexists(os.path.join(pack_path, stored_root)):
+                self.logger.info(stored_config_name + ' does not contain ' + location + ', it will be left dangling')
+            target = os.path.join(self.get_current_pack_link_path(), stored_root)
+            if os.path.islink(location) and os.readlink(location) == target:
+                continue
+            try:
+                os.makedirs(os.path.dirname(location), exist_ok=True)
+                self.__replace_with_symlink(location, target)
+                self.logger.log('Linked ' + location + ' into the store')
+            except Exception as e:
                 any_error = True
-                self.logger.error('Error while copying ' + source_location + ' into ' + associated_path)
+                self.logger.error('Error while linking ' + location)
+                self.logger.error(e)
         if any_error:
-            self.logger.error('Encountered error while applying 1 or more configurations....\nSo aborting')
+            self.logger.error('Encountered error while linking 1 or more configurations....\nSo aborting')
             ctx.abort()
 
-    def __get_associated_path(self, config: str, config_paths: list) -> str:
-        """
-        Returns a
+    @traced_operation('materialize')
+    def materialize_switched_config(self, ctx):
+        """Replaces every symlink into the switched pack with a real copy of its contents and leaves switch mode"""
 
-        :rtype: str
-        """
-        for config_path in config_paths:
-            if config in config_path:
-                return config_path
+        any_error = False
+        engine = self.__get_copy_engine()
+        for location in self.__get_backup_source_paths():
+            if not self.is_switched_location(location):
+                continue
+            target = os.path.realpath(location)
+            os.unlink(location)
+            if not os.path.lexists(target):
+                self.logger.log('Removed dangling link ' + location)
+                continue
+            self.logger.log('Materializing ' + location)
+            for _, error in engine.copy_entries([(target, location)], locations={target: location}):
+                any_error = True
+                self.logger.error('Error while materializing ' + location)
+                self.logger.error(error)
+        if any_error:
+            self.logger.error('Encountered error while materializing 1 or more configurations....\nSo aborting')
+            ctx.abort()
+        os.unlink(self.get_current_pack_link_path())
 
+    @traced_operation('delete')
     def delete_location(self, location: str) -> None:
-        """
+        """Deletes the location. Packs are only moved into the trash of the store, which is then emptied in the background
 
         :param location: str
         :rtype: None
         """
-        shutil.rmtree(location)
+        with self.__trace_location(location):
+            store_dir = self.get_store_dir()
+            if os.path.dirname(os.path.normpath(location)) == os.path.normpath(store_dir):
+                try:
+                    trashed_path = move_to_trash(store_dir, location)
+                    self.logger.log('Moved ' + location + ' to ' + trashed_path)
+                    empty_trash_in_background(store_dir)
+                    return
+                except OSError as e:
+                    self.logger.log('Could not move ' + location + ' to the trash, deleting it right away')
+                    self.logger.log(e)
+            shutil.rmtree(location)
+
+    def empty_trash(self):
+        """Removes everything deleted packs left in the trash of the store, waiting for a background removal to finish
+
+        :rtype: (entries removed, bytes freed, entries which could not be removed)"""
+
+        return empty_trash(self.get_store_dir())
+
+    def is_trash_empty(self):
+        return is_trash_empty(self.get_store_dir())
+
+    def get_apply_journals(self):
+        """Returns (path, journal) of every apply which can be undone, the last one first"""
+
+        return list_journals(self.__get_journal_dir())
+
+    @traced_operation('undo')
+    def undo_applies(self, steps=1, force=False):
+        """Puts back what the last steps applies replaced, last one first. Paths changed again since they were applied
+        are left alone unless force is set, and undo stops at the first apply which could not be undone completely
+
+        :rtype: list of (description, number of paths put back, list of (relative path, why it was left alone))"""
+
+        results = list()
+        for journal_path, journal in self.get_apply_journals()[:steps]:
+            self.logger.log('Undoing ' + journal['description'] + ' recorded in ' + journal_path)
+            restored, problems = undo_journal(journal_path, self.get_home_path(), self.logger, force)
+            results.append((journal['description'], restored, problems))
+            if problems:
+                break
+        return results
+
+    @traced_operation('verify')
+    def verify_configs(self, stored_config_names=None, full=False):
+        """Checks the named packs, every pack if none are given, against the checksums recorded when backing them up.
+        Digests of files which did not change since they were last hashed come from a persistent cache unless full
+        is set, and are only forgotten when every pack is verified
+
+        :rtype: VerifyResult"""
+
+        store_dir = self.get_store_dir()
+        names = stored_config_names or self.__list_store_dir()
+        engine = self.__get_copy_engine()
+        hash_cache = HashCache(os.path.join(self.get_konfig_config_dir_path(), HASH_CACHE_FILE_NAME))
+        try:
+            result = verify_packs(store_dir, names, self.__get_object_store(engine), engine, hash_cache, full)
+            if not stored_config_names:
+                hash_cache.forget_below(store_dir, result.seen_paths)
+        finally:
+            hash_cache.close()
+        return result
+
+    @traced_operation('remove_unreferenced_objects')
+    def remove_unreferenced_objects(self):
+        """Removes stored file contents that no configuration pack refers to anymore"""
+
+        return self.__get_object_store().remove_unreferenced_objects()
 
     def create_directory(self, location, overwrite=False):
         """Creates directory at said location:
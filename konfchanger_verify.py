@@ -0,0 +1,165 @@
+"""
+konfchanger_verify - checks stored configuration packs against the checksums recorded at backup time for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+from konfchanger_store import LAYOUT_OBJECTS, get_pack_entry_path, get_root_of, hash_file, read_manifest
+
+HASH_CACHE_FILE_NAME = 'hash_cache.sqlite'
+
+
+def get_stat_key(st):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+class HashCache:
+    """SQLite backed digests of files keyed by their path and stat, so verifying files which did not change since they
+    were last hashed does not read them again. The change time is part of the key too, so a file written and then
+    given back its modification time is hashed again"""
+
+    def __init__(self, cache_path):
+        import sqlite3
+        self.cache_path = cache_path
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                                'path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                                'ctime_ns INTEGER, digest TEXT)')
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, path, st):
+        """Returns the digest recorded for path if it still has the stat result st, None otherwise"""
+
+        row = self.connection.execute('SELECT dev, ino, size, mtime_ns, ctime_ns, digest FROM hashes WHERE path = ?',
+                                      (path,)).fetchone()
+        if row is None or tuple(row[:5]) != get_stat_key(st):
+            return None
+        return row[5]
+
+    def put_many(self, rows):
+        """Records every (path, stat result, digest) of rows"""
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        [(path,) + get_stat_key(st) + (digest,) for path, st, digest in rows])
+
+    def forget_below(self, directory, kept_paths):
+        """Removes the digests of every path below directory which is not in kept_paths"""
+
+        prefix = os.path.join(directory, '')
+        rows = self.connection.execute('SELECT path FROM hashes WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+        stale = [(path,) for (path,) in rows.fetchall() if path not in kept_paths]
+        with self.connection:
+            self.connection.executemany('DELETE FROM hashes WHERE path = ?', stale)
+
+
+class VerifyResult:
+    """What verifying packs found"""
+
+    def __init__(self):
+        self.files_checked = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        # files of packs backed up before checksums were recorded, only their size could be checked
+        self.files_without_checksum = 0
+        # (pack name, relative path or None for the whole pack, what is wrong)
+        self.problems = list()
+        # every file whose contents were checked
+        self.seen_paths = set()
+
+
+def iter_pack_checks(store_dir, name, object_store, result):
+    """Checks everything of the named pack which does not need reading file contents and yields
+    (path, expected digest, pack name, relative path, lstat result if already known) for every file whose contents
+    have to be checked"""
+
+    pack_path = os.path.join(store_dir, name)
+    manifest = read_manifest(pack_path)
+    if manifest is None:
+        result.problems.append((name, None, 'has no manifest, run backup with --overwrite-existing for it to record one'))
+        return
+    objects = manifest.get('layout') == LAYOUT_OBJECTS
+    roots = set(manifest['roots'])
+    for relative_path in sorted(manifest['entries']):
+        entry = manifest['entries'][relative_path]
+        if objects:
+            if 'hash' in entry:
+                yield object_store.get_object_path(entry['hash']), entry['hash'], name, relative_path, None
+            continue
+        path = get_pack_entry_path(pack_path, manifest, get_root_of(relative_path, roots), relative_path)
+        if entry['type'] == 'file' and 'patch' in entry:
+            continue
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            result.problems.append((name, relative_path, 'is missing'))
+            continue
+        if entry['type'] == 'dir':
+            if not os.path.isdir(path) or os.path.islink(path):
+                result.problems.append((name, relative_path, 'is not a directory anymore'))
+        elif entry['type'] == 'symlink':
+            if not os.path.islink(path) or os.readlink(path) != entry['target']:
+                result.problems.append((name, relative_path, 'does not point at ' + entry['target'] + ' anymore'))
+        elif st.st_size != entry['size']:
+            result.problems.append((name, relative_path, 'has ' + str(st.st_size) + ' bytes instead of ' +
+                                    str(entry['size'])))
+        elif 'hash' in entry:
+            yield path, entry['hash'], name, relative_path, st
+        else:
+            result.files_checked += 1
+            result.files_without_checksum += 1
+
+
+def verify_packs(store_dir, names, object_store, engine, hash_cache, full=False):
+    """Checks every file of the named packs against the checksum recorded at backup time, hashing them with the
+    worker threads of engine. Files already hashed in the same state according to hash_cache are not read again,
+    unless full is set. An object shared by several packs is only hashed once
+
+    :rtype: VerifyResult"""
+
+    result = VerifyResult()
+    seen_paths = result.seen_paths
+    to_record = list()
+
+    def iter_jobs():
+        for name in names:
+            for path, expected, pack_name, relative_path, st in iter_pack_checks(store_dir, name, object_store,
+                                                                                  result):
+                if path in seen_paths:
+                    continue
+                seen_paths.add(path)
+                result.files_checked += 1
+                try:
+                    st = st or os.stat(path)
+                except FileNotFoundError:
+                    result.problems.append((pack_name, relative_path, 'is missing'))
+                    continue
+                digest = None if full else hash_cache.get(path, st)
+                if digest is None:
+                    yield {'path': path, 'expected': expected, 'name': pack_name, 'relative_path': relative_path,
+                           'st': st}
+                elif digest != expected:
+                    result.problems.append((pack_name, relative_path, 'does not match its checksum'))
+
+    def hash_job(job):
+        job['digest'] = hash_file(job['path'])
+
+    def record(job):
+        result.files_hashed += 1
+        result.bytes_hashed += job['st'].st_size
+        to_record.append((job['path'], job['st'], job['digest']))
+        if job['digest'] != job['expected']:
+            result.problems.append((job['name'], job['relative_path'], 'does not match its checksum'))
+
+    failed = engine.map(hash_job, iter_jobs(), lambda job: os.path.join(store_dir, job['name']), record)
+    for job, error in failed:
+        result.problems.append((job['name'], job['relative_path'], 'could not be read: ' + str(error)))
+    hash_cache.put_many(to_record)
+    return result
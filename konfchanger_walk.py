@@ -0,0 +1,69 @@
+"""
+konfchanger_walk - streaming directory tree walker for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import stat
+
+
+def scan_tree(path, read_path=None, onerror=None, exclude=None):
+    """Yields (path, read_path, lstat result) for path and, if read_path is a real directory, every path below it with
+    parents before their children. read_path is where the entries are actually read from, defaults to path.
+    exclude optionally is called with the path of every entry below path relative to it, "/" separated, and its lstat
+    result. An entry it returns True for is left out, and a directory is not even read.
+
+    Directories are read with os.scandir one entry at a time and only the directories from the top down to the current
+    entry are kept open, so memory does not grow with the number of entries in a directory or in the tree.
+    A directory which can not be read is skipped after passing the error to onerror, if given"""
+
+    read_path = read_path or path
+    st = os.lstat(read_path)
+    yield path, read_path, st
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    stack = list()
+    try:
+        try:
+            stack.append((path, '', os.scandir(read_path)))
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            return
+        while stack:
+            parent, relative_parent, iterator = stack[-1]
+            try:
+                entry = next(iterator, None)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                entry = None
+            if entry is None:
+                iterator.close()
+                stack.pop()
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+            relative_child = relative_parent + '/' + entry.name if relative_parent else entry.name
+            if exclude is not None and exclude(relative_child, st):
+                continue
+            child = os.path.join(parent, entry.name)
+            yield child, entry.path, st
+            if stat.S_ISDIR(st.st_mode):
+                try:
+                    stack.append((child, relative_child, os.scandir(entry.path)))
+                except OSError as e:
+                    if onerror is not None:
+                        onerror(e)
+    finally:
+        for _, _, iterator in stack:
+            iterator.close()
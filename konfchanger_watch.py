@@ -0,0 +1,263 @@
+"""
+konfchanger_watch - filesystem change watchers of the configuration locations for konfchanger
+Copyright (C) 2020 shrijit basak
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import stat
+import time
+import errno
+import struct
+import select
+from konfchanger_walk import scan_tree
+
+# flags from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+def is_excluded(location_rules, location, path, is_dir):
+    """Checks if the rules of location exclude path, a path inside it"""
+
+    rules = location_rules.get(location)
+    if rules is None or path == location:
+        return False
+    return rules.is_excluded(os.path.relpath(path, location).replace(os.sep, '/'), is_dir)
+
+
+class WatchedDirectory:
+    """What an inotify watch descriptor stands for: a directory inside the tree of location,
+    and/or the parent directory of the locations in children, keyed by their name"""
+
+    def __init__(self, path):
+        self.path = path
+        self.location = None
+        self.children = dict()
+
+
+class InotifyWatcher:
+    """Waits for changes below the locations using inotify. Only directories are watched: every directory inside a
+    location and the parent directory of every location, so replacing a file by renaming over it is noticed too.
+    While waiting the process just sleeps in the kernel, whatever the number of watched files.
+    Directories the rules of their location exclude are not watched, and changes to excluded files are ignored"""
+
+    def __init__(self, locations, logger, location_rules=None):
+        import ctypes
+        import ctypes.util
+        self.logger = logger
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = dict()
+        self.locations = list(locations)
+        self.location_rules = location_rules or dict()
+        try:
+            for location in self.locations:
+                self.__watch_location(location)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        os.close(self.fd)
+
+    def __add_watch(self, path):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(error, 'inotify_add_watch failed for ' + path)
+        if wd not in self.watches:
+            self.watches[wd] = WatchedDirectory(path)
+        return self.watches[wd]
+
+    def __watch_tree(self, path, location):
+        if os.path.islink(path) or not os.path.isdir(path):
+            return
+        for root, dir_names, _ in os.walk(path):
+            dir_names[:] = [name for name in dir_names
+                            if not is_excluded(self.location_rules, location, os.path.join(root, name), True)]
+            watched = self.__add_watch(root)
+            if watched is not None:
+                watched.location = location
+
+    def __watch_location(self, location):
+        """Watches the nearest existing parent of location for it being created, replaced or deleted,
+        and everything inside it if it is a directory"""
+
+        child = location
+        parent = os.path.dirname(location)
+        while not os.path.isdir(parent) and parent != os.path.dirname(parent):
+            child = parent
+            parent = os.path.dirname(parent)
+        watched = self.__add_watch(parent)
+        if watched is not None:
+            watched.children[os.path.basename(child)] = location
+        self.__watch_tree(location, location)
+
+    def __read_events(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return list()
+        events = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def __get_changed_locations(self, events):
+        changed = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.logger.log('Too many changes at once, treating every location as changed')
+                changed.update(self.locations)
+                continue
+            watched = self.watches.get(wd)
+            if watched is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            location = watched.children.get(name)
+            if location is not None:
+                changed.add(location)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.__watch_location(location)
+            if watched.location is not None:
+                if name and is_excluded(self.location_rules, watched.location, os.path.join(watched.path, name),
+                                        bool(mask & IN_ISDIR)):
+                    continue
+                changed.add(watched.location)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.__watch_tree(os.path.join(watched.path, name), watched.location)
+        return changed
+
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds, forever if None, for changes
+
+        :rtype: set of the locations which changed, empty if none did before the timeout"""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return set()
+            changed = self.__get_changed_locations(self.__read_events())
+            if changed:
+                return changed
+
+
+class PollingWatcher:
+    """Waits for changes below the locations by scanning them every interval seconds. Only a digest of the stat
+    results is kept per location, so memory does not grow with the number of watched files.
+    What the rules of a location exclude is not scanned"""
+
+    def __init__(self, locations, logger, interval=2.0, location_rules=None):
+        self.logger = logger
+        self.interval = interval
+        self.locations = list(locations)
+        self.location_rules = location_rules or dict()
+        self.digests = {location: self.__get_digest(location) for location in self.locations}
+
+    def close(self):
+        pass
+
+    def __get_digest(self, location):
+        rules = self.location_rules.get(location)
+        exclude = None
+        if rules is not None:
+            def exclude(relative_path, st):
+                return rules.is_excluded(relative_path, stat.S_ISDIR(st.st_mode))
+        digest = None
+        try:
+            for path, _, st in scan_tree(location, exclude=exclude):
+                # entries added to or removed from a directory change the digest by their paths, so the size and
+                # modification time of directories are left out, they also change for entries the rules exclude
+                if stat.S_ISDIR(st.st_mode):
+                    digest = hash((digest, path, st.st_mode, st.st_ino))
+                else:
+                    digest = hash((digest, path, st.st_mode, st.st_ino, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            return None
+        return digest
+
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds, forever if None, for changes
+
+        :rtype: set of the locations which changed, empty if none did before the timeout"""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            changed = set()
+            for location in self.locations:
+                digest = self.__get_digest(location)
+                if digest != self.digests[location]:
+                    self.digests[location] = digest
+                    changed.add(location)
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+def get_watcher(locations, logger, poll_interval=2.0, polling=False, location_rules=None):
+    """Returns an InotifyWatcher for the locations, or a PollingWatcher if polling is asked for
+    or inotify can not be used. location_rules optionally maps a location to the LocationRules of what to ignore"""
+
+    if not polling:
+        try:
+            return InotifyWatcher(locations, logger, location_rules)
+        except (OSError, AttributeError) as e:
+            logger.info('Could not use inotify, scanning for changes every ' + str(poll_interval) + ' seconds instead')
+            logger.log(e)
+    return PollingWatcher(locations, logger, poll_interval, location_rules)
+
+
+def wait_for_changes(watcher, debounce, max_delay):
+    """Waits for a change and then until no change happened for debounce seconds,
+    but no longer than max_delay seconds after the first one
+
+    :rtype: set of the locations which changed"""
+
+    changed = watcher.wait()
+    first_change = time.monotonic()
+    while True:
+        remaining = max_delay - (time.monotonic() - first_change)
+        if remaining <= 0:
+            return changed
+        more = watcher.wait(min(debounce, remaining))
+        if not more:
+            return changed
+        changed.update(more)
@@ -6,13 +6,18 @@ with open('README.md', 'r') as rdme:
 setuptools.setup(
     name='konfchanger',
     version='0.1',
-    py_modules=['konfchanger','konfchanger_utils'],
+    py_modules=['konfchanger', 'konfchanger_utils', 'konfchanger_store', 'konfchanger_copy',
+                'konfchanger_archive', 'konfchanger_index', 'konfchanger_trace',
+                'konfchanger_watch', 'konfchanger_daemon', 'konfchanger_trash',
+                'konfchanger_sync', 'konfchanger_layers', 'konfchanger_walk',
+                'konfchanger_rules', 'konfchanger_ini', 'konfchanger_diff',
+                'konfchanger_verify', 'konfchanger_journal', 'konfchanger_api'],
     install_requires=[
         'Click'
     ],
     entry_points='''
         [console_scripts]
-        konfchanger=konfchanger:konfchanger''',
+        konfchanger=konfchanger_daemon:main''',
     packages=setuptools.find_packages(),
     author='Shrijit Basak(SB-Jr)',
     author_email='shrijitbasak@gmail.com',
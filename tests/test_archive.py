@@ -0,0 +1,84 @@
+"""
+Regression tests for applying and importing untrusted pack archives
+"""
+import os
+import sys
+import json
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from konfchanger_copy import CopyEngine
+from konfchanger_archive import apply_archive, import_pack
+from konfchanger_store import LAYOUT_DIRECTORY, PACK_MANIFEST_FILE_NAME
+
+
+class NullLogger:
+    def log(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+def write_archive(archive_path, entries, members):
+    manifest = {'version': 2, 'layout': LAYOUT_DIRECTORY, 'host': 'test', 'roots': ['.config'], 'entries': entries}
+    with zipfile.ZipFile(archive_path, 'w') as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+        archive.writestr(PACK_MANIFEST_FILE_NAME, json.dumps(manifest))
+
+
+class ArchiveSymlinkEscapeTest(unittest.TestCase):
+    """An archive with the symlink .config/x pointing outside of home and the file .config/x/pwned below it"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.home = os.path.join(self.tmp, 'home')
+        self.outside = os.path.join(self.tmp, 'outside')
+        os.makedirs(os.path.join(self.home, '.config'))
+        os.makedirs(self.outside)
+        self.archive_path = os.path.join(self.tmp, 'poc.kpack')
+        entries = {
+            '.config': {'type': 'dir', 'mode': 0o755, 'mtime_ns': 0},
+            '.config/x': {'type': 'symlink', 'target': self.outside, 'mode': 0o777, 'mtime_ns': 0},
+            '.config/x/pwned': {'type': 'file', 'size': 5, 'mode': 0o644, 'mtime_ns': 0},
+        }
+        write_archive(self.archive_path, entries, {'.config/x/pwned': b'owned'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assert_nothing_outside(self):
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_apply_refuses_entries_below_symlinks(self):
+        with self.assertRaises(ValueError):
+            apply_archive(self.archive_path, self.home, ['.config'], NullLogger(), CopyEngine())
+        self.assert_nothing_outside()
+
+    def test_import_refuses_entries_below_symlinks(self):
+        pack_path = os.path.join(self.tmp, 'store', 'poc')
+        os.makedirs(pack_path)
+        with self.assertRaises(ValueError):
+            import_pack(self.archive_path, pack_path, LAYOUT_DIRECTORY)
+        self.assert_nothing_outside()
+
+    def test_apply_does_not_write_through_existing_symlinks(self):
+        os.symlink(self.outside, os.path.join(self.home, '.config', 'x'))
+        entries = {
+            '.config': {'type': 'dir', 'mode': 0o755, 'mtime_ns': 0},
+            '.config/x/pwned': {'type': 'file', 'size': 5, 'mode': 0o644, 'mtime_ns': 0},
+        }
+        write_archive(self.archive_path, entries, {'.config/x/pwned': b'owned'})
+        any_error = apply_archive(self.archive_path, self.home, ['.config'], NullLogger(), CopyEngine())
+        self.assertTrue(any_error)
+        self.assert_nothing_outside()
+
+
+if __name__ == '__main__':
+    unittest.main()
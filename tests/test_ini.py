@@ -0,0 +1,86 @@
+"""
+Regression tests for diffing and patching KDE style INI files key by key
+"""
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from konfchanger_ini import IniFile, diff_ini, parse_ini, patch_ini
+
+OLD_TEXT = '''# written by hand
+[General]
+; the scheme
+ColorScheme=Breeze
+Font=Noto
+
+[Old]
+x=1
+
+[Icons]
+# Theme=commented out
+Theme=breeze
+'''
+
+NEW_TEXT = '''[General]
+ColorScheme=Dark
+Size=10
+
+[Icons]
+Theme=papirus
+
+[New]
+a=b
+'''
+
+
+class PatchIniTest(unittest.TestCase):
+
+    def patch(self, old_text, new_text):
+        changes = diff_ini(IniFile(old_text).groups, IniFile(new_text).groups)
+        return patch_ini(old_text, changes)
+
+    def test_comments_and_order_are_kept(self):
+        self.assertEqual(self.patch(OLD_TEXT, NEW_TEXT), '''# written by hand
+[General]
+; the scheme
+ColorScheme=Dark
+Size=10
+
+[Icons]
+# Theme=commented out
+Theme=papirus
+
+[New]
+a=b
+''')
+
+    def test_patched_text_has_the_new_groups(self):
+        self.assertEqual(IniFile(self.patch(OLD_TEXT, NEW_TEXT)).groups, IniFile(NEW_TEXT).groups)
+
+    def test_same_groups_leave_the_text_alone(self):
+        reordered = '[Icons]\nTheme=breeze\n[Old]\nx=1\n[General]\nFont=Noto\nColorScheme=Breeze\n'
+        self.assertEqual(diff_ini(IniFile(OLD_TEXT).groups, IniFile(reordered).groups), dict())
+        self.assertEqual(self.patch(OLD_TEXT, reordered), OLD_TEXT)
+
+    def test_keys_before_the_first_header(self):
+        patched = self.patch('top=1\n# note\n[A]\nk=v\n', 'top=2\nadded=3\n[A]\nk=v\n')
+        self.assertEqual(patched, 'top=2\n# note\nadded=3\n[A]\nk=v\n')
+
+    def test_missing_final_newline(self):
+        self.assertEqual(self.patch('[A]\nk=v', '[A]\nk=w\nl=x\n'), '[A]\nk=w\nl=x\n')
+
+    def test_values_keep_equals_signs(self):
+        patched = self.patch('[A]\nurl=http://a/?x=1\n', '[A]\nurl=http://b/?x=2\n')
+        self.assertEqual(IniFile(patched).groups, {'A': {'url': 'http://b/?x=2'}})
+
+    def test_non_ini_is_rejected(self):
+        self.assertIsNone(parse_ini(b'[A]\nnot a key\n'))
+        self.assertIsNone(parse_ini(b'[A]\nk=1\nk=2\n'))
+        self.assertIsNone(parse_ini(b'\xff\xfe'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Regression tests for the journal of applies and undoing them
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from konfchanger_journal import ApplyJournal, list_journals, read_journal, undo_journal
+
+
+class NullLogger:
+    def log(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+class UndoJournalTest(unittest.TestCase):
+    """An apply replacing .config/kdeglobals and creating the directory .config/new with a file in it"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.home = os.path.join(self.tmp, 'home')
+        self.journal_dir = os.path.join(self.tmp, 'journal')
+        self.kdeglobals = os.path.join(self.home, '.config', 'kdeglobals')
+        self.new_dir = os.path.join(self.home, '.config', 'new')
+        self.new_file = os.path.join(self.new_dir, 'file')
+        write_file(self.kdeglobals, 'before')
+        self.journal_path = self.apply()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def apply(self):
+        journal = ApplyJournal(self.journal_dir, self.home, 'apply test')
+        journal.record(self.kdeglobals)
+        write_file(self.kdeglobals + '.tmp', 'applied')
+        os.replace(self.kdeglobals + '.tmp', self.kdeglobals)
+        journal.record(self.new_dir)
+        os.mkdir(self.new_dir)
+        journal.record(self.new_file)
+        write_file(self.new_file, 'new')
+        self.assertTrue(journal.commit())
+        return journal.path
+
+    def undo(self, force=False):
+        return undo_journal(self.journal_path, self.home, NullLogger(), force)
+
+    def test_undo_puts_everything_back(self):
+        self.assertEqual(self.undo(), (3, []))
+        self.assertEqual(read_file(self.kdeglobals), 'before')
+        self.assertFalse(os.path.lexists(self.new_dir))
+        self.assertFalse(os.path.lexists(self.journal_path))
+
+    def test_path_changed_after_the_apply_is_left_alone(self):
+        write_file(self.kdeglobals, 'edited later')
+        restored, problems = self.undo()
+        self.assertEqual(restored, 2)
+        self.assertEqual(problems, [('.config/kdeglobals', 'was changed after it was applied')])
+        self.assertEqual(read_file(self.kdeglobals), 'edited later')
+        self.assertFalse(os.path.lexists(self.new_dir))
+        self.assertEqual(list(read_journal(self.journal_path)['entries']), ['.config/kdeglobals'])
+        self.assertEqual(self.undo(force=True), (1, []))
+        self.assertEqual(read_file(self.kdeglobals), 'before')
+        self.assertFalse(os.path.lexists(self.journal_path))
+
+    def test_directory_with_files_added_after_the_apply_is_left_alone(self):
+        write_file(os.path.join(self.new_dir, 'added'), 'added')
+        restored, problems = self.undo()
+        self.assertEqual(restored, 2)
+        self.assertEqual(problems, [('.config/new', 'is a directory with files added after it was applied')])
+        self.assertEqual(read_file(os.path.join(self.new_dir, 'added')), 'added')
+        self.assertFalse(os.path.lexists(self.new_file))
+
+    def test_journals_are_listed_newest_first(self):
+        second_path = self.apply()
+        self.assertEqual([journal_path for journal_path, _ in list_journals(self.journal_dir)],
+                         [second_path, self.journal_path])
+
+    def test_apply_which_changed_nothing_leaves_no_journal(self):
+        journal = ApplyJournal(self.journal_dir, self.home, 'apply nothing')
+        self.assertFalse(journal.commit())
+        self.assertEqual(len(list_journals(self.journal_dir)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
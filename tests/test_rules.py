@@ -0,0 +1,100 @@
+"""
+Regression tests for the gitignore style exclude rules of backup_locations
+"""
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from konfchanger_rules import LocationRules, Pattern, parse_locations, parse_size
+
+# (pattern, relative path, is a directory, whether git would match it)
+CASES = [
+    ('*.lock', 'a.lock', False, True),
+    ('*.lock', 'x/y/a.lock', False, True),
+    ('*.lock', 'a.locks', False, False),
+    ('Cache/', 'Cache', True, True),
+    ('Cache/', 'x/Cache', True, True),
+    ('Cache/', 'Cache', False, False),
+    ('/Cache', 'Cache', True, True),
+    ('/Cache', 'x/Cache', True, False),
+    ('a/b', 'a/b', False, True),
+    ('a/b', 'x/a/b', False, False),
+    ('a/*.ini', 'a/x.ini', False, True),
+    ('a/*.ini', 'a/b/x.ini', False, False),
+    ('**/foo', 'foo', False, True),
+    ('**/foo', 'x/y/foo', False, True),
+    ('a/**', 'a/x', False, True),
+    ('a/**', 'a/x/y', False, True),
+    ('a/**', 'a', True, False),
+    ('a/**/b', 'a/b', False, True),
+    ('a/**/b', 'a/x/y/b', False, True),
+    ('a/**/b', 'xa/b', False, False),
+    ('?.txt', 'a.txt', False, True),
+    ('?.txt', 'ab.txt', False, False),
+    ('[!a]x', 'bx', False, True),
+    ('[!a]x', 'ax', False, False),
+    ('[a-c].ini', 'b.ini', False, True),
+    ('[a-c].ini', 'd.ini', False, False),
+    ('foo\\*', 'foo*', False, True),
+    ('foo\\*', 'foox', False, False),
+    ('\\!important', '!important', False, True),
+    ('\\#hash', '#hash', False, True),
+    ('a.b', 'axb', False, False),
+]
+
+
+class PatternTest(unittest.TestCase):
+
+    def test_gitignore_semantics(self):
+        for pattern, relative_path, is_dir, expected in CASES:
+            with self.subTest(pattern=pattern, path=relative_path, is_dir=is_dir):
+                self.assertEqual(Pattern(pattern).matches(relative_path, is_dir), expected)
+
+    def test_negation(self):
+        pattern = Pattern('!keep.log')
+        self.assertTrue(pattern.negated)
+        self.assertTrue(pattern.matches('x/keep.log', False))
+        self.assertFalse(Pattern('\\!keep.log').negated)
+
+
+class LocationRulesTest(unittest.TestCase):
+
+    def make_rules(self, *lines):
+        rules = LocationRules()
+        for line in lines:
+            rules.add_line(line)
+        return rules
+
+    def test_last_matching_pattern_decides(self):
+        rules = self.make_rules('*.log', '!keep.log')
+        self.assertTrue(rules.is_excluded('a.log', False))
+        self.assertFalse(rules.is_excluded('x/keep.log', False))
+        self.assertFalse(rules.is_excluded('a.txt', False))
+        rules = self.make_rules('!keep.log', '*.log')
+        self.assertTrue(rules.is_excluded('keep.log', False))
+
+    def test_directory_patterns_leave_files_alone(self):
+        rules = self.make_rules('Cache/')
+        self.assertTrue(rules.is_excluded('Cache', True))
+        self.assertFalse(rules.is_excluded('Cache', False))
+
+    def test_size_limits(self):
+        rules = self.make_rules('max-file-size 10K', 'max-size 1.5M')
+        self.assertEqual(rules.max_file_size, 10 * 1024)
+        self.assertEqual(rules.max_size, int(1.5 * 1024 ** 2))
+        self.assertEqual(parse_size('2GiB'), 2 * 1024 ** 3)
+        self.assertRaises(ValueError, parse_size, '10 parsecs')
+
+    def test_parse_locations(self):
+        locations = parse_locations(['# comment\n', '.config/google-chrome\n', '    Cache/\n', '\n', '.gtkrc-2.0\n'])
+        self.assertEqual([location for location, _ in locations], ['.config/google-chrome', '.gtkrc-2.0'])
+        self.assertTrue(locations[0][1].is_excluded('Default/Cache', True))
+        self.assertIsNone(locations[1][1])
+        self.assertRaises(ValueError, parse_locations, ['  *.lock\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Regression tests for the object store of configuration packs
+"""
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import konfchanger_store
+from konfchanger_store import ObjectStore
+
+
+class NullLogger:
+    def log(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+class PutFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = ObjectStore(os.path.join(self.tmp, 'store'), NullLogger())
+        self.path = os.path.join(self.tmp, 'kdeglobals')
+        with open(self.path, 'wb') as f:
+            f.write(b'A')
+        self.hash_file = konfchanger_store.hash_file
+
+    def tearDown(self):
+        konfchanger_store.hash_file = self.hash_file
+        shutil.rmtree(self.tmp)
+
+    def read_object(self, digest):
+        with open(self.store.get_object_path(digest), 'rb') as f:
+            return f.read()
+
+    def test_object_is_named_after_its_contents(self):
+        digest = self.store.put_file(self.path)
+        self.assertEqual(digest, hashlib.sha256(b'A').hexdigest())
+        self.assertEqual(self.read_object(digest), b'A')
+
+    def test_file_changing_after_hashing_is_stored_under_its_new_hash(self):
+        def hash_then_change(path):
+            digest = self.hash_file(path)
+            with open(path, 'wb') as f:
+                f.write(b'B')
+            return digest
+
+        konfchanger_store.hash_file = hash_then_change
+        digest = self.store.put_file(self.path)
+        self.assertEqual(digest, hashlib.sha256(b'B').hexdigest())
+        self.assertEqual(self.read_object(digest), b'B')
+        self.assertFalse(os.path.exists(self.store.get_object_path(hashlib.sha256(b'A').hexdigest())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+Regression tests for synchronizing configuration packs between two stores
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import konfchanger_sync
+from konfchanger_copy import CopyEngine
+from konfchanger_sync import STAGING_SUFFIX, SyncStats, apply_delta, compute_delta, get_block_size, make_signature, \
+    sync_pack
+from konfchanger_trash import get_trash_dir
+
+
+class NullLogger:
+    def log(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+def write_pack(pack_path, files):
+    for relative_path, data in files.items():
+        path = os.path.join(pack_path, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def read_pack(pack_path):
+    files = dict()
+    for root, _, file_names in os.walk(pack_path):
+        for name in file_names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, pack_path)] = f.read()
+    return files
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+
+
+def edit(rng, data, count):
+    """Returns data with count random inserts and deletes of up to 2000 bytes"""
+
+    for _ in range(count):
+        position = rng.randrange(len(data) + 1)
+        length = rng.randrange(1, 2000)
+        if rng.random() < 0.5:
+            data = data[:position] + random_bytes(rng, length) + data[position:]
+        else:
+            data = data[:position] + data[position + length:]
+    return data
+
+
+class DeltaRoundTripTest(unittest.TestCase):
+    """Files rebuilt from a basis and a delta against random edits of it"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.basis_path = os.path.join(self.tmp, 'basis')
+        self.source_path = os.path.join(self.tmp, 'source')
+        self.dest_path = os.path.join(self.tmp, 'dest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def round_trip(self, basis, source, roll_limit=None):
+        with open(self.basis_path, 'wb') as f:
+            f.write(basis)
+        with open(self.source_path, 'wb') as f:
+            f.write(source)
+        signature = make_signature(self.basis_path, get_block_size(len(basis)))
+        if roll_limit is None:
+            digest, delta = compute_delta(self.source_path, signature)
+        else:
+            digest, delta = compute_delta(self.source_path, signature, roll_limit)
+        self.assertEqual(apply_delta(self.basis_path, delta, self.dest_path), digest)
+        with open(self.dest_path, 'rb') as f:
+            self.assertEqual(f.read(), source)
+        return delta
+
+    def test_random_edits(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            basis = random_bytes(rng, rng.randrange(1, 200000))
+            self.round_trip(basis, edit(rng, basis, rng.randrange(1, 10)))
+
+    def test_random_edits_past_the_roll_limit(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            basis = random_bytes(rng, rng.randrange(1, 200000))
+            self.round_trip(basis, edit(rng, basis, rng.randrange(1, 10)), roll_limit=rng.randrange(0, 4096))
+
+    def test_empty_files(self):
+        self.round_trip(b'', b'')
+        self.round_trip(b'basis', b'')
+        self.round_trip(b'', b'source')
+
+    def test_unchanged_file_is_one_copy(self):
+        basis = random_bytes(random.Random(0), 100000)
+        self.assertEqual(self.round_trip(basis, basis), [(0, len(basis))])
+
+    def test_moved_blocks_are_found(self):
+        rng = random.Random(1)
+        basis = random_bytes(rng, 100000)
+        delta = self.round_trip(basis, b'x' + basis[:50000] + random_bytes(rng, 10) + basis[50000:])
+        # only the inserted bytes and the block they were inserted into are sent
+        literal = sum(len(instruction) for instruction in delta if not isinstance(instruction, tuple))
+        self.assertLessEqual(literal, 11 + get_block_size(len(basis)))
+
+
+class InterruptedSyncTest(unittest.TestCase):
+    """A directory layout pack whose transfer fails for one of its files"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_store = os.path.join(self.tmp, 'source')
+        self.dest_store = os.path.join(self.tmp, 'dest')
+        self.old_files = {'.config/a': b'old a', '.config/b': b'old b', '.config/c': b'unchanged'}
+        self.new_files = {'.config/a': b'new a!', '.config/b': b'new b!', '.config/c': b'unchanged'}
+        write_pack(os.path.join(self.dest_store, 'pack'), self.old_files)
+        write_pack(os.path.join(self.source_store, 'pack'), self.new_files)
+        shutil.copystat(os.path.join(self.dest_store, 'pack', '.config', 'c'),
+                        os.path.join(self.source_store, 'pack', '.config', 'c'))
+        self.transfer_file = konfchanger_sync.transfer_file
+
+    def tearDown(self):
+        konfchanger_sync.transfer_file = self.transfer_file
+        shutil.rmtree(self.tmp)
+
+    def sync(self):
+        return sync_pack(self.source_store, self.dest_store, 'pack', CopyEngine(logger=NullLogger()), SyncStats(),
+                         NullLogger())
+
+    def fail_on_b(self):
+        def transfer_file(source, dest, *args, **kwargs):
+            if source.endswith(os.sep + 'b'):
+                raise OSError('interrupted')
+            return self.transfer_file(source, dest, *args, **kwargs)
+        konfchanger_sync.transfer_file = transfer_file
+
+    def test_previous_version_is_left_untouched(self):
+        self.fail_on_b()
+        self.assertTrue(self.sync())
+        self.assertEqual(read_pack(os.path.join(self.dest_store, 'pack')), self.old_files)
+        self.assertTrue(os.path.isdir(os.path.join(self.dest_store, '.pack' + STAGING_SUFFIX)))
+
+    def test_next_transfer_completes_the_staged_one(self):
+        self.fail_on_b()
+        self.sync()
+        konfchanger_sync.transfer_file = self.transfer_file
+        self.assertFalse(self.sync())
+        self.assertEqual(read_pack(os.path.join(self.dest_store, 'pack')), self.new_files)
+        self.assertFalse(os.path.lexists(os.path.join(self.dest_store, '.pack' + STAGING_SUFFIX)))
+        self.assertEqual(len(os.listdir(get_trash_dir(self.dest_store))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()